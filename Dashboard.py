@@ -1,6 +1,66 @@
+import json
+import os
+
 import streamlit as st
-import plotly.express as px
-from streamlit_extras.switch_page_button import switch_page
+
+# Written by `python suite_runner.py`
+TEST_REPORT_PATH = 'reports/test_suite_report.json'
+
+# The widest the diagrams are shown at in the wide layout
+DIAGRAM_WIDTH = 1460
+
+# The results published before the report existed
+PUBLISHED_RESULTS = {
+    'categories': 18,
+    'variants_per_category': 20,
+    'repetitions': 10,
+    'assertions_per_test': 2,
+    'assertions': 7200,
+    'passed': 6778,
+    'failed': 422,
+}
+
+
+@st.cache_resource
+def load_asset(path):
+    # Images and the demo video are read from disk once per process
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@st.cache_resource
+def load_diagram(path, width=DIAGRAM_WIDTH):
+    # The diagrams are 7000+ px wide, shrunk once per process rather than
+    # by st.image on every run; the files keep their full resolution
+    from io import BytesIO
+
+    from PIL import Image
+    with Image.open(path) as image:
+        image.thumbnail((width, image.height), Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@st.cache_data
+def load_test_report(path, modified):
+    # modified (the file's mtime) is only there so a new report is picked up
+    with open(path, 'r', encoding='utf-8') as file:
+        report = json.load(file)
+    return {name: report[name] for name in PUBLISHED_RESULTS}
+
+
+@st.cache_resource
+def assertions_figure(passed, failed):
+    # Built once; graph_objects rather than plotly.express, which imports pandas
+    import plotly.graph_objects as go
+    fig = go.Figure(go.Pie(values=[passed, failed],
+                           labels=['Passed', 'Failed']))
+    fig.update_layout(
+        title="Status of Assertions",
+        width=200
+    )
+    return fig
 
 
 st.set_page_config(
@@ -10,13 +70,20 @@ st.set_page_config(
     page_icon="👋",
 )
 
+if os.path.exists(TEST_REPORT_PATH):
+    results = load_test_report(TEST_REPORT_PATH, os.path.getmtime(TEST_REPORT_PATH))
+else:
+    results = PUBLISHED_RESULTS
+total = max(results['assertions'], 1)
+
 st.markdown("""# Natural Language to PostgreSQL Convertor""")
 st.markdown(
-    '##### AI tool to convert natural language text to PostgreSQL commands with 94% accuracy')
+    f"##### AI tool to convert natural language text to PostgreSQL commands with {results['passed'] / total:.0%} accuracy")
 
 
 open_chatbot = st.button("Open Chatbot", key="top_button", type="primary")
 if open_chatbot:
+    from streamlit_extras.switch_page_button import switch_page
     switch_page("chatbot")
 
 st.header('Project Overview')
@@ -35,20 +102,20 @@ The main components of our project include:
 
 st.header('Demo')
 
-st.video('./assets/demo.mp4', format="video/mp4", start_time=10)
+st.video(load_asset('./assets/demo.mp4'), format="video/mp4", start_time=10)
 
 st.header('Workflows')
 
 st.markdown('### Our Complete Workflow')
 
-st.image('assets/Workflow.png',
+st.image(load_diagram('assets/Workflow.png'),
          caption='Complete Workflow of the model')
 
 "---"
 
 st.markdown(f'### Internals of the Package')
 
-st.image('assets/Workflow-Text2SQL.png',
+st.image(load_diagram('assets/Workflow-Text2SQL.png'),
          caption='Internals of the Text to SQL')
 
 "---"
@@ -71,29 +138,18 @@ Despite a challenging start, our team managed to pull together and complete the
 st.header("Testing Results")
 col1, col2 = st.columns([1, 1], gap="small")
 with col1:
-    st.markdown("""
-    - Test Categories : 18
-    - Input Variants / Category  : 20
-    - Repetitions / Input    : 10
-    - Assertions / Test : 2
+    st.markdown(f"""
+    - Test Categories : {results['categories']}
+    - Input Variants / Category  : {results['variants_per_category']:g}
+    - Repetitions / Input    : {results['repetitions']}
+    - Assertions / Test : {results['assertions_per_test']:g}
     
-    ##### Total Assertions : 7200
-    ##### Passed Assertions : 6778 (94%)
-    ##### Failed Assertions : 4222 (6%)
+    ##### Total Assertions : {results['assertions']}
+    ##### Passed Assertions : {results['passed']} ({results['passed'] / total:.0%})
+    ##### Failed Assertions : {results['failed']} ({results['failed'] / total:.0%})
     """)
 
 with col2:
-    data = {
-        'value': [6778, 422],
-        'label': ['Passed', 'Failed']
-    }
-    fig = px.pie(data,
-                 values="value",
-                 names='label',
-                 title="Status of Assertions")
-    fig.update_layout(
-        width=200
-    )
-    st.plotly_chart(fig, theme="streamlit")
+    st.plotly_chart(assertions_figure(results['passed'], results['failed']), theme="streamlit")
 
 
@@ -3,19 +3,39 @@ from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema import HumanMessage, SystemMessage, AIMessage
 
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+import time
+
+from cost_guard import CostVerdict
+from memory import ConversationMemory, memory_from_options
+from model_routing import StageRouter
+from response_cache import llm_config, make_cache_key
+from schema_parser import LoadedSchema, load_schema, prune_schema
+from sql_classifier import Verdict, classify_sql
+from structured_output import StructuredOutputError, parse_structured_answer
+from session import ChatSession
+from stage_pipeline import Discard, Join, LLMCall, Speculate, Stage, StagePipeline, StreamEvent  # noqa: F401
+from tokens import estimate_message_tokens, estimate_tokens
+from tracing import Trace, tracing_enabled
 
 @dataclass
 class ModelOutput:
     message: str
     is_final_output: bool = False
-
+    metrics: dict = field(default_factory=dict)
+    trace: Trace = None
+    cost_verdict: CostVerdict = None
 
 class IBaseClass(ABC):
     @abstractmethod
     def predict(self, user_input: str) -> ModelOutput:
         pass
 
+    @abstractmethod
+    async def apredict(self, user_input: str) -> ModelOutput:
+        pass
+
 # Enumerators
 OutputTypes = Enum('OutputTypes', [
     'SQL',
@@ -32,7 +52,14 @@ OutputTypes = Enum('OutputTypes', [
     # 'API' # This is for a later use case
 ])
 
-class NLP2SQL(IBaseClass):
+# Upper bound on the rendered system prompts kept per model
+MAX_COMPILED_PROMPTS = 64
+
+# Speculative generation threads when options['speculative_workers'] is
+# not set and the generation LLM is not an LLMGateway
+DEFAULT_SPECULATIVE_WORKERS = 32
+
+class NLP2SQL(StagePipeline, IBaseClass):
     """
     This class implements the Natural Language to the SQL 
     functionality of the package
@@ -45,8 +72,12 @@ class NLP2SQL(IBaseClass):
     def __init__(self, llm, options) -> None:
         self.llm = llm
         self.options = options
+        self.router = StageRouter(llm, options.get('stage_llms'), options.get('escalation_llm'),
+                                  options.get('llm_prices'), options.get('escalation_validator'),
+                                  track_usage=options.get('router_stats', False))
 
-        self.schema = ''
+        self.loaded_schema = load_schema('')
+        self._compiled_prompts = {}
 
         self.relevancy_prompt = """
             As an experienced data analyst with expertise in PostgreSQL, your role is to assess the relevance of a human prompt in relation to a given database schema, focusing on flexibility and practical interpretations. 
@@ -108,68 +139,438 @@ class NLP2SQL(IBaseClass):
             LIMIT YOUR RESPONSES TO UNDER THREE SENTENCES IN LENGTH.
         """.replace('  ', '').strip()
 
-        self.chat_history = []
-        self.memory_length = options['memory']*2 if 'memory' in options else 0
+        self.structured_prompt = """
+            As an experienced data analyst and PostgreSQL developer, your task is to assess a human prompt against the provided database schema, write the query that answers it and review that query, all in a single JSON object.
 
-    def predict(self, user_input: str) -> ModelOutput:
-        if len(self.schema) == 0:
-            return ModelOutput("Schema not loaded", True)
-        if len(user_input) == 0:
-            return ModelOutput("I'm sorry, I don't understand your question.", False)
-        if user_input[-1] not in '.;:?!':
-            user_input += '.'
+            Respond with the JSON object only, without code fences or commentary, using exactly these fields:
+            {{"relevant": true or false, "sql": "...", "read_only": true or false, "clarification": "..."}}
 
-        final_output = False
+            - "relevant": true if it is reasonably possible to answer the prompt using the given schema, erring on the side of a broader interpretation of column names and data types. false only if the prompt clearly cannot be answered with the schema.
+            - "sql": if relevant, a concise, well-structured PostgreSQL query answering the prompt, otherwise an empty string.
+            - "read_only": true only if the query does not modify the database in any way (such as through INSERT, UPDATE, DELETE, or ALTER statements).
+            - "clarification": if not relevant, specific questions asking for the missing information, under three sentences in length, otherwise an empty string.
 
-        relevancy_prompt = self.relevancy_prompt.format(schema=self.schema)
-        messages = [SystemMessage(content=relevancy_prompt), HumanMessage(content=user_input)]
-        response = self.llm.predict_messages(messages=(self.chat_history + messages)).content
+            Database Schema:
+            {schema}
+        """.replace('  ', '').strip()
+
+        self.memory = memory_from_options(options)
+        self._speculation_pool = None
+        if options.get('speculative', False):
+            # The model is shared by every session, a speculative call per
+            # question in flight; behind a gateway more would only queue
+            workers = options.get('speculative_workers') or getattr(
+                self.router.llm_for('generation'), 'max_in_flight', DEFAULT_SPECULATIVE_WORKERS)
+            self._speculation_pool = ThreadPoolExecutor(max_workers=workers,
+                                                         thread_name_prefix='nlp2sql-speculation')
+
+    def predict(self, user_input: str, memory: ConversationMemory = None,
+                loaded_schema: LoadedSchema = None) -> ModelOutput:
+        return self._run_steps(self._pipeline(user_input, memory, loaded_schema))
+
+    async def apredict(self, user_input: str, memory: ConversationMemory = None,
+                       loaded_schema: LoadedSchema = None) -> ModelOutput:
+        """
+        Async counterpart of predict, uses the async LangChain message API
+        so many questions can be in flight on a single event loop
+        """
+        return await self._arun_steps(self._pipeline(user_input, memory, loaded_schema))
+
+    def predict_stream(self, user_input: str, memory: ConversationMemory = None,
+                       loaded_schema: LoadedSchema = None):
+        """
+        Generator version of predict that yields StreamEvents, so the
+        answer can be shown while it is being generated. The generation,
+        escalation and clarification stages are streamed token by token.
+        """
+        return self._stream_steps(self._pipeline(user_input, memory, loaded_schema))
+
+    def _pipeline(self, user_input: str, memory: ConversationMemory = None,
+                  loaded_schema: LoadedSchema = None):
+        """
+        The stages of one question as a generator of stage_pipeline steps,
+        the only copy of them predict, apredict and predict_stream run
+        """
+        loaded_schema = loaded_schema if loaded_schema is not None else self.loaded_schema
+        user_input, early_output = self._validate_input(user_input, loaded_schema)
+        if early_output is not None:
+            return early_output
+
+        trace = Trace(user_input) if tracing_enabled(self.options) else None
+        memory = memory if memory is not None else self.memory
+        history = memory.snapshot()
+        cache_key, cached_output = self._cache_lookup(user_input, history, loaded_schema)
+        if cached_output is not None:
+            memory.add_turn(user_input, cached_output.message)
+            return (yield from self._finish(trace, cached_output, 'cache'))
+
+        metrics = {}
+        schema = self._prompt_schema(user_input, metrics, loaded_schema)
+
+        result = None
+        if self.options.get('pipeline', 'multi') == 'structured':
+            result = yield from self._structured_call(history, user_input, schema, metrics, trace)
+        if result is None:
+            result = yield from self._multi_call(history, user_input, schema, metrics, trace, loaded_schema.hash)
+        response, final_output, branch = result
+
+        memory.add_turn(user_input, response)
+
+        output = ModelOutput(response.strip(), final_output, metrics)
+        self._cache_store(cache_key, user_input, output, loaded_schema, history)
+        return (yield from self._finish(trace, output, branch))
+
+    def _multi_call(self, history, user_input: str, schema: str, metrics: dict, trace: Trace = None,
+                    schema_hash: str = ''):
+        """
+        The multi-call pipeline: relevancy, then generation and review or
+        clarification. Returns the response, whether it is final and the
+        branch taken.
+        """
+        final_output = False
+        speculative = self.options.get('speculative', False)
+        if speculative:
+            # Start generating before the relevancy verdict is in, most
+            # questions are relevant so the result is usually kept
+            generation_messages = self._generation_messages(history, user_input, schema, metrics, schema_hash)
+            generation = yield Speculate(LLMCall('generation', generation_messages))
+
+        yield Stage('relevancy')
+        messages = history.messages('relevancy') + self._stage_messages(self.relevancy_prompt, user_input, schema)
+        response, metrics['relevancy_seconds'] = yield LLMCall('relevancy', messages, trace)
         #print("Relevancy:\n"+response)
 
         if 'yes' in response.lower():
-            generation_prompt = self.generation_prompt.format(schema=self.schema)
-            messages = [SystemMessage(content=generation_prompt), HumanMessage(content=user_input)]
-            response = self.llm.predict_messages(messages=(self.chat_history + messages)).content
+            yield Stage('generation')
+            if speculative:
+                response, metrics['generation_seconds'] = yield Join(generation)
+                metrics.update(self._speculation_metrics(metrics, kept=True))
+                messages = generation_messages
+                if trace is not None:
+                    trace.add_stage('generation', metrics['generation_seconds'], messages, response,
+                                    **self.router.describe('generation', messages, response))
+            else:
+                messages = self._generation_messages(history, user_input, schema, metrics, schema_hash)
+                response, metrics['generation_seconds'] = yield LLMCall('generation', messages, trace,
+                                                                        streamed=True)
+            response = yield from self._escalate(response, messages, metrics, trace)
             #print("SQL:\n"+response)
 
-            review_prompt = self.review_prompt.format(schema=self.schema)
-            messages = [SystemMessage(content=review_prompt), HumanMessage(content=response)]
-            review_response = self.llm.predict_messages(messages=messages).content
-            #print("Review:\n"+review_response)
-            if 'yes' in review_response.lower():
+            yield Stage('review')
+            start = time.perf_counter()
+            approved, metrics['review_backend'] = yield from self._review(response, schema, trace)
+            metrics['review_seconds'] = time.perf_counter() - start
+            if approved:
                 final_output = True
+                branch = 'approved'
             else:
                 response = "I'm sorry, I don't understand your question."
+                branch = 'rejected'
         else:
-            clarification_prompt = self.clarification_prompt.format(schema=self.schema)
-            messages = [SystemMessage(content=clarification_prompt), HumanMessage(content=user_input)]
-            response = self.llm.predict_messages(messages=(self.chat_history + messages)).content
-
-        self.chat_history.append(HumanMessage(content=user_input))
-        self.chat_history.append(AIMessage(content=response))
-        if len(self.chat_history) > self.memory_length:
-            excess = len(self.chat_history) - self.memory_length
-            self.chat_history = self.chat_history[excess:]
-
-        return ModelOutput(response.strip(), final_output)
+            if speculative:
+                sent = yield Discard(generation)
+                metrics.update(self._speculation_metrics(
+                    metrics, kept=False, messages=generation_messages, future=generation, sent=sent))
+            yield Stage('clarification')
+            messages = history.messages('clarification') + self._stage_messages(self.clarification_prompt, user_input, schema)
+            response, metrics['clarification_seconds'] = yield LLMCall('clarification', messages, trace,
+                                                                       streamed=True)
+            branch = 'clarification'
+
+        return response, final_output, branch
+
+    def _structured_call(self, history, user_input: str, schema: str, metrics: dict, trace: Trace = None):
+        """
+        The single-call pipeline: one JSON verdict covers relevancy,
+        generation and review. Returns None when the response is malformed,
+        so the caller falls back to the multi-call pipeline.
+        """
+        yield Stage('structured')
+        messages = history.messages('structured') + self._stage_messages(self.structured_prompt, user_input, schema)
+        response, metrics['structured_seconds'] = yield LLMCall('structured', messages, trace)
+        return self._structured_result(response, metrics)
+
+    def _structured_result(self, response: str, metrics: dict):
+        metrics['pipeline'] = 'structured'
+        try:
+            answer = parse_structured_answer(response)
+        except StructuredOutputError as error:
+            metrics['structured_fallback'] = str(error)
+            return None
+
+        if not answer.relevant:
+            return answer.clarification, False, 'clarification'
+        # The model reviews its own SQL here, so the local classifier gets a veto
+        metrics['review_backend'] = 'structured'
+        if answer.read_only and classify_sql(answer.sql) is not Verdict.MODIFIES:
+            return answer.sql, True, 'approved'
+        return "I'm sorry, I don't understand your question.", False, 'rejected'
+
+    def _escalate(self, response: str, messages: list, metrics: dict, trace: Trace = None):
+        """
+        Generates the query again on options['escalation_llm'] when the
+        generated one fails validation, returns the response to go on with
+        """
+        reason = self.router.escalation_reason(response)
+        if not reason:
+            return response
+        metrics['escalation_reason'] = reason
+        yield Stage('escalation')
+        response, metrics['escalation_seconds'] = yield LLMCall(
+            'escalation', messages, trace, self.router.escalation_llm, streamed=True)
+        return response
+
+    def _review(self, response: str, schema: str, trace: Trace = None):
+        """
+        Decides whether the generated SQL is safe to run, returns the verdict
+        and the backend that produced it
+        """
+        if self.options.get('review_backend', 'llm') == 'local':
+            verdict = self._local_review(response, trace)
+            if verdict is not Verdict.UNKNOWN:
+                return verdict is Verdict.READ_ONLY, 'local'
+
+        messages = self._stage_messages(self.review_prompt, response, schema)
+        review_response, _ = yield LLMCall('review', messages, trace)
+        #print("Review:\n"+review_response)
+        return 'yes' in review_response.lower(), 'llm'
+
+    def _local_review(self, response: str, trace: Trace = None) -> Verdict:
+        start = time.perf_counter()
+        verdict = classify_sql(response)
+        if trace is not None and verdict is not Verdict.UNKNOWN:
+            trace.add_stage('review', time.perf_counter() - start, backend='local')
+        return verdict
+
+    def _speculation_metrics(self, metrics: dict, kept: bool, messages=None, future=None,
+                             sent: bool = False) -> dict:
+        if kept:
+            # Run serially the two calls would have taken the sum of their
+            # times, side by side only the longer one is on the critical path
+            saved = min(metrics['relevancy_seconds'], metrics['generation_seconds'])
+            return {'speculative': True, 'speculation_kept': True,
+                    'latency_saved_seconds': saved, 'wasted_tokens': 0}
+
+        wasted_tokens = 0
+        if sent:
+            # The request has gone out, so its prompt is paid for
+            wasted_tokens = estimate_message_tokens(messages)
+        if future.done() and not future.cancelled() and future.exception() is None:
+            wasted_tokens += estimate_tokens(future.result()[0])
+        return {'speculative': True, 'speculation_kept': False,
+                'latency_saved_seconds': 0.0, 'wasted_tokens': wasted_tokens}
+
+    def predict_many(self, questions: list, max_concurrency: int = 8,
+                     with_history: bool = False, loaded_schema: LoadedSchema = None) -> list:
+        """
+        Answers a batch of questions on a bounded pool of worker threads.
+        Outputs come back in input order, a question that raises gets an
+        output with the error in metrics['error'] instead of failing the
+        batch. Unless with_history is set, every question is answered on
+        its own and chat_history is left untouched.
+        """
+        def answer(question):
+            memory = self.memory if with_history else ConversationMemory(max_turns=0)
+            try:
+                return self.predict(question, memory=memory, loaded_schema=loaded_schema)
+            except Exception as error:
+                return ModelOutput(f"Error: {error}", False, {'error': repr(error)})
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency),
+                                thread_name_prefix='nlp2sql-batch') as executor:
+            return list(executor.map(answer, questions))
+
+    def _validate_input(self, user_input: str, loaded_schema: LoadedSchema):
+        if len(loaded_schema.text) == 0:
+            return user_input, ModelOutput("Schema not loaded", True)
+        if len(user_input) == 0:
+            return user_input, ModelOutput("I'm sorry, I don't understand your question.", False)
+        if user_input[-1] not in '.;:?!':
+            user_input += '.'
+        return user_input, None
+
+    def _generation_messages(self, history, user_input: str, schema: str, metrics: dict,
+                             schema_hash: str = '') -> list:
+        """
+        The generation stage's messages. With options['few_shot'] on, the
+        most similar examples of options['example_store'] for the schema go
+        between the system prompt and the question as question/answer turns.
+        """
+        messages = self._stage_messages(self.generation_prompt, user_input, schema)
+        store = self.options.get('example_store')
+        if store is None or not self.options.get('few_shot', True):
+            return history.messages('generation') + messages
+
+        start = time.perf_counter()
+        examples = store.search(user_input, schema_hash)
+        metrics['few_shot_seconds'] = time.perf_counter() - start
+        metrics['few_shot_examples'] = len(examples)
+        shots = []
+        for example in examples:
+            shots += [HumanMessage(content=example.question), AIMessage(content=example.sql)]
+        return history.messages('generation') + messages[:1] + shots + messages[1:]
+
+    def _stage_messages(self, prompt: str, content: str, schema: str) -> list:
+        return [self._system_message(prompt, schema),
+                HumanMessage(content=content)]
+
+    def _system_message(self, prompt: str, schema) -> SystemMessage:
+        """
+        Returns the SystemMessage for the prompt rendered with the schema,
+        reusing the one built for earlier calls. A schema of None means the
+        prompt is used as it is.
+        """
+        key = (prompt, schema)
+        message = self._compiled_prompts.get(key)
+        if message is None:
+            # Pruned schemas differ per question, keep the cache bounded
+            if len(self._compiled_prompts) >= MAX_COMPILED_PROMPTS:
+                self._compiled_prompts = {}
+            content = prompt if schema is None else prompt.format(schema=schema)
+            message = SystemMessage(content=content)
+            self._compiled_prompts[key] = message
+        return message
+
+    def _compile_prompts(self) -> None:
+        self._compiled_prompts = {}
+        for prompt in (self.relevancy_prompt, self.generation_prompt,
+                       self.review_prompt, self.clarification_prompt, self.structured_prompt):
+            self._system_message(prompt, self.schema)
+
+    def _prompt_schema(self, user_input: str, metrics: dict, loaded_schema: LoadedSchema) -> str:
+        """
+        The schema to put in the prompts, pruned to the tables and columns
+        relevant to the question when options['schema_token_budget'] is set
+        """
+        token_budget = self.options.get('schema_token_budget')
+        if token_budget is None or loaded_schema.tokens <= token_budget:
+            return loaded_schema.text
+
+        schema = prune_schema(loaded_schema.parsed, user_input, token_budget)
+        prompt_schema_tokens = estimate_tokens(schema)
+        metrics['schema_tokens'] = loaded_schema.tokens
+        metrics['prompt_schema_tokens'] = prompt_schema_tokens
+        metrics['schema_reduction'] = 1 - prompt_schema_tokens / loaded_schema.tokens
+        return schema
+
+    def _cache_lookup(self, user_input: str, history, loaded_schema: LoadedSchema):
+        cache_key = None
+        cache = self.options.get('cache')
+        if cache is not None:
+            prompts = [self.relevancy_prompt, self.generation_prompt,
+                       self.review_prompt, self.clarification_prompt, self.structured_prompt]
+            config = {'review_backend': self.options.get('review_backend', 'llm'),
+                      'pipeline': self.options.get('pipeline', 'multi'), 'llm': llm_config(self.llm)}
+            if self.router.config():
+                config['stages'] = self.router.config()
+            if self.options.get('example_store') is not None and self.options.get('few_shot', True):
+                config['few_shot'] = True
+            cache_key = make_cache_key(prompts, loaded_schema.text, user_input, history.messages(), config)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cached['metrics'] = {'cache': 'exact'}
+                return cache_key, ModelOutput(**cached)
+
+        # The semantic cache and the templates are keyed on the question
+        # alone, a follow-up only means the same thing in its conversation
+        standalone = not history.messages('generation')
+        semantic_cache = self.options.get('semantic_cache')
+        if semantic_cache is not None and standalone:
+            match = semantic_cache.lookup(user_input, loaded_schema.hash)
+            if match is not None:
+                cached, similarity = match
+                cached['metrics'] = {'cache': 'semantic', 'similarity': similarity}
+                return cache_key, ModelOutput(**cached)
+
+        templates = self.options.get('query_templates')
+        if templates is not None and standalone:
+            match = templates.match(user_input, loaded_schema.hash)
+            # Filled in SQL is new SQL, it only skips the pipeline when the
+            # classifier passes it the way the local review would
+            if match is not None and classify_sql(match.sql) is Verdict.READ_ONLY:
+                return cache_key, ModelOutput(match.sql, True, {
+                    'cache': 'template', 'template_confidence': match.confidence,
+                    'template_support': match.support})
+
+        return cache_key, None
+
+    def _cache_store(self, cache_key, user_input: str, output: ModelOutput,
+                     loaded_schema: LoadedSchema, history) -> None:
+        # Timings belong to the call that produced the answer, not to hits
+        value = dict(asdict(output), metrics={}, trace=None, cost_verdict=None)
+        if cache_key is not None:
+            self.options['cache'].set(cache_key, value)
+        semantic_cache = self.options.get('semantic_cache')
+        standalone = not history.messages('generation')
+        if semantic_cache is not None and output.is_final_output and standalone:
+            # Only reviewed SQL is worth reusing for reworded questions
+            semantic_cache.insert(user_input, loaded_schema.hash, value)
+        templates = self.options.get('query_templates')
+        if templates is not None and output.is_final_output and standalone:
+            templates.learn(user_input, output.message, loaded_schema.hash)
+        store = self.options.get('example_store')
+        if store is not None and output.is_final_output and standalone and 'cache' not in output.metrics:
+            # Accepted answers become examples for the questions after them,
+            # a follow-up's SQL doesn't answer its question on its own
+            store.add(user_input, output.message, loaded_schema.hash)
 
     def override_system_prompt(self, new_system_prompt: str) -> None:
         if '{schema}' in new_system_prompt:
             self.system_prompt = new_system_prompt
+            self._compile_prompts()
 
     def override_review_prompt(self, new_review_prompt: str) -> None:
         self.review_prompt = new_review_prompt
+        self._compile_prompts()
 
     def load_schema_from_file(self, file_path: str) -> bool:
         with open(file_path, 'r', encoding='utf-8') as file:
             contents = file.read()
-            self.load_schema_as_string(contents)
+            return self.load_schema_as_string(contents)
 
     def load_schema_as_string(self, schema: str) -> bool:
-        self.schema = schema
+        """
+        Loads the schema and pre-renders the prompts for it. Returns False
+        without doing any work when the schema is the one already loaded.
+        """
+        loaded_schema = load_schema(schema)
+        if loaded_schema.hash == self.loaded_schema.hash:
+            return False
+
+        self.loaded_schema = loaded_schema
+        self._compile_prompts()
+        return True
+
+    @property
+    def schema(self) -> str:
+        return self.loaded_schema.text
+
+    @property
+    def schema_hash(self) -> str:
+        return self.loaded_schema.hash
+
+    @property
+    def schema_tokens(self) -> int:
+        return self.loaded_schema.tokens
+
+    @property
+    def parsed_schema(self):
+        return self.loaded_schema.parsed
+
+    @property
+    def chat_history(self) -> list:
+        return self.memory.messages()
 
     def clear_chat_history(self) -> None:
-        self.chat_history = []
+        self.memory.clear()
+
+    def new_session(self) -> ChatSession:
+        """
+        A per-user handle with its own chat history and schema. The model
+        keeps no per-user state, so one instance can serve many sessions
+        concurrently.
+        """
+        return ChatSession(self, memory_from_options(self.options))
 
 # Can be implemented later
 
@@ -194,10 +595,15 @@ output_type_class_map = {
 }
 
 
-def initialize_model(llm, options={}, output_type: OutputTypes = OutputTypes.SQL):
+def initialize_model(llm, options={}, output_type: OutputTypes = OutputTypes.SQL,
+                     stage_llms: dict = None):
     """
-    Based on the Output Type the Model will be instantiated
+    Based on the Output Type the Model will be instantiated. stage_llms
+    maps stages ('relevancy', 'generation', 'review', 'clarification',
+    'structured') to the LLM to use for them, the others use llm.
     """
+    if stage_llms is not None:
+        options = dict(options, stage_llms=stage_llms)
 
     model_class = output_type_class_map[output_type]
     model_instance = model_class(llm, options)
@@ -0,0 +1,102 @@
+"""
+Queries per second of the pooled QueryExecutor against opening a new
+connection for every query (what execute_command does).
+
+By default a SQLite file with a generated website_aggregates table stands
+in for the database. Opening a SQLite file is far cheaper than a TCP and
+auth handshake, so run it with --postgres against a real server to see
+the saving that matters in production:
+
+    python benchmarks/execution_bench.py [--rows 100000] [--queries 500] [--threads 1 8]
+    python benchmarks/execution_bench.py --postgres "dbname=demo user=demo host=localhost"
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from executor import PostgresDialect, QueryExecutor, SQLiteDialect  # noqa: E402
+
+DOMAINS = ['hardy.net', 'meta.com', 'example.org', 'shop.io', 'acme.com']
+INDUSTRIES = ['software', 'retail', 'finance', 'health', 'education']
+QUERIES = [
+    "SELECT SUM(no_of_visiting_ips) FROM website_aggregates WHERE customer_domain = '{domain}'",
+    "SELECT industry, COUNT(*) FROM website_aggregates WHERE customer_domain = '{domain}' GROUP BY industry",
+    "SELECT lead_domain, no_of_hits FROM website_aggregates WHERE customer_domain = '{domain}' "
+    "ORDER BY no_of_hits DESC LIMIT 10",
+]
+
+
+def create_sqlite_table(path: str, rows: int) -> None:
+    generator = random.Random(0)
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE website_aggregates (id INTEGER PRIMARY KEY, dt DATE, customer_domain TEXT, "
+            "lead_domain TEXT, industry TEXT, no_of_visiting_ips INTEGER, no_of_hits INTEGER)")
+        connection.executemany(
+            "INSERT INTO website_aggregates VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((i, f"2023-{1 + i % 12:02d}-{1 + i % 28:02d}", generator.choice(DOMAINS),
+              f"lead{generator.randrange(5000)}.com", generator.choice(INDUSTRIES),
+              generator.randrange(1, 500), generator.randrange(1, 5000)) for i in range(rows)))
+        connection.execute("CREATE INDEX website_aggregates_domain ON website_aggregates (customer_domain)")
+    connection.close()
+
+
+def make_queries(count: int) -> list:
+    generator = random.Random(1)
+    return [generator.choice(QUERIES).format(domain=generator.choice(DOMAINS)) for _ in range(count)]
+
+
+def connect_per_call(dialect):
+    def run(sql):
+        connection = dialect.connect()
+        try:
+            return dialect.run(connection, sql, 30.0, None)
+        finally:
+            connection.close()
+    return run
+
+
+def queries_per_second(run, queries: list, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as workers:
+        list(workers.map(run, queries))
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--postgres', help='psycopg2 DSN of a database with website_aggregates')
+    args = parser.parse_args()
+
+    if args.postgres:
+        dialect = PostgresDialect(dsn=args.postgres)
+    else:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'bench.sqlite')
+        create_sqlite_table(path, args.rows)
+        dialect = SQLiteDialect(path)
+
+    queries = make_queries(args.queries)
+    for threads in args.threads:
+        executor = QueryExecutor(dialect, max_connections=threads)
+        pooled = queries_per_second(executor.execute, queries, threads)
+        executor.close()
+        unpooled = queries_per_second(connect_per_call(dialect), queries, threads)
+        print(f"{dialect.name} threads={threads}: connect-per-call {unpooled:8.1f} q/s, "
+              f"pooled {pooled:8.1f} q/s ({pooled / unpooled:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+A simulated LangChain chat model for benchmarks: no network, configurable
+latency and scripted answers for every stage of the NLP2SQL pipelines.
+"""
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from pathlib import Path
+from typing import Any, List, Optional
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatGeneration, ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from tokens import estimate_message_tokens, estimate_tokens  # noqa: E402
+
+# Recognises the stage from a phrase of its system prompt
+STAGE_MARKERS = [
+    ('relevancy', 'assess the relevance'),
+    ('review', 'review a provided'),
+    ('review', 'review the content provided'),
+    ('clarification', 'request additional information'),
+    ('structured', 'in a single JSON object'),
+]
+
+DEFAULT_SQL = ("SELECT SUM(no_of_visiting_ips) AS visitor_count\n"
+               "FROM website_aggregates\nWHERE customer_domain ILIKE 'hardy.net';")
+DEFAULT_CLARIFICATION = "Could you tell me which domain and date range you are interested in?"
+INVALID_SQL = "To get the visitor count you would sum the visiting IPs of hardy.net in website_aggregates."
+
+
+class FakeRateLimitError(Exception):
+    """
+    What the fake raises instead of answering, shaped like an openai
+    client error: http_status 429 and a retry-after header when set
+    """
+
+    def __init__(self, message: str, http_status: int = 429, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = {'retry-after': str(retry_after)} if retry_after is not None else {}
+
+
+def detect_stage(messages: list) -> str:
+    system = next((message.content for message in reversed(messages)
+                   if message.type == 'system'), '')
+    for stage, marker in STAGE_MARKERS:
+        if marker in system:
+            return stage
+    return 'generation'
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Latency per call is drawn from a lognormal distribution with the given
+    median and sigma (sigma 0 gives a fixed latency). Questions are judged
+    relevant for the fraction relevant_ratio of them, decided by a hash of
+    the question so reruns are reproducible. The fraction malformed_ratio
+    of structured (JSON) answers is cut short and the fraction
+    invalid_sql_ratio of generated queries is prose instead of SQL, to
+    play a weaker model. model_name is reported like an OpenAI model's.
+    Every call is recorded in `calls` with its stage, prompt size and
+    simulated latency.
+
+    To exercise retries, the fraction rate_limit_ratio of calls fail with a
+    FakeRateLimitError (429), and so does every call over requests_per_minute.
+    Like OpenAI's, the limit is enforced over shorter windows of
+    rate_limit_window seconds (a tenth of the limit in 6s, ...). server_error_ratio fails
+    calls with a 503. Rejected calls are counted in `rejected`.
+    """
+    latency_ms: float = 300.0
+    latency_sigma: float = 0.3
+    tokens_per_second: float = 50.0
+    relevant_ratio: float = 0.9
+    malformed_ratio: float = 0.0
+    invalid_sql_ratio: float = 0.0
+    model_name: str = 'fake-chat-model'
+    sql: str = DEFAULT_SQL
+    clarification: str = DEFAULT_CLARIFICATION
+    seed: int = 0
+    rate_limit_ratio: float = 0.0
+    server_error_ratio: float = 0.0
+    requests_per_minute: float = 0.0
+    rate_limit_window: float = 60.0
+    rejected: int = 0
+    calls: List[dict] = []
+    rng: Any = None
+    lock: Any = None
+    recent: Any = None
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.rng = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.recent = deque()
+
+    def _check_limits(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            window = self.rate_limit_window
+            while self.recent and self.recent[0] <= now - window:
+                self.recent.popleft()
+            error = None
+            if self.requests_per_minute and len(self.recent) >= self.requests_per_minute * window / 60:
+                error = FakeRateLimitError("Rate limit reached for requests",
+                                           retry_after=round(self.recent[0] + window - now, 3))
+            elif self.rng.random() < self.rate_limit_ratio:
+                error = FakeRateLimitError("Rate limit reached for tokens")
+            elif self.rng.random() < self.server_error_ratio:
+                error = FakeRateLimitError("The server is overloaded", http_status=503)
+            if error is not None:
+                self.rejected += 1
+                raise error
+            self.recent.append(now)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat-model'
+
+    def _latency(self) -> float:
+        with self.lock:
+            factor = self.rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else 1.0
+        return self.latency_ms * factor / 1000
+
+    def _relevant(self, question: str) -> bool:
+        return zlib.crc32(question.encode('utf-8')) % 1000 < self.relevant_ratio * 1000
+
+    def _answer(self, messages: list, stage: str) -> str:
+        question = messages[-1].content
+        if stage == 'relevancy':
+            return 'yes' if self._relevant(question) else 'no'
+        if stage == 'structured':
+            relevant = self._relevant(question)
+            answer = json.dumps({'relevant': relevant, 'sql': self.sql if relevant else '',
+                                 'read_only': relevant,
+                                 'clarification': '' if relevant else self.clarification})
+            with self.lock:
+                malformed = self.rng.random() < self.malformed_ratio
+            return answer[:len(answer) // 2] if malformed else answer
+        if stage == 'review':
+            # The llm.py review extracts the SQL, the _llm.py one says yes/no
+            return self.sql if 'Content:' in question else 'yes'
+        if stage == 'clarification':
+            return self.clarification
+        with self.lock:
+            invalid = self.rng.random() < self.invalid_sql_ratio
+        return INVALID_SQL if invalid else self.sql
+
+    def _record(self, messages: list, stage: str, latency: float, answer: str) -> None:
+        with self.lock:
+            self.calls.append({
+                'stage': stage,
+                'prompt_bytes': sum(len(message.content.encode('utf-8')) for message in messages),
+                'prompt_tokens': estimate_message_tokens(messages),
+                'completion_tokens': estimate_tokens(answer),
+                'latency': latency,
+            })
+
+    def reset(self) -> list:
+        with self.lock:
+            calls, self.calls = self.calls, []
+            self.rejected = 0
+        return calls
+
+    def _generate(self, messages, stop: Optional[list] = None, run_manager=None, **kwargs) -> ChatResult:
+        stage = detect_stage(messages)
+        self._check_limits()
+        latency = self._latency()
+        time.sleep(latency)
+        answer = self._answer(messages, stage)
+        self._record(messages, stage, latency, answer)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+    async def _agenerate(self, messages, stop: Optional[list] = None, run_manager=None, **kwargs) -> ChatResult:
+        stage = detect_stage(messages)
+        self._check_limits()
+        latency = self._latency()
+        await asyncio.sleep(latency)
+        answer = self._answer(messages, stage)
+        self._record(messages, stage, latency, answer)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+    def _stream(self, messages, stop: Optional[list] = None, run_manager=None, **kwargs):
+        # The latency is time to first token, the rest arrives word by word
+        stage = detect_stage(messages)
+        self._check_limits()
+        latency = self._latency()
+        time.sleep(latency)
+        answer = self._answer(messages, stage)
+        words = answer.split(' ')
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=word if index == len(words) - 1 else word + ' '))
+        self._record(messages, stage, latency, answer)
@@ -0,0 +1,154 @@
+"""
+Index build time and lookup latency of few_shot.ExampleStore.
+
+The examples are synthetic question/SQL pairs over website_aggregates:
+a metric (visitors, hits, companies, revenue, scores) by a dimension
+(industry, city, country, ...) with filters on domains, countries, months
+and sizes, and modifiers such as top N, daily or a rolling window, so
+terms are spread much like in real traffic. For every size it prints
+the time to build the index with add_many, the time of single add calls
+made afterwards (accepted answers while serving) and the p50/p95/p99 of
+search() for the questions of question_suite.json and generated ones.
+The examples picked for a rolling-window question are printed at the
+end.
+
+    python benchmarks/few_shot_bench.py [--sizes 1000 10000 100000] [--lookups 500] [--k 3]
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from few_shot import ExampleStore  # noqa: E402
+from mock_data import CITIES, COUNTRIES, INDUSTRIES  # noqa: E402
+from schema_parser import load_schema  # noqa: E402
+
+SUITE_PATH = Path(__file__).resolve().parent / 'question_suite.json'
+
+METRICS = [('visitors', 'SUM(no_of_visiting_ips)'), ('hits', 'SUM(no_of_hits)'),
+           ('companies', 'COUNT(DISTINCT lead_domain)'), ('average annual revenue', 'AVG(annual_revenue)'),
+           ('average intent score', 'AVG(decayed_intent_score)'), ('total funding', 'SUM(total_funding)')]
+DIMENSIONS = [('industry', 'industry'), ('city', 'city'), ('country', 'company_country'),
+              ('state', 'state'), ('funding stage', 'latest_funding_stage'), ('status', 'status'),
+              ('employee range', 'employee_range'), ('lead domain', 'lead_domain')]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December']
+
+
+def make_example(rng: random.Random, index: int):
+    metric, metric_sql = rng.choice(METRICS)
+    dimension, column = rng.choice(DIMENSIONS)
+    domain = f"site{index % 5000}.{rng.choice(['com', 'net', 'io', 'org'])}"
+    filters, conditions = [], [f"customer_domain = '{domain}'"]
+    kind = rng.random()
+    if kind < 0.3:
+        country = rng.choice(COUNTRIES)
+        filters.append(f"from {country}")
+        conditions.append(f"ip_country = '{country}'")
+    elif kind < 0.6:
+        month = rng.randrange(12)
+        filters.append(f"in {MONTHS[month]} 2023")
+        conditions.append(f"dt >= '2023-{month + 1:02d}-01' AND dt < '2023-{month + 2:02d}-01'"
+                          if month < 11 else "dt >= '2023-12-01' AND dt < '2024-01-01'")
+    elif kind < 0.8:
+        industry = rng.choice(INDUSTRIES)
+        filters.append(f"in the {industry} industry")
+        conditions.append(f"industry = '{industry}'")
+    else:
+        employees = rng.choice([50, 200, 500, 1000])
+        filters.append(f"with more than {employees} employees")
+        conditions.append(f"estimated_num_employees > {employees}")
+    where = ' AND '.join(conditions)
+
+    style = rng.random()
+    if style < 0.4:
+        count = rng.choice([3, 5, 10, 20])
+        question = f"Top {count} {dimension} by {metric} for {domain} {' '.join(filters)}"
+        sql = (f"SELECT {column}, {metric_sql} AS value\nFROM website_aggregates\nWHERE {where}\n"
+               f"GROUP BY {column}\nORDER BY value DESC\nLIMIT {count};")
+    elif style < 0.7:
+        question = f"Daily {metric} of {domain} {' '.join(filters)}"
+        sql = f"SELECT dt, {metric_sql} AS value\nFROM website_aggregates\nWHERE {where}\nGROUP BY dt\nORDER BY dt;"
+    elif style < 0.85:
+        days = rng.choice([7, 14, 30])
+        question = f"{days} day rolling {metric} for {domain} {' '.join(filters)}"
+        sql = (f"SELECT dt, SUM(daily) OVER (ORDER BY dt ROWS BETWEEN {days - 1} PRECEDING AND CURRENT ROW)"
+               f" AS rolling\nFROM (SELECT dt, {metric_sql} AS daily FROM website_aggregates\n"
+               f"WHERE {where} GROUP BY dt) AS days\nORDER BY dt;")
+    else:
+        city = rng.choice(CITIES)
+        question = f"How many {metric} did {domain} get from {city} {' '.join(filters)}?"
+        sql = f"SELECT {metric_sql} AS value\nFROM website_aggregates\nWHERE {where} AND city = '{city}';"
+    return question, sql
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_size(size: int, questions: list, schema_hash: str, args) -> ExampleStore:
+    rng = random.Random(size)
+    examples = [make_example(rng, index) for index in range(size)]
+    store = ExampleStore(k=args.k)
+
+    start = time.perf_counter()
+    store.add_many(examples, schema_hash)
+    build_seconds = time.perf_counter() - start
+
+    # The first search of a term builds its arrays, the rest reuse them
+    start = time.perf_counter()
+    for question in questions:
+        store.search(question, schema_hash)
+    first_ms = (time.perf_counter() - start) * 1000 / len(questions)
+
+    samples = []
+    for index in range(args.lookups):
+        start = time.perf_counter()
+        store.search(questions[index % len(questions)], schema_hash)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    extra = [make_example(rng, size + index) for index in range(200)]
+    start = time.perf_counter()
+    for question, sql in extra:
+        store.add(question, sql, schema_hash)
+    add_ms = (time.perf_counter() - start) * 1000 / len(extra)
+
+    print(f"{size:>8} {build_seconds:9.2f}s {size / build_seconds:>10,.0f}/s {add_ms:8.3f}ms "
+          f"{first_ms:9.2f}ms {statistics.median(samples):7.2f}ms {percentile(samples, 0.95):7.2f}ms "
+          f"{percentile(samples, 0.99):7.2f}ms")
+    return store
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--k', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        suite = json.load(file)
+    schema_hash = load_schema(suite['schema']).hash
+    rng = random.Random(-1)
+    questions = [case['question'] for case in suite['cases']]
+    questions += [make_example(rng, index)[0] for index in range(len(questions))]
+
+    print(f"{'examples':>8} {'build':>10} {'rate':>12} {'add':>10} {'1st search':>11} "
+          f"{'p50':>9} {'p95':>9} {'p99':>9}")
+    for size in args.sizes:
+        store = bench_size(size, questions, schema_hash, args)
+
+    question = "Give the 7 day rolling sum of hits for example.org"
+    print(f"\n{question}:")
+    for example in store.search(question, schema_hash):
+        print(f"  {example.question}")
+
+
+if __name__ == '__main__':
+    main()
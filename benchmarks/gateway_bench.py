@@ -0,0 +1,112 @@
+"""
+Traffic spike against a rate limited LLM, with and without LLMGateway.
+
+FakeChatModel plays OpenAI with a requests-per-minute limit enforced per
+second (and a few random 429s on top): calls over the limit fail with a
+429. One heavy session fires a burst of questions from many threads while
+a few light sessions ask one question at a time.
+
+direct        every call goes straight to the model, as before the gateway
+gateway fifo  the gateway, every call in a single queue
+gateway fair  the gateway, one queue per session served round robin
+
+For each setup it prints failed questions, 429s returned by the model,
+retries, the gateway's peak queue depth and the p50/p95 latency of the
+heavy and the light sessions.
+
+    python benchmarks/gateway_bench.py [--rpm 600] [--heavy 60] [--light 4] [--light-questions 5]
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from fake_llm import FakeChatModel  # noqa: E402
+from llm import initialize_model  # noqa: E402
+from llm_gateway import LLMGateway, llm_session  # noqa: E402
+from memory import ConversationMemory  # noqa: E402
+
+SCHEMA = "CREATE TABLE website_aggregates (id SERIAL PRIMARY KEY, customer_domain VARCHAR(255), no_of_hits BIGINT);"
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * fraction)))] if ordered else 0.0
+
+
+def ask(model, session: str, question: str):
+    start = time.perf_counter()
+    with llm_session(session):
+        try:
+            model.predict(question, memory=ConversationMemory(max_turns=0))
+            failed = False
+        except Exception:
+            failed = True
+    return time.perf_counter() - start, failed
+
+
+def run(setup: str, args) -> dict:
+    fake = FakeChatModel(latency_ms=args.latency_ms, latency_sigma=0.2,
+                         requests_per_minute=args.rpm, rate_limit_window=1.0,
+                         rate_limit_ratio=args.random_429)
+    llm = fake if setup == 'direct' else LLMGateway(
+        fake, requests_per_minute=args.rpm * 0.95, max_in_flight=args.max_in_flight,
+        backoff_base=0.2, backoff_max=5.0, seed=0)
+    model = initialize_model(llm, {})
+    model.load_schema_as_string(SCHEMA)
+
+    def session_name(name):
+        return '' if setup == 'gateway fifo' else name
+
+    with ThreadPoolExecutor(max_workers=args.heavy + args.light) as workers:
+        heavy = [workers.submit(ask, model, session_name('heavy'), f"Heavy question {i}?")
+                 for i in range(args.heavy)]
+
+        def light_session(index):
+            return [ask(model, session_name(f'light-{index}'), f"Light question {index}-{i}?")
+                    for i in range(args.light_questions)]
+        light = [workers.submit(light_session, index) for index in range(args.light)]
+        heavy_runs = [future.result() for future in heavy]
+        light_runs = [run for future in light for run in future.result()]
+
+    stats = llm.stats() if setup != 'direct' else {}
+    runs = heavy_runs + light_runs
+    return {
+        'failed': sum(failed for _, failed in runs),
+        'questions': len(runs),
+        'rejected_429': fake.rejected,
+        'retries': stats.get('retries', 0),
+        'max_queue_depth': stats.get('max_queue_depth', 0),
+        'heavy_p50': percentile([seconds for seconds, _ in heavy_runs], 0.5),
+        'heavy_p95': percentile([seconds for seconds, _ in heavy_runs], 0.95),
+        'light_p50': percentile([seconds for seconds, _ in light_runs], 0.5),
+        'light_p95': percentile([seconds for seconds, _ in light_runs], 0.95),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rpm', type=float, default=600, help="the fake model's requests per minute limit")
+    parser.add_argument('--random-429', type=float, default=0.02, help='fraction of calls failing at random')
+    parser.add_argument('--latency-ms', type=float, default=200.0)
+    parser.add_argument('--heavy', type=int, default=60, help='questions the heavy session sends at once')
+    parser.add_argument('--light', type=int, default=4, help='light sessions')
+    parser.add_argument('--light-questions', type=int, default=5)
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'setup':14} {'failed':>8} {'429s':>6} {'retries':>8} {'queue':>6} "
+          f"{'heavy p50/p95':>16} {'light p50/p95':>16}")
+    for setup in ('direct', 'gateway fifo', 'gateway fair'):
+        result = run(setup, args)
+        print(f"{setup:14} {result['failed']:>4}/{result['questions']:<3} {result['rejected_429']:>6} "
+              f"{result['retries']:>8} {result['max_queue_depth']:>6} "
+              f"{result['heavy_p50']:7.2f}/{result['heavy_p95']:<7.2f}s "
+              f"{result['light_p50']:7.2f}/{result['light_p95']:<7.2f}s")
+
+
+if __name__ == '__main__':
+    main()
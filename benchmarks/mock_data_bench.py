@@ -0,0 +1,93 @@
+"""
+Throughput of mock_data.MockDataGenerator against a row-at-a-time
+generator, on the website_aggregates table of question_suite.json.
+
+row-at-a-time  one Python loop iteration per row: random.choice,
+               random.randint and friends per value, csv.writer per row,
+               the way mock data is usually generated
+csv / parquet  MockDataGenerator.to_csv and to_parquet, in one process
+               and in --processes processes
+
+The row-at-a-time generator runs on --baseline-rows rows only, it would
+take minutes on millions. Every setup prints rows/second, the time and
+the size of the file written.
+
+    python benchmarks/mock_data_bench.py [--rows 1000000] [--processes 4]
+    python benchmarks/mock_data_bench.py --rows 10000000
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from mock_data import (CITIES, COUNTRIES, INDUSTRIES, MockDataGenerator, _FLOAT_TYPES,  # noqa: E402
+                       _INTEGER_TYPES, _base_type)
+
+SUITE_PATH = Path(__file__).resolve().parent / 'question_suite.json'
+
+
+def row_at_a_time(generator: MockDataGenerator, path: str, rows: int) -> None:
+    words = COUNTRIES + CITIES + INDUSTRIES
+    start = datetime.date(2023, 1, 1)
+    types = [_base_type(column.type) for column in generator.table.columns]
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(generator.column_names)
+        for _ in range(rows):
+            values = []
+            for base_type in types:
+                if base_type in _INTEGER_TYPES:
+                    values.append(random.randint(1, 100000))
+                elif base_type in ('DATE', 'TIMESTAMP', 'TIMESTAMPTZ'):
+                    values.append(start + datetime.timedelta(days=random.randint(0, 364)))
+                elif base_type in _FLOAT_TYPES:
+                    values.append(round(random.uniform(0, 1e6), 2))
+                else:
+                    values.append(random.choice(words))
+            writer.writerow(values)
+
+
+def measure(label: str, write, path: str, rows: int) -> None:
+    start = time.perf_counter()
+    write(path, rows)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path) / 1e6
+    print(f"{label:24} {rows:>10} {rows / seconds:>12,.0f} {seconds:8.2f}s {size:9.1f}MB")
+    os.remove(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--baseline-rows', type=int, default=100000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        schema = json.load(file)['schema']
+    directory = tempfile.mkdtemp()
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'setup':24} {'rows':>10} {'rows/s':>12} {'time':>9} {'size':>11}")
+    generator = MockDataGenerator(schema, processes=1)
+    measure('row-at-a-time csv', partial(row_at_a_time, generator),
+            os.path.join(directory, 'baseline.csv'), args.baseline_rows)
+    for processes in sorted({1, args.processes}):
+        generator = MockDataGenerator(schema, processes=processes)
+        measure(f"csv, {processes} processes", generator.to_csv,
+                os.path.join(directory, 'rows.csv'), args.rows)
+        measure(f"parquet, {processes} processes", generator.to_parquet,
+                os.path.join(directory, 'rows.parquet'), args.rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Peak Python memory of reading a whole result with QueryExecutor.execute
+(every row fetched at once) against QueryExecutor.stream (a server-side
+cursor read page by page), and of exporting it to CSV (and to Parquet
+when pyarrow is installed).
+
+The stream column should stay flat as the row count grows, the execute
+column grows with it.
+
+    python benchmarks/paged_result_bench.py [--rows 10000 100000 500000] [--page-size 1000]
+    python benchmarks/paged_result_bench.py --postgres "dbname=demo user=demo host=localhost"
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from execution_bench import create_sqlite_table  # noqa: E402
+from executor import PostgresDialect, QueryExecutor, SQLiteDialect  # noqa: E402
+
+QUERY = "SELECT * FROM website_aggregates ORDER BY id LIMIT {rows}"
+
+
+def measure(read) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = read()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rows, peak, seconds
+
+
+def read_all(executor, sql):
+    return lambda: executor.execute(sql, max_rows=None).row_count
+
+
+def read_paged(executor, sql, page_size):
+    def read():
+        rows = 0
+        with executor.stream(sql, page_size=page_size, max_rows=None) as result:
+            for page in result:
+                rows += page.row_count
+        return rows
+    return read
+
+
+def export(executor, sql, page_size, path, to_parquet=False):
+    def write():
+        result = executor.stream(sql, page_size=page_size, max_rows=None)
+        return result.to_parquet(path) if to_parquet else result.to_csv(path)
+    return write
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--postgres', help='psycopg2 DSN of a database with website_aggregates')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    if args.postgres:
+        dialect = PostgresDialect(dsn=args.postgres)
+    else:
+        path = os.path.join(directory, 'bench.sqlite')
+        create_sqlite_table(path, max(args.rows))
+        dialect = SQLiteDialect(path)
+    try:
+        import pyarrow  # noqa: F401
+        formats = ['csv', 'parquet']
+    except ImportError:
+        formats = ['csv']
+
+    executor = QueryExecutor(dialect, max_connections=1, statement_timeout=600)
+    print(f"{'rows':>8} {'execute':>16} {'stream':>16}" + ''.join(f" {name:>16}" for name in formats))
+    for rows in args.rows:
+        sql = QUERY.format(rows=rows)
+        cells = []
+        readers = [read_all(executor, sql), read_paged(executor, sql, args.page_size)]
+        readers += [export(executor, sql, args.page_size, os.path.join(directory, f'export.{name}'),
+                           to_parquet=name == 'parquet') for name in formats]
+        for read in readers:
+            count, peak, seconds = measure(read)
+            assert count == rows, (count, rows)
+            cells.append(f"{peak / 2 ** 20:7.1f} MiB {seconds:5.2f}s")
+        print(f"{rows:>8} " + ' '.join(f"{cell:>16}" for cell in cells))
+    executor.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Per-call prompt preparation overhead of _llm.NLP2SQL at large schema sizes.
+
+Compares formatting the four stage prompts on every call (what predict
+used to do) with the pre-rendered SystemMessages, and reloading an
+unchanged schema (what the chatbot pages do on every message) with
+loading a new one.
+
+    python benchmarks/prompt_prep_bench.py [--tables 10 100 1000]
+"""
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from langchain.schema import HumanMessage, SystemMessage  # noqa: E402
+
+from _llm import initialize_model  # noqa: E402
+from schema_parser import load_schema  # noqa: E402
+
+
+def make_schema(tables: int) -> str:
+    return '\n'.join(
+        f"CREATE TABLE table_{i} (\n    id SERIAL PRIMARY KEY,\n    name VARCHAR(255),\n"
+        f"    created_at DATE,\n    parent_id INT REFERENCES table_{max(i - 1, 0)}(id),\n"
+        f"    amount_{i} FLOAT\n);" for i in range(tables))
+
+
+def bench(tables: int, number: int) -> dict:
+    model = initialize_model(llm=None, options={})
+    schema = make_schema(tables)
+    model.load_schema_as_string(schema)
+    prompts = (model.relevancy_prompt, model.generation_prompt,
+               model.review_prompt, model.clarification_prompt)
+
+    def format_every_call():
+        for prompt in prompts:
+            [SystemMessage(content=prompt.format(schema=model.schema)),
+             HumanMessage(content='How many visitors did meta.com get?')]
+
+    def precompiled():
+        for prompt in prompts:
+            model._stage_messages(prompt, 'How many visitors did meta.com get?', model.schema)
+
+    def reload_unchanged():
+        model.load_schema_as_string(schema)
+
+    def reload_changed():
+        load_schema.cache_clear()
+        model.loaded_schema = load_schema('')
+        model.load_schema_as_string(schema)
+
+    def per_call_us(function, repeat=number):
+        return min(timeit.repeat(function, number=repeat, repeat=3)) / repeat * 1e6
+
+    return {
+        'tables': tables,
+        'schema_bytes': len(schema),
+        'format_every_call_us': per_call_us(format_every_call),
+        'precompiled_us': per_call_us(precompiled),
+        'reload_unchanged_us': per_call_us(reload_unchanged),
+        'reload_changed_us': per_call_us(reload_changed, max(1, number // 100)),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tables', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--number', type=int, default=1000)
+    args = parser.parse_args()
+
+    for tables in args.tables:
+        print(json.dumps(bench(tables, args.number)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Dashboard-style workload on a large local website_aggregates table with
+and without a ResultCache in front of QueryExecutor.
+
+A handful of aggregates are rerun over and over, written with different
+spacing and keyword case the way generated SQL comes back. Every
+--write-every queries a row is inserted through a separate connection,
+which the cache must notice: either the writer calls
+cache.invalidate('website_aggregates') or the executor polls and sees
+SQLite's data_version change. Every cached answer is checked against the
+database; the writes and the checks are not timed.
+
+    python benchmarks/result_cache_bench.py [--rows 500000] [--queries 300] [--write-every 50]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from execution_bench import create_sqlite_table  # noqa: E402
+from executor import QueryExecutor, SQLiteDialect  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+
+AGGREGATES = [
+    "SELECT customer_domain, SUM(no_of_visiting_ips) FROM website_aggregates GROUP BY customer_domain",
+    "SELECT industry, COUNT(*), AVG(no_of_hits) FROM website_aggregates GROUP BY industry ORDER BY 2 DESC",
+    "SELECT strftime('%m', dt) AS month, SUM(no_of_hits) FROM website_aggregates "
+    "WHERE customer_domain = 'hardy.net' GROUP BY month",
+    "SELECT COUNT(DISTINCT lead_domain) FROM website_aggregates WHERE industry = 'software'",
+    "SELECT lead_domain, SUM(no_of_hits) AS hits FROM website_aggregates GROUP BY lead_domain "
+    "ORDER BY hits DESC LIMIT 10",
+]
+
+
+def reformat(sql: str, generator: random.Random) -> str:
+    # Same query, different spacing and keyword case
+    words = sql.split(' ')
+    if generator.random() < 0.5:
+        words = [word.lower() if word.isupper() else word for word in words]
+    return (' ' * generator.randrange(1, 3)).join(words) + generator.choice(['', ';', '\n'])
+
+
+def run(executor, cache, writer, queries: list, write_every: int, invalidate: str) -> dict:
+    latencies = []
+    untimed = 0.0
+    start = time.perf_counter()
+    for index, sql in enumerate(queries):
+        if write_every and index and index % write_every == 0:
+            write_start = time.perf_counter()
+            writer.execute("INSERT INTO website_aggregates (dt, customer_domain, lead_domain, industry, "
+                           "no_of_visiting_ips, no_of_hits) VALUES ('2023-06-01', 'hardy.net', 'new.com', "
+                           "'software', 1, 1)")
+            writer.commit()
+            if cache is not None and invalidate == 'explicit':
+                cache.invalidate('website_aggregates')
+            elif cache is not None:
+                time.sleep(cache.poll_interval)  # let the next query poll
+            untimed += time.perf_counter() - write_start
+        query_start = time.perf_counter()
+        result = executor.execute(sql)
+        latencies.append(time.perf_counter() - query_start)
+        if result.cached:
+            # A cached answer must still match the database
+            check_start = time.perf_counter()
+            fresh = writer.execute(sql).fetchall()
+            assert [tuple(row) for row in result.rows()] == fresh, sql
+            untimed += time.perf_counter() - check_start
+    seconds = time.perf_counter() - start - untimed
+    latencies.sort()
+    return {'qps': len(queries) / seconds, 'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'hit_rate': cache.stats()['hit_rate'] if cache is not None else 0.0}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--write-every', type=int, default=50, help='0 for a read-only workload')
+    parser.add_argument('--poll-interval', type=float, default=0.01)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    create_sqlite_table(path, args.rows)
+    generator = random.Random(0)
+    queries = [reformat(generator.choice(AGGREGATES), generator) for _ in range(args.queries)]
+
+    setups = [('no cache', None, None),
+              ('cache, invalidate()', ResultCache(), 'explicit'),
+              ('cache, polled version', ResultCache(poll_interval=args.poll_interval), 'poll')]
+    print(f"rows={args.rows} queries={args.queries} write_every={args.write_every}")
+    for name, cache, invalidate in setups:
+        writer = sqlite3.connect(path)
+        executor = QueryExecutor(SQLiteDialect(path), max_connections=1, max_rows=None, cache=cache)
+        stats = run(executor, cache, writer, queries, args.write_every, invalidate)
+        executor.close()
+        writer.close()
+        print(f"{name:24} {stats['qps']:8.1f} q/s  p50 {stats['p50_ms']:8.2f} ms  "
+              f"hit rate {stats['hit_rate']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Checks that the local SQL classifier agrees with the LLM review stage.
+
+By default the verdicts recorded in review_corpus.json are used. With
+--live every statement is sent through the review prompt of
+_llm.NLP2SQL (needs OPENAI_API_KEY) and the live verdicts are used instead.
+
+    python benchmarks/review_agreement.py [--live]
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from sql_classifier import Verdict, classify_sql  # noqa: E402
+
+CORPUS_PATH = Path(__file__).resolve().parent / 'review_corpus.json'
+
+
+def live_verdicts(corpus: list) -> list:
+    from langchain.chat_models import ChatOpenAI
+    from _llm import initialize_model
+
+    llm = ChatOpenAI(model="gpt-3.5-turbo-16k",
+                     openai_api_key=os.environ['OPENAI_API_KEY'], temperature=0)
+    model = initialize_model(llm, {'review_backend': 'llm'})
+    model.load_schema_as_string('website_aggregates')
+    return ['yes' if model._run_steps(model._review(case['sql'], model.schema))[0] else 'no' for case in corpus]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--live', action='store_true',
+                        help='ask the LLM for the reference verdicts')
+    args = parser.parse_args()
+
+    with open(CORPUS_PATH, 'r', encoding='utf-8') as file:
+        corpus = json.load(file)
+    references = live_verdicts(corpus) if args.live else [case['llm_verdict'] for case in corpus]
+
+    agreed, fallbacks, disagreements = 0, 0, []
+    for case, reference in zip(corpus, references):
+        verdict = classify_sql(case['sql'])
+        if verdict is Verdict.UNKNOWN:
+            fallbacks += 1
+            continue
+        local = 'yes' if verdict is Verdict.READ_ONLY else 'no'
+        if local == reference:
+            agreed += 1
+        else:
+            disagreements.append((case['sql'], reference, local))
+
+    classified = len(corpus) - fallbacks
+    print(f"Statements: {len(corpus)}")
+    print(f"Classified locally: {classified} ({classified / len(corpus):.0%})")
+    print(f"Sent to LLM fallback: {fallbacks}")
+    print(f"Agreement: {agreed}/{classified}")
+    for sql, reference, local in disagreements:
+        print(f"  DISAGREE llm={reference} local={local}: {sql}")
+    return 1 if disagreements else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
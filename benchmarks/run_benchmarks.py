@@ -0,0 +1,230 @@
+"""
+Offline latency and throughput benchmarks for llm.NLP2SQL and _llm.NLP2SQL.
+
+Both models run against FakeChatModel, so no API key or network is needed
+and the simulated LLM latency is reproducible (seeded). Every combination
+of model, schema size, memory and review is measured for (review 'off'
+runs _llm with its LLM-free local review backend, labelled 'local'):
+
+  - per-stage latency as the model measured it (its *_seconds metrics,
+    the local review included) and end-to-end latency (p50/p95/p99),
+    questions answered one after another
+  - Python overhead per question: end-to-end time minus the simulated
+    LLM latency
+  - prompt bytes and estimated tokens sent per question
+  - throughput of predict_many with N concurrent callers
+
+Results are written as JSON. Pass --compare with an earlier result file to
+flag regressions between versions (exit status 1 if any).
+
+    python benchmarks/run_benchmarks.py [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import _llm  # noqa: E402
+import llm  # noqa: E402
+from fake_llm import FakeChatModel  # noqa: E402
+
+MODELS = {'llm': llm, '_llm': _llm}
+
+DOMAINS = ['hardy.net', 'meta.com', 'example.org', 'shop.io', 'news.co.uk', 'acme.com']
+QUESTION_TEMPLATES = [
+    "How many visitors did {domain} get in {month}?",
+    "What was the average visit duration on {domain} in {month}?",
+    "Show the top 5 landing pages of {domain} for {month}",
+    "Which countries sent the most traffic to {domain} in {month}?",
+    "Compare the bounce rate of {domain} between {month} and the month before",
+]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June']
+
+# Stages whose times the models report as metrics['<stage>_seconds']
+STAGES = ('relevancy', 'generation', 'review', 'clarification', 'escalation', 'structured')
+
+# Metrics compared by --compare (higher is worse) with the smallest
+# absolute change that is not just timer noise
+COMPARED_METRICS = {
+    'end_to_end_p50_seconds': 0.005,
+    'end_to_end_p95_seconds': 0.01,
+    'overhead_p50_ms': 1.0,
+    'prompt_tokens_mean': 1,
+}
+
+
+def make_schema(tables: int) -> str:
+    schema = [
+        "CREATE TABLE website_aggregates (\n    id SERIAL PRIMARY KEY,\n"
+        "    customer_domain VARCHAR(255),\n    no_of_visiting_ips INT,\n"
+        "    avg_visit_duration FLOAT,\n    bounce_rate FLOAT,\n    date DATE\n);"
+    ]
+    schema += [
+        f"CREATE TABLE table_{i} (\n    id SERIAL PRIMARY KEY,\n    name VARCHAR(255),\n"
+        f"    created_at DATE,\n    parent_id INT REFERENCES table_{max(i - 1, 0)}(id),\n"
+        f"    amount_{i} FLOAT\n);" for i in range(tables - 1)]
+    return '\n'.join(schema)
+
+
+def make_questions(count: int) -> list:
+    combinations = itertools.cycle(itertools.product(QUESTION_TEMPLATES, DOMAINS, MONTHS))
+    return [template.format(domain=domain, month=month)
+            for _, (template, domain, month) in zip(range(count), combinations)]
+
+
+def percentiles(values: list, prefix: str, scale: float = 1.0, unit: str = 'seconds') -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def percentile(fraction):
+        position = (len(ordered) - 1) * fraction
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return (ordered[low] + (ordered[high] - ordered[low]) * (position - low)) * scale
+
+    return {f"{prefix}_p{round(fraction * 100)}_{unit}": percentile(fraction)
+            for fraction in (0.5, 0.95, 0.99)}
+
+
+def build_model(config: dict, fake: FakeChatModel):
+    options = {'memory': config['memory']}
+    if config['model'] == 'llm':
+        options['review'] = config['review'] != 'off'
+    else:
+        options['review_backend'] = config['review']
+    model = MODELS[config['model']].initialize_model(fake, options)
+    model.load_schema_as_string(make_schema(config['tables']))
+    return model
+
+
+def run_config(config: dict, questions: list, concurrency: list, args) -> dict:
+    fake = FakeChatModel(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                         relevant_ratio=args.relevant_ratio, seed=args.seed)
+    model = build_model(config, fake)
+
+    end_to_end, overhead, stages = [], [], {}
+    prompt_bytes, prompt_tokens = [], []
+    for question in questions:
+        fake.reset()
+        start = time.perf_counter()
+        output = model.predict(question)
+        elapsed = time.perf_counter() - start
+        calls = fake.reset()
+
+        end_to_end.append(elapsed)
+        overhead.append(elapsed - sum(call['latency'] for call in calls))
+        prompt_bytes.append(sum(call['prompt_bytes'] for call in calls))
+        prompt_tokens.append(sum(call['prompt_tokens'] for call in calls))
+        for stage in STAGES:
+            if f"{stage}_seconds" in output.metrics:
+                stages.setdefault(stage, []).append(output.metrics[f"{stage}_seconds"])
+
+    result = dict(config)
+    result['questions'] = len(questions)
+    result.update(percentiles(end_to_end, 'end_to_end'))
+    result.update(percentiles(overhead, 'overhead', scale=1000, unit='ms'))
+    for stage, latencies in sorted(stages.items()):
+        result.update(percentiles(latencies, stage))
+        result[f"{stage}_calls"] = len(latencies)
+    result['prompt_bytes_mean'] = sum(prompt_bytes) / len(prompt_bytes)
+    result['prompt_tokens_mean'] = sum(prompt_tokens) / len(prompt_tokens)
+
+    result['throughput'] = {}
+    for callers in concurrency:
+        model.clear_chat_history()
+        start = time.perf_counter()
+        model.predict_many(questions, max_concurrency=callers)
+        result['throughput'][str(callers)] = len(questions) / (time.perf_counter() - start)
+    return result
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+
+    def key(result):
+        return tuple(result[name] for name in ('model', 'tables', 'memory', 'review'))
+
+    previous = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        checks = [(name, old.get(name), result.get(name), floor)
+                  for name, floor in COMPARED_METRICS.items()]
+        # Throughput is negated so that higher is worse here too
+        checks += [(f"throughput@{callers}", -old['throughput'].get(callers, 0), -value, 0)
+                   for callers, value in result['throughput'].items()]
+        for name, before, after, floor in checks:
+            if before is None or after is None:
+                continue
+            if after - before > max(abs(before) * tolerance, floor):
+                regressions.append(f"{key(result)} {name}: {abs(before):.4g} -> {abs(after):.4g}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--tables', type=int, nargs='+', default=[1, 50, 500])
+    parser.add_argument('--memory', type=int, nargs='+', default=[0, 5],
+                        help='turns of chat history kept')
+    parser.add_argument('--review', nargs='+', default=['off', 'llm'], choices=['off', 'llm'])
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--latency-ms', type=float, default=50.0,
+                        help='median simulated latency per LLM call')
+    parser.add_argument('--latency-sigma', type=float, default=0.3,
+                        help='lognormal sigma of the latency, 0 for a fixed latency')
+    parser.add_argument('--relevant-ratio', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier result file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    questions = make_questions(args.questions)
+    results = []
+    for model, tables, memory, review in itertools.product(args.models, args.tables, args.memory, args.review):
+        # _llm always reviews, without the LLM it reviews locally
+        if model == '_llm' and review == 'off':
+            review = 'local'
+        config = {'model': model, 'tables': tables, 'memory': memory, 'review': review}
+        result = run_config(config, questions, args.concurrency, args)
+        results.append(result)
+        print(f"{model:5} tables={tables:<5} memory={memory:<3} review={review:5} "
+              f"p50={result['end_to_end_p50_seconds'] * 1000:7.1f}ms "
+              f"p99={result['end_to_end_p99_seconds'] * 1000:7.1f}ms "
+              f"overhead_p50={result['overhead_p50_ms']:6.2f}ms "
+              f"tokens={result['prompt_tokens_mean']:8.0f} "
+              + ' '.join(f"qps@{callers}={qps:.1f}" for callers, qps in result['throughput'].items()))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'settings': {name: value for name, value in vars(args).items()
+                     if name not in ('output', 'compare')},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Lookup latency of SemanticCache at different numbers of cached questions.
+
+The matrix is filled with random unit vectors (embedding a million
+questions would dominate the run), lookups embed real questions with the
+HashingEmbedder, so the timings include embedding and the similarity scan.
+
+    python benchmarks/semantic_cache_bench.py [--sizes 10000 100000 1000000]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from semantic_cache import HashingEmbedder, SemanticCache  # noqa: E402
+
+QUESTIONS = [
+    "how many visitors did meta.com get",
+    "total hits for hardy.net in 2022",
+    "top 5 industries by estimated employees",
+    "visitor count for lead domain google.com",
+    "average intent score per country",
+]
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_size(size: int, dim: int, lookups: int, mmap_path: str = None) -> dict:
+    rng = np.random.default_rng(0)
+    cache = SemanticCache(HashingEmbedder(dim), capacity=size, mmap_path=mmap_path)
+
+    start = time.perf_counter()
+    batch = 100000
+    for offset in range(0, size, batch):
+        count = min(batch, size - offset)
+        vectors = rng.standard_normal((count, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        questions = [f"synthetic question {offset + i}" for i in range(count)]
+        cache.insert_many(questions, 'schema', [{'message': ''}] * count, vectors=vectors)
+    insert_seconds = time.perf_counter() - start
+
+    samples = []
+    for index in range(lookups):
+        start = time.perf_counter()
+        cache.lookup(QUESTIONS[index % len(QUESTIONS)], 'schema')
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'entries': size,
+        'dim': dim,
+        'insert_rows_per_sec': size / insert_seconds,
+        'lookup_p50_ms': statistics.median(samples),
+        'lookup_p95_ms': percentile(samples, 0.95),
+        'lookup_p99_ms': percentile(samples, 0.99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--mmap', help='back the matrix with a memory-mapped file at this path')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(json.dumps(bench_size(size, args.dim, args.lookups, args.mmap)))
+
+
+if __name__ == '__main__':
+    main()
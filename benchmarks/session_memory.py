@@ -0,0 +1,91 @@
+"""
+Memory held per chat session, before and after sharing one model.
+
+before: every session owns an LLM client and an NLP2SQL model that loads
+        and parses the schema itself, like the Streamlit pages used to do
+after:  one cached client and model, every session is a ChatSession with
+        only its chat history and a reference to the shared schema
+
+Both sides answer the same questions so the histories are comparable.
+FakeChatModel stands in for ChatOpenAI; a real client also owns an HTTP
+connection pool, so the per-session saving in production is larger.
+
+    python benchmarks/session_memory.py [--sessions 200] [--turns 3] [--tables 50]
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from fake_llm import FakeChatModel  # noqa: E402
+from llm import initialize_model  # noqa: E402
+from schema_parser import load_schema  # noqa: E402
+
+QUESTIONS = [
+    "How many visitors did hardy.net get last month?",
+    "Which industries sent the most hits to meta.com?",
+    "List the top 5 cities by number of visitors",
+    "What is the average annual revenue of visiting companies?",
+]
+
+
+def make_schema(tables: int) -> str:
+    return '\n'.join(
+        f"CREATE TABLE table_{i} (\n    id SERIAL PRIMARY KEY,\n    name VARCHAR(255),\n"
+        f"    created_at DATE,\n    amount_{i} FLOAT\n);" for i in range(tables))
+
+
+def per_session_model(schema: str, turns: int):
+    load_schema.cache_clear()  # each old-style model parsed its own copy
+    model = initialize_model(FakeChatModel(latency_ms=0, latency_sigma=0), {'memory': 3})
+    model.load_schema_as_string(schema)
+    for question in QUESTIONS[:turns]:
+        model.predict(question)
+    return model
+
+
+def shared_model_session(model, schema: str, turns: int):
+    session = model.new_session()
+    session.load_schema_as_string(schema)
+    for question in QUESTIONS[:turns]:
+        session.predict(question)
+    return session
+
+
+def measure(make_session, sessions: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    kept = [make_session() for _ in range(sessions)]
+    gc.collect()
+    used = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename'))
+    tracemalloc.stop()
+    del kept
+    return used / sessions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--turns', type=int, default=3)
+    parser.add_argument('--tables', type=int, default=50)
+    args = parser.parse_args()
+
+    schema = make_schema(args.tables)
+    before = measure(lambda: per_session_model(schema, args.turns), args.sessions)
+
+    shared = initialize_model(FakeChatModel(latency_ms=0, latency_sigma=0), {'memory': 3})
+    shared.load_schema_as_string(schema)
+    after = measure(lambda: shared_model_session(shared, schema, args.turns), args.sessions)
+
+    print(f"sessions={args.sessions} turns={args.turns} tables={args.tables}")
+    print(f"before: {before / 1024:8.1f} KiB per session (own client and model)")
+    print(f"after:  {after / 1024:8.1f} KiB per session (shared model, ChatSession)")
+    print(f"saved:  {1 - after / before:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Per-stage model routing of _llm.NLP2SQL on question_suite.json: a small,
+fast model for the yes/no stages and a large one for generation, with and
+without the escalation cascade.
+
+large          every stage on the large model, as before routing
+small          every stage on the small model
+routed         relevancy, review and clarification on the small model
+routed+cascade every stage on the small model, generation escalated to the
+               large model when its output fails validation
+
+Both models are benchmarks/fake_llm.py fakes with their own latency and
+price. The small one answers the fraction --small-invalid of generations
+with prose instead of SQL. For each setup it prints latency (p50/p95),
+estimated cost per question, the share of final answers that are valid
+SQL and how often generation was escalated, then the per stage and model
+table of StageRouter.stats() for the cascade.
+
+    python benchmarks/stage_routing_bench.py [--repeat 1] [--small-invalid 0.15]
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from _llm import initialize_model  # noqa: E402
+from fake_llm import FakeChatModel  # noqa: E402
+from memory import ConversationMemory  # noqa: E402
+from sql_classifier import Verdict, classify_sql  # noqa: E402
+
+SUITE_PATH = Path(__file__).resolve().parent / 'question_suite.json'
+GATING_STAGES = ('relevancy', 'review', 'clarification')
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * fraction)))]
+
+
+def make_model(setup: str, small, large, prices: dict):
+    options = {'llm_prices': prices, 'router_stats': True}
+    if setup == 'large':
+        return initialize_model(large, options)
+    if setup == 'small':
+        return initialize_model(small, options)
+    if setup == 'routed':
+        return initialize_model(large, options, stage_llms={stage: small for stage in GATING_STAGES})
+    return initialize_model(small, dict(options, escalation_llm=large))
+
+
+def run(setup: str, suite: dict, args) -> dict:
+    small = FakeChatModel(model_name='fake-small', latency_ms=args.small_latency_ms,
+                          invalid_sql_ratio=args.small_invalid, seed=1)
+    large = FakeChatModel(model_name='fake-large', latency_ms=args.large_latency_ms, seed=2)
+    prices = {'fake-small': (0.0005, 0.0015), 'fake-large': (0.01, 0.03)}
+    model = make_model(setup, small, large, prices)
+    model.load_schema_as_string(suite['schema'])
+
+    latencies, finals, valid, escalated = [], 0, 0, 0
+    for _ in range(args.repeat):
+        for case in suite['cases']:
+            start = time.perf_counter()
+            output = model.predict(case['question'], memory=ConversationMemory(max_turns=0))
+            latencies.append(time.perf_counter() - start)
+            if output.is_final_output:
+                finals += 1
+                valid += classify_sql(output.message) is Verdict.READ_ONLY
+            escalated += 'escalation_reason' in output.metrics
+    stats = model.router.stats()
+    questions = len(latencies)
+    return {
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'cost': sum(row['cost'] for row in stats) / questions,
+        'valid': valid / finals if finals else 0.0,
+        'escalated': escalated / questions,
+        'stats': stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--small-latency-ms', type=float, default=150.0)
+    parser.add_argument('--large-latency-ms', type=float, default=600.0)
+    parser.add_argument('--small-invalid', type=float, default=0.15,
+                        help='fraction of generations the small model answers with prose')
+    args = parser.parse_args()
+
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        suite = json.load(file)
+
+    print(f"{'setup':16} {'p50':>7} {'p95':>7} {'$/question':>11} {'valid SQL':>10} {'escalated':>10}")
+    for setup in ('large', 'small', 'routed', 'routed+cascade'):
+        result = run(setup, suite, args)
+        print(f"{setup:16} {result['p50']:6.2f}s {result['p95']:6.2f}s {result['cost']:11.5f} "
+              f"{result['valid']:10.0%} {result['escalated']:10.0%}")
+
+    print("\nrouted+cascade, per stage and model:")
+    print(f"{'stage':14} {'model':12} {'calls':>6} {'mean':>7} {'tokens':>8} {'cost':>9}")
+    for row in result['stats']:
+        print(f"{row['stage']:14} {row['model']:12} {row['calls']:>6} {row['mean_seconds']:6.2f}s "
+              f"{row['prompt_tokens'] + row['completion_tokens']:>8} {row['cost']:9.5f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Cold start of the Streamlit pages: what they import and how long until
+the first render, for the working tree against a baseline revision.
+
+Every page is run headless with streamlit.testing's AppTest in a fresh
+`python -X importtime` process, so imports are cold. For each page and
+tree it reports the modules imported by the page itself, their import
+time (summed self times from -X importtime), the time to first render and
+the time of a rerun (what every widget interaction costs). AppTest's own
+polling for widget deltas is included in both, so compare the two trees
+rather than reading the numbers as browser latency.
+
+    python benchmarks/startup_bench.py [--baseline HEAD~1] [--runs 5]
+    python benchmarks/startup_bench.py --pages Dashboard.py pages/1_Chatbot.py
+
+The baseline is exported with git archive into a temporary directory.
+Needs streamlit (1.28+) and the app's requirements installed.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_PAGES = ['Dashboard.py', 'pages/1_Chatbot.py']
+
+# Runs in the child: renders the page twice and reports what it imported
+CHILD = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+before = set(sys.modules)
+app = AppTest.from_file({page!r}, default_timeout=120)
+app.secrets['OPENAI_API_KEY'] = 'sk-startup-bench'
+start = time.perf_counter()
+app.run()
+first = time.perf_counter() - start
+start = time.perf_counter()
+app.run()
+rerun = time.perf_counter() - start
+print(json.dumps({{'first_render': first, 'rerun': rerun,
+                   'modules': sorted(set(sys.modules) - before),
+                   'errors': [str(error.value) for error in app.exception]}}))
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    # "import time: self [us] | cumulative | imported package"
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def measure(tree: Path, page: str) -> dict:
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD.format(page=page)],
+                               cwd=tree, capture_output=True, text=True, check=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    import_times = parse_importtime(completed.stderr)
+    result['import_seconds'] = sum(import_times.get(name, 0) for name in result['modules']) / 1e6
+    result['module_count'] = len(result['modules'])
+    return result
+
+
+def export_revision(revision: str) -> Path:
+    directory = Path(tempfile.mkdtemp())
+    archive = subprocess.run(['git', 'archive', revision], cwd=ROOT, capture_output=True, check=True)
+    subprocess.run(['tar', '-x', '-C', str(directory)], input=archive.stdout, check=True)
+    return directory
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default='HEAD~1', help='git revision to compare with')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--pages', nargs='+', default=DEFAULT_PAGES)
+    args = parser.parse_args()
+
+    trees = [(args.baseline, export_revision(args.baseline)), ('working tree', ROOT)]
+    print(f"{'page':22} {'tree':14} {'modules':>8} {'imports':>10} {'first render':>13} {'rerun':>9}")
+    for page in args.pages:
+        for name, tree in trees:
+            runs = [measure(tree, page) for _ in range(args.runs)]
+            errors = runs[-1]['errors']
+            print(f"{page:22} {name:14} {runs[-1]['module_count']:>8} "
+                  f"{statistics.median(run['import_seconds'] for run in runs) * 1000:8.0f}ms "
+                  f"{statistics.median(run['first_render'] for run in runs) * 1000:11.0f}ms "
+                  f"{statistics.median(run['rerun'] for run in runs) * 1000:7.0f}ms"
+                  + (f"  (errors: {'; '.join(errors)})" if errors else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Compares the single-call structured pipeline of _llm.NLP2SQL with the
+multi-call one (relevancy, generation, review) on question_suite.json.
+
+For each pipeline it reports latency (p50/p95), LLM calls and estimated
+tokens per question, how often the structured answer was malformed and
+fell back to the multi-call path, and accuracy against the expected
+labels: whether the question was judged relevant and whether a final,
+read-only query came back. It also reports how often both pipelines took
+the same branch.
+
+By default both pipelines run against benchmarks/fake_llm.py. That
+measures latency, calls and tokens, but the fake doesn't understand the
+questions, so its accuracy figures mean nothing. With --live the
+questions go to OpenAI (needs OPENAI_API_KEY), which gives the accuracy
+numbers to decide between 1 and 3 calls on.
+
+    python benchmarks/structured_vs_multi.py [--live] [--repeat 3] [--output results.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from _llm import initialize_model  # noqa: E402
+from memory import ConversationMemory  # noqa: E402
+
+SUITE_PATH = Path(__file__).resolve().parent / 'question_suite.json'
+PIPELINES = ('multi', 'structured')
+
+
+def make_llm(args):
+    if args.live:
+        from langchain.chat_models import ChatOpenAI
+        return ChatOpenAI(model=args.model, openai_api_key=os.environ['OPENAI_API_KEY'], temperature=0)
+    from fake_llm import FakeChatModel
+    return FakeChatModel(latency_ms=args.latency_ms, malformed_ratio=args.malformed_ratio)
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * fraction)))]
+
+
+def run_pipeline(llm, pipeline: str, suite: dict, args) -> list:
+    model = initialize_model(llm, {'pipeline': pipeline, 'trace': True,
+                                   'review_backend': args.review_backend})
+    model.load_schema_as_string(suite['schema'])
+    runs = []
+    for _ in range(args.repeat):
+        for case in suite['cases']:
+            start = time.perf_counter()
+            output = model.predict(case['question'], memory=ConversationMemory(max_turns=0))
+            seconds = time.perf_counter() - start
+            llm_stages = [stage for stage in output.trace.stages if stage.backend == 'llm']
+            runs.append({
+                'question': case['question'],
+                'seconds': seconds,
+                'llm_calls': len(llm_stages),
+                'tokens': sum(stage.prompt_tokens + stage.completion_tokens for stage in llm_stages),
+                'fallback': 'structured_fallback' in output.metrics,
+                'branch': output.trace.branch,
+                'relevant_ok': (output.trace.branch != 'clarification') == case['relevant'],
+                'final_ok': output.is_final_output == case['final'],
+            })
+    return runs
+
+
+def summarize(runs: list) -> dict:
+    count = len(runs)
+    return {
+        'questions': count,
+        'p50_seconds': percentile([run['seconds'] for run in runs], 0.5),
+        'p95_seconds': percentile([run['seconds'] for run in runs], 0.95),
+        'llm_calls_mean': sum(run['llm_calls'] for run in runs) / count,
+        'tokens_mean': sum(run['tokens'] for run in runs) / count,
+        'fallback_rate': sum(run['fallback'] for run in runs) / count,
+        'relevance_accuracy': sum(run['relevant_ok'] for run in runs) / count,
+        'final_accuracy': sum(run['final_ok'] for run in runs) / count,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--live', action='store_true', help='use OpenAI instead of the fake LLM')
+    parser.add_argument('--model', default='gpt-3.5-turbo-16k')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--review-backend', default='llm', choices=['llm', 'local'])
+    parser.add_argument('--latency-ms', type=float, default=300.0)
+    parser.add_argument('--malformed-ratio', type=float, default=0.05,
+                        help='fraction of malformed structured answers from the fake LLM')
+    parser.add_argument('--output', help='write the summaries and per-question runs as JSON')
+    args = parser.parse_args()
+
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        suite = json.load(file)
+    llm = make_llm(args)
+
+    runs = {pipeline: run_pipeline(llm, pipeline, suite, args) for pipeline in PIPELINES}
+    summaries = {pipeline: summarize(pipeline_runs) for pipeline, pipeline_runs in runs.items()}
+    agreement = sum(multi['branch'] == structured['branch']
+                    for multi, structured in zip(runs['multi'], runs['structured'])) / len(runs['multi'])
+
+    print(f"{'':20}" + ''.join(f"{pipeline:>12}" for pipeline in PIPELINES))
+    for name in summaries['multi']:
+        print(f"{name:20}" + ''.join(f"{summaries[pipeline][name]:12.3f}" for pipeline in PIPELINES))
+    print(f"branch agreement: {agreement:.0%}")
+    if not args.live:
+        print("(fake LLM: accuracy figures are not meaningful, use --live)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'live': args.live, 'summaries': summaries,
+                       'branch_agreement': agreement, 'runs': runs}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Learned query templates (query_templates.TemplateLibrary) on a stream of
+questions that mostly differ in their literals.
+
+The traffic mixes recurring question shapes (visitors of a domain in a
+month, hits from a country, the top N lead domains, ...) filled with
+random domains, months, countries and numbers, picked with a Zipf skew,
+and the fraction --one-off of questions no other question looks like.
+The fake LLM (benchmarks/fake_llm.py) answers every question with the
+SQL written for it, so template answers can be checked against it.
+
+The stream is answered by _llm.NLP2SQL without and with
+options['query_templates']. For each it prints the mean and p50/p95
+latency and LLM calls per question, then how much traffic the templates
+served locally, the latency of those answers against the LLM path, the
+share of template answers equal to the LLM's (canonical SQL and
+literals) and why the rest fell back.
+
+    python benchmarks/template_bench.py [--questions 300] [--latency-ms 40] [--one-off 0.2]
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from _llm import initialize_model  # noqa: E402
+from fake_llm import FakeChatModel  # noqa: E402
+from memory import ConversationMemory  # noqa: E402
+from mock_data import COUNTRIES, domain_pool  # noqa: E402
+from query_templates import TemplateLibrary  # noqa: E402
+from response_cache import normalize_question  # noqa: E402
+from result_cache import canonicalize_sql  # noqa: E402
+
+SUITE_PATH = Path(__file__).resolve().parent / 'question_suite.json'
+
+# Question and SQL of every recurring shape, formatted with the same values
+SHAPES = [
+    ("How many visitors did {domain} get in {month_name} {year}?",
+     "SELECT SUM(no_of_visiting_ips) AS visitors\nFROM website_aggregates\n"
+     "WHERE customer_domain = '{domain}'\n  AND dt >= '{month_start}' AND dt < '{month_next}';"),
+    ("What is the total number of hits from {country}?",
+     "SELECT SUM(no_of_hits) AS hits\nFROM website_aggregates\nWHERE ip_country = '{country}';"),
+    ("Show the top {count} lead domains by decayed intent score",
+     "SELECT lead_domain, MAX(decayed_intent_score) AS intent_score\nFROM website_aggregates\n"
+     "GROUP BY lead_domain\nORDER BY intent_score DESC\nLIMIT {count};"),
+    ("How many companies with more than {employees} employees visited {domain}?",
+     "SELECT COUNT(DISTINCT lead_domain) AS companies\nFROM website_aggregates\n"
+     "WHERE customer_domain = '{domain}' AND estimated_num_employees > {employees};"),
+    ("What is the daily number of visitors for {domain} over the last {days} days?",
+     "SELECT dt, SUM(no_of_visiting_ips) AS visitors\nFROM website_aggregates\n"
+     "WHERE customer_domain = '{domain}' AND dt >= CURRENT_DATE - INTERVAL '{days} days'\n"
+     "GROUP BY dt\nORDER BY dt;"),
+    ("Which lead domains from {country} visited {domain} in {year}?",
+     "SELECT DISTINCT lead_domain\nFROM website_aggregates\nWHERE company_country = '{country}'\n"
+     "  AND customer_domain = '{domain}'\n  AND dt BETWEEN '{year}-01-01' AND '{year}-12-31';"),
+    ("How many users came from companies with annual revenue over {millions} million?",
+     "SELECT SUM(no_of_visiting_ips) AS visitors\nFROM website_aggregates\n"
+     "WHERE annual_revenue > {revenue};"),
+    ("Which cities had the most visitors on {date}?",
+     "SELECT city, SUM(no_of_visiting_ips) AS visitors\nFROM website_aggregates\n"
+     "WHERE dt = '{date}'\nGROUP BY city\nORDER BY visitors DESC\nLIMIT 10;"),
+]
+
+ONE_OFF_WORDS = ['trend', 'weekly', 'industry', 'churned', 'funding', 'intent', 'inbound', 'state',
+                 'growth', 'median', 'share', 'retention', 'ratio', 'cohort', 'score', 'status',
+                 'seasonal', 'compare', 'spike', 'drop', 'repeat', 'first', 'returning', 'active']
+ONE_OFF_SQL = "SELECT status, COUNT(*) AS companies\nFROM website_aggregates\nGROUP BY status;"
+
+
+class ScriptedChatModel(FakeChatModel):
+    """
+    A FakeChatModel that generates the SQL written for each question
+    """
+    answers: dict = {}
+
+    def _answer(self, messages: list, stage: str) -> str:
+        if stage == 'generation':
+            return self.answers.get(normalize_question(messages[-1].content), ONE_OFF_SQL)
+        return super()._answer(messages, stage)
+
+
+def make_traffic(count: int, one_off: float, seed: int) -> list:
+    rng = random.Random(seed)
+    domains = domain_pool(2000, np.random.default_rng(seed))
+    weights = [1 / (rank + 1) for rank in range(len(SHAPES))]
+    traffic = []
+    for _ in range(count):
+        if rng.random() < one_off:
+            words = rng.sample(ONE_OFF_WORDS, 4)
+            traffic.append((f"Show the {words[0]} {words[1]} by {words[2]} and {words[3]}", ONE_OFF_SQL))
+            continue
+        question, sql = rng.choices(SHAPES, weights)[0]
+        year, month = rng.randint(2021, 2024), rng.randint(1, 12)
+        month_start = np.datetime64(f"{year}-{month:02d}", 'M')
+        millions = rng.choice([1, 5, 10, 50, 100, 250])
+        values = {
+            'domain': str(domains[min(int(rng.paretovariate(1.0)) - 1, len(domains) - 1)]),
+            'month_name': month_start.astype(object).strftime('%B'), 'year': year,
+            'month_start': str(month_start.astype('datetime64[D]')),
+            'month_next': str((month_start + 1).astype('datetime64[D]')),
+            'country': rng.choice(COUNTRIES[:12]), 'count': rng.choice([3, 5, 10, 20, 25]),
+            'employees': rng.choice([50, 200, 500, 1000, 5000]), 'days': rng.choice([7, 14, 30, 90]),
+            'millions': millions, 'revenue': millions * 1000000,
+            'date': str(np.datetime64('2023-01-01') + rng.randint(0, 364)),
+        }
+        traffic.append((question.format(**values), sql.format(**values)))
+    return traffic
+
+
+def same_sql(first: str, second: str) -> bool:
+    first, second = canonicalize_sql(first), canonicalize_sql(second)
+    return first is not None and second is not None and first[:2] == second[:2]
+
+
+def run(traffic: list, schema: str, args, templates: TemplateLibrary = None) -> dict:
+    llm = ScriptedChatModel(latency_ms=args.latency_ms, latency_sigma=0.2, relevant_ratio=1.0,
+                            answers={normalize_question(question): sql for question, sql in traffic})
+    options = {'review_backend': 'local'}
+    if templates is not None:
+        options['query_templates'] = templates
+    model = initialize_model(llm, options)
+    model.load_schema_as_string(schema)
+
+    results = []
+    for question, expected in traffic:
+        start = time.perf_counter()
+        output = model.predict(question, memory=ConversationMemory(max_turns=0))
+        results.append({'seconds': time.perf_counter() - start,
+                        'served': output.metrics.get('cache') == 'template',
+                        'correct': same_sql(output.message, expected)})
+    return {'results': results, 'calls': len(llm.reset())}
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * fraction)))]
+
+
+def describe(name: str, run_result: dict) -> None:
+    seconds = [result['seconds'] for result in run_result['results']]
+    print(f"{name:16} {statistics.mean(seconds) * 1000:8.1f}ms {percentile(seconds, 0.5) * 1000:8.1f}ms "
+          f"{percentile(seconds, 0.95) * 1000:8.1f}ms {run_result['calls'] / len(seconds):10.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--questions', type=int, default=300)
+    parser.add_argument('--latency-ms', type=float, default=40.0)
+    parser.add_argument('--one-off', type=float, default=0.2, help='fraction of questions of no recurring shape')
+    parser.add_argument('--min-support', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        schema = json.load(file)['schema']
+    traffic = make_traffic(args.questions, args.one_off, args.seed)
+
+    print(f"{'setup':16} {'mean':>10} {'p50':>10} {'p95':>10} {'LLM calls':>10}")
+    baseline = run(traffic, schema, args)
+    describe('llm only', baseline)
+    templates = TemplateLibrary(min_support=args.min_support)
+    with_templates = run(traffic, schema, args, templates)
+    describe('with templates', with_templates)
+
+    results = with_templates['results']
+    served = [result for result in results if result['served']]
+    other = [result['seconds'] for result in results if not result['served']]
+    stats = templates.stats()
+    print(f"\nserved locally: {len(served)}/{len(results)} ({len(served) / len(results):.0%}), "
+          f"{stats['shapes']} shapes learned")
+    if served:
+        print(f"template answers: p50 {percentile([r['seconds'] for r in served], 0.5) * 1000:.2f}ms, "
+              f"equal to the LLM's {sum(r['correct'] for r in served) / len(served):.0%}")
+    if other:
+        print(f"LLM answers:      p50 {percentile(other, 0.5) * 1000:.2f}ms")
+    print(f"fallbacks: {stats['fallbacks']}")
+
+
+if __name__ == '__main__':
+    main()
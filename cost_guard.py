@@ -0,0 +1,115 @@
+import time
+from dataclasses import dataclass
+from enum import Enum
+
+from executor import ExecutionError
+from sql_classifier import strip_code_fences
+
+# Enumerators
+CostAction = Enum('CostAction', [
+    'ALLOW',
+    'REJECT',   # Over the limits, not to be run
+    'LIMIT',    # Over the row limit, the message was wrapped with a LIMIT
+    'CONFIRM',  # Over the limits, runs only once confirmed
+])
+
+ON_EXCEED_ACTIONS = {'reject': CostAction.REJECT, 'limit': CostAction.LIMIT, 'confirm': CostAction.CONFIRM}
+
+
+@dataclass
+class CostVerdict:
+    """
+    What the CostGuard decided for a ModelOutput. sql is the query as
+    generated, estimated_cost and estimated_rows the planner's estimates
+    for it and reason why it went over the limits.
+    """
+    action: CostAction
+    sql: str
+    estimated_cost: float = 0.0
+    estimated_rows: float = 0.0
+    reason: str = ''
+    confirmed: bool = False
+
+    @property
+    def needs_confirmation(self) -> bool:
+        return self.action == CostAction.CONFIRM and not self.confirmed
+
+    def confirm(self) -> None:
+        self.confirmed = True
+
+
+def wrap_with_limit(sql: str, limit: int, offset: int = 0) -> str:
+    wrapped = f"SELECT * FROM (\n{sql.rstrip().rstrip(';')}\n) AS limited LIMIT {int(limit)}"
+    return f"{wrapped} OFFSET {int(offset)}" if offset else wrapped
+
+
+class CostGuard:
+    """
+    Runs EXPLAIN on final outputs before anyone executes them and compares
+    the estimated cost and rows with max_cost and max_rows. A query over
+    them is rejected, wrapped with LIMIT limit (only when the rows are the
+    problem) or marked to need confirmation, depending on on_exceed.
+    Pass it as options['cost_guard'] to either model; point its executor
+    at a replica if EXPLAIN shouldn't touch the primary either.
+    """
+
+    def __init__(self, executor, max_cost: float = 1e6, max_rows: float = 1e5,
+                 on_exceed: str = 'reject', limit: int = 1000, timeout: float = 5.0) -> None:
+        if on_exceed not in ON_EXCEED_ACTIONS:
+            raise ValueError(f"on_exceed must be one of {', '.join(ON_EXCEED_ACTIONS)}")
+        self.executor = executor
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.on_exceed = on_exceed
+        self.limit = limit
+        self.timeout = timeout
+
+    def check(self, sql: str) -> CostVerdict:
+        sql = strip_code_fences(sql)
+        try:
+            cost, rows = self.executor.explain(sql, self.timeout)
+        except ExecutionError as error:
+            return CostVerdict(CostAction.REJECT, sql, reason=f"the query could not be planned: {error}")
+
+        reasons = []
+        if cost > self.max_cost:
+            reasons.append(f"its estimated cost {cost:,.0f} is over the limit of {self.max_cost:,.0f}")
+        if rows > self.max_rows:
+            reasons.append(f"it is estimated to return {rows:,.0f} rows, over the limit of {self.max_rows:,.0f}")
+        verdict = CostVerdict(CostAction.ALLOW, sql, cost, rows, ' and '.join(reasons))
+        if not reasons:
+            return verdict
+
+        verdict.action = ON_EXCEED_ACTIONS[self.on_exceed]
+        if verdict.action == CostAction.LIMIT:
+            # A LIMIT caps the rows, not necessarily the work (sorts, aggregates)
+            try:
+                limited_cost, _ = self.executor.explain(wrap_with_limit(sql, self.limit), self.timeout)
+            except ExecutionError:
+                limited_cost = cost
+            if limited_cost > self.max_cost:
+                verdict.action = CostAction.REJECT
+        return verdict
+
+    def apply(self, output, trace=None):
+        """
+        Checks a final output and attaches the verdict as
+        output.cost_verdict. A rejected output stops being final and its
+        message explains why, a limited one gets the wrapped SQL.
+        """
+        if not output.is_final_output:
+            return output
+        start = time.perf_counter()
+        verdict = self.check(output.message)
+        seconds = time.perf_counter() - start
+        output.metrics['cost_guard_seconds'] = seconds
+        if trace is not None:
+            trace.add_stage('cost_guard', seconds, backend='explain')
+
+        output.cost_verdict = verdict
+        if verdict.action == CostAction.REJECT:
+            output.is_final_output = False
+            output.message = f"This query was not run because {verdict.reason}."
+        elif verdict.action == CostAction.LIMIT:
+            output.message = wrap_with_limit(verdict.sql, self.limit)
+        return output
@@ -0,0 +1,764 @@
+import csv
+import datetime
+import decimal
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from result_cache import make_result_key
+from sql_classifier import SQLTokenizeError, Verdict, classify_sql, split_statements, strip_code_fences, tokenize
+
+
+class ExecutionError(Exception):
+    pass
+
+
+class QueryTimeout(ExecutionError):
+    pass
+
+
+class QueryCancelled(ExecutionError):
+    pass
+
+
+class PoolTimeout(ExecutionError):
+    pass
+
+
+class ConfirmationRequired(ExecutionError):
+    pass
+
+
+# PostgreSQL type OIDs of the common column types
+_POSTGRES_TYPES = {
+    16: 'boolean', 20: 'integer', 21: 'integer', 23: 'integer', 26: 'integer',
+    700: 'float', 701: 'float', 1700: 'numeric',
+    18: 'text', 25: 'text', 1042: 'text', 1043: 'text', 2950: 'text',
+    1082: 'date', 1083: 'time', 1114: 'timestamp', 1184: 'timestamp',
+    1186: 'interval', 17: 'bytes', 114: 'json', 3802: 'json',
+}
+
+_PYTHON_TYPES = [
+    (bool, 'boolean'), (int, 'integer'), (float, 'float'), (decimal.Decimal, 'numeric'),
+    (str, 'text'), (datetime.datetime, 'timestamp'), (datetime.date, 'date'),
+    (datetime.time, 'time'), (datetime.timedelta, 'interval'), (bytes, 'bytes'),
+]
+
+
+def _python_type(values: list) -> str:
+    value = next((value for value in values if value is not None), None)
+    for python_type, name in _PYTHON_TYPES:
+        if isinstance(value, python_type):
+            return name
+    return 'unknown'
+
+
+@dataclass
+class QueryResult:
+    """
+    Columnar query result: data holds one list of values per column, types
+    the column types ('integer', 'float', 'numeric', 'text', 'boolean',
+    'date', 'timestamp', ...). truncated is set when max_rows cut it short,
+    cached when it came from the executor's ResultCache.
+    """
+    columns: list
+    types: list
+    data: list
+    row_count: int = 0
+    truncated: bool = False
+    seconds: float = 0.0
+    cached: bool = False
+
+    def column(self, name: str) -> list:
+        return self.data[self.columns.index(name)]
+
+    def rows(self):
+        return zip(*self.data)
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.columns, self.data))
+
+
+def _columnar(columns: list, types: list, rows: list) -> QueryResult:
+    data = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+    types = [column_type or _python_type(values) for column_type, values in zip(types, data)]
+    return QueryResult(columns, types, data, len(rows))
+
+
+class SQLiteDialect:
+    """
+    SQLite stand-in for local runs and benchmarks. Connections are opened
+    with query_only, the statement timeout is enforced by a progress
+    handler and cancellation uses sqlite3's interrupt().
+    """
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._version_connection = None
+        self._version_lock = threading.Lock()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    @contextmanager
+    def _deadline(self, connection, timeout: float):
+        deadline = time.monotonic() + timeout
+        connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            yield
+        except sqlite3.OperationalError as error:
+            if 'interrupted' in str(error):
+                raise QueryTimeout(f"statement exceeded {timeout}s") from error
+            raise
+        finally:
+            connection.set_progress_handler(None, 0)
+
+    def run(self, connection, sql: str, timeout: float, max_rows: Optional[int]):
+        with self._deadline(connection, timeout):
+            cursor = connection.execute(sql)
+            rows = cursor.fetchall() if max_rows is None else cursor.fetchmany(max_rows + 1)
+            columns, types = self.describe(cursor)
+            cursor.close()
+        return columns, types, rows
+
+    def open_cursor(self, connection, sql: str, timeout: float):
+        # SQLite steps through the result as rows are fetched
+        with self._deadline(connection, timeout):
+            return connection.execute(sql)
+
+    def fetch_page(self, connection, cursor, size: int, timeout: float) -> list:
+        with self._deadline(connection, timeout):
+            return cursor.fetchmany(size)
+
+    def describe(self, cursor):
+        columns = [column[0] for column in cursor.description or ()]
+        return columns, [None] * len(columns)
+
+    def close_cursor(self, connection, cursor) -> None:
+        cursor.close()
+        connection.rollback()
+
+    def explain(self, connection, sql: str, timeout: float):
+        # SQLite has no cost model to ask, so the estimate is the number of
+        # rows its plan visits: the whole table for a SCAN, a tenth of it
+        # for an index SEARCH (the planner's own default guess)
+        cost, rows = 0.0, 0.0
+        with self._deadline(connection, timeout):
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            for *_, detail in plan:
+                match = re.match(r'(SCAN|SEARCH) (?:TABLE )?(\w+)', detail)
+                if match is None:
+                    continue
+                try:
+                    table_rows = connection.execute(f'SELECT max(rowid) FROM "{match.group(2)}"').fetchone()[0] or 0
+                except sqlite3.OperationalError:
+                    continue  # a subquery or CTE, its tables have their own steps
+                step_rows = float(table_rows) if match.group(1) == 'SCAN' else table_rows / 10
+                cost += step_rows
+                rows = max(rows, step_rows)
+        connection.rollback()
+        return cost, rows
+
+    def table_versions(self, connection, tables: list) -> dict:
+        # data_version only moves for commits made by other connections and
+        # is per connection, so it is always read on the same one. SQLite
+        # has no per table counter, a write to any table changes them all.
+        with self._version_lock:
+            if self._version_connection is None:
+                self._version_connection = sqlite3.connect(self.path, check_same_thread=False)
+            version = self._version_connection.execute('PRAGMA data_version').fetchone()[0]
+        return {table: version for table in tables}
+
+    def cancel(self, connection) -> None:
+        connection.interrupt()
+
+    def reset(self, connection) -> None:
+        connection.rollback()
+
+
+def _single_statement(sql: str) -> str:
+    """
+    The SQL, if it is a single statement. A READ ONLY transaction only
+    covers the statements run in it, one after a COMMIT would run outside.
+    """
+    try:
+        statements = split_statements(tokenize(sql))
+    except SQLTokenizeError as error:
+        raise ExecutionError(f"the query could not be read: {error}") from error
+    if len(statements) != 1:
+        raise ExecutionError(f"expected a single SQL statement, got {len(statements)}")
+    return sql
+
+
+class PostgresDialect:
+    """
+    PostgreSQL through psycopg2 (imported on first connect). Every query
+    runs in a READ ONLY transaction with a SET LOCAL statement_timeout and
+    is rolled back afterwards; cancellation uses connection.cancel().
+    Connections are also opened with default_transaction_read_only and
+    statement_timeout (seconds) as server options, and input of more than
+    one statement is refused. Takes the psycopg2.connect arguments, e.g.
+    dsn or dbname/user/host.
+    """
+    name = 'postgresql'
+
+    def __init__(self, statement_timeout: float = 30.0, **connect_params) -> None:
+        self.statement_timeout = statement_timeout
+        self.connect_params = connect_params
+        self.errors = ()
+
+    def connect(self):
+        import psycopg2
+        self.errors = (psycopg2.Error,)
+        params = dict(self.connect_params)
+        options = [params.get('options', ''), '-c default_transaction_read_only=on',
+                   f"-c statement_timeout={max(1, int(self.statement_timeout * 1000))}"]
+        params['options'] = ' '.join(option for option in options if option)
+        connection = psycopg2.connect(**params)
+        connection.set_session(readonly=True, autocommit=False)
+        return connection
+
+    def run(self, connection, sql: str, timeout: float, max_rows: Optional[int]):
+        import psycopg2.errors
+        _single_statement(sql)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(timeout * 1000)),))
+                cursor.execute(sql)
+                if cursor.description is None:
+                    return [], [], []
+                rows = cursor.fetchall() if max_rows is None else cursor.fetchmany(max_rows + 1)
+                columns = [column.name for column in cursor.description]
+                types = [_POSTGRES_TYPES.get(column.type_code) for column in cursor.description]
+        except psycopg2.errors.QueryCanceled as error:
+            raise QueryTimeout(f"statement exceeded {timeout}s") from error
+        finally:
+            connection.rollback()
+        return columns, types, rows
+
+    def open_cursor(self, connection, sql: str, timeout: float):
+        # A named cursor lives on the server, rows come over page by page
+        _single_statement(sql)
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(timeout * 1000)),))
+        cursor = connection.cursor(name=f"nlp2sql_{uuid.uuid4().hex}")
+        cursor.execute(sql)
+        return cursor
+
+    def fetch_page(self, connection, cursor, size: int, timeout: float) -> list:
+        import psycopg2.errors
+        try:
+            return cursor.fetchmany(size)
+        except psycopg2.errors.QueryCanceled as error:
+            raise QueryTimeout(f"statement exceeded {timeout}s") from error
+
+    def describe(self, cursor):
+        # Named cursors only have a description after the first fetch
+        description = cursor.description or ()
+        return ([column.name for column in description],
+                [_POSTGRES_TYPES.get(column.type_code) for column in description])
+
+    def close_cursor(self, connection, cursor) -> None:
+        try:
+            cursor.close()
+        finally:
+            connection.rollback()
+
+    def explain(self, connection, sql: str, timeout: float):
+        import psycopg2.errors
+        _single_statement(sql)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(timeout * 1000)),))
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+                plan = cursor.fetchone()[0][0]['Plan']
+        except psycopg2.errors.QueryCanceled as error:
+            raise QueryTimeout(f"EXPLAIN exceeded {timeout}s") from error
+        finally:
+            connection.rollback()
+        return float(plan['Total Cost']), float(plan['Plan Rows'])
+
+    def table_versions(self, connection, tables: list) -> dict:
+        # The statistics collector's change counters, they lag commits by
+        # up to a second (PGSTAT_STAT_INTERVAL) and don't count TRUNCATE,
+        # hence the live row count next to them
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT relname, sum(n_tup_ins + n_tup_upd + n_tup_del), sum(n_live_tup) "
+                    "FROM pg_stat_user_tables WHERE relname = ANY(%s) GROUP BY relname", (list(tables),))
+                versions = {name: (int(changes), int(live)) for name, changes, live in cursor.fetchall()}
+        finally:
+            connection.rollback()
+        return {table: versions.get(table) for table in tables}
+
+    def cancel(self, connection) -> None:
+        connection.cancel()
+
+    def reset(self, connection) -> None:
+        connection.rollback()
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe connection pool. Connections are opened lazily up
+    to max_size and reused most-recently-returned first; callers wait up
+    to timeout seconds for a free one.
+    """
+
+    def __init__(self, connect, max_size: int = 10, timeout: float = 30.0) -> None:
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ExecutionError("the connection pool is closed")
+                if self._idle:
+                    self.reused += 1
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"no connection free after {self.timeout}s")
+                self._condition.wait(remaining)
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        self.created += 1
+        return connection
+
+    def release(self, connection, discard: bool = False) -> None:
+        with self._condition:
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+        if discard or self._closed:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'size': self._size, 'idle': len(self._idle), 'max_size': self.max_size,
+                    'created': self.created, 'reused': self.reused}
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+@dataclass
+class QueryHandle:
+    """
+    A query submitted with QueryExecutor.submit: result() waits for it,
+    cancel() stops it, also while it is running on the database
+    """
+    sql: str
+    _future: object = None
+    _connection: object = None
+    _cancelled: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _dialect: object = None
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled = True
+            if self._connection is not None:
+                self._dialect.cancel(self._connection)
+        if self._future is not None:
+            self._future.cancel()
+
+    def result(self, timeout: Optional[float] = None) -> QueryResult:
+        return self._future.result(timeout)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+
+# Arrow types for the QueryResult column types, decimals are written as floats
+_ARROW_TYPES = {
+    'boolean': 'bool_', 'integer': 'int64', 'float': 'float64', 'numeric': 'float64',
+    'text': 'string', 'date': 'date32', 'bytes': 'binary',
+}
+
+
+def _arrow_array(values: list, type_name: str):
+    import pyarrow
+    if type_name == 'timestamp':
+        return pyarrow.array(values, type=pyarrow.timestamp('us'))
+    if type_name in _ARROW_TYPES:
+        if type_name == 'numeric':
+            values = [None if value is None else float(value) for value in values]
+        return pyarrow.array(values, type=getattr(pyarrow, _ARROW_TYPES[type_name])())
+    return pyarrow.array([None if value is None else str(value) for value in values], type=pyarrow.string())
+
+
+class PagedResult:
+    """
+    Lazily fetched result from QueryExecutor.stream. Rows are pulled from
+    the database a page at a time, so memory stays flat however large the
+    result is. The pooled connection is held until the result is exhausted,
+    reaches max_rows (truncated is then set) or is closed.
+    """
+
+    def __init__(self, executor, handle, connection, cursor, page_size: int,
+                 max_rows: Optional[int], timeout: float) -> None:
+        self._executor = executor
+        self._handle = handle
+        self._connection = connection
+        self._cursor = cursor
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.rows_fetched = 0
+        self.exhausted = False
+        self.truncated = False
+        self.columns, self.types = None, None
+        # The first page is fetched up front so the columns are known
+        self._pending = self._fetch()
+        self.types = _columnar(self.columns, self.types, self._pending).types
+
+    def _fetch(self) -> list:
+        if self.exhausted:
+            return []
+        size = self.page_size
+        if self.max_rows is not None:
+            size = min(size, self.max_rows - self.rows_fetched)
+        try:
+            rows = self._executor.dialect.fetch_page(self._connection, self._cursor, size, self.timeout) \
+                if size > 0 else []
+            if self.columns is None:
+                self.columns, self.types = self._executor.dialect.describe(self._cursor)
+            if self.max_rows is not None and self.rows_fetched + len(rows) >= self.max_rows:
+                # One more row tells whether the cap cut the result short
+                extra = self._executor.dialect.fetch_page(self._connection, self._cursor, 1, self.timeout)
+                self.truncated = bool(extra)
+                self.close()
+        except QueryTimeout as error:
+            self.close(discard=False)
+            if self._handle._cancelled:
+                raise QueryCancelled("the query was cancelled") from error
+            raise
+        except self._executor.dialect.errors as error:
+            self.close(discard=False)
+            if self._handle._cancelled:
+                raise QueryCancelled("the query was cancelled") from error
+            raise ExecutionError(str(error).strip()) from error
+        self.rows_fetched += len(rows)
+        if len(rows) < size:
+            self.close()
+        return rows
+
+    def next_page(self) -> Optional[QueryResult]:
+        """
+        The next page of rows as a QueryResult, None when there are no more
+        """
+        rows, self._pending = self._pending, None
+        if rows is None:
+            rows = self._fetch()
+        if not rows:
+            return None
+        # Columns that were all NULL so far get their type from this page
+        page = _columnar(self.columns, [None if column_type == 'unknown' else column_type
+                                        for column_type in self.types], rows)
+        self.types = page.types
+        return page
+
+    def __iter__(self):
+        while True:
+            page = self.next_page()
+            if page is None:
+                return
+            yield page
+
+    def rows(self):
+        for page in self:
+            yield from page.rows()
+
+    def to_csv(self, path: str) -> int:
+        """
+        Streams the remaining rows into a CSV file, returns how many
+        """
+        written = 0
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(self.columns)
+            for page in self:
+                writer.writerows(page.rows())
+                written += page.row_count
+        return written
+
+    def to_parquet(self, path: str) -> int:
+        """
+        Streams the remaining rows into a Parquet file, one row group per
+        page. Needs pyarrow.
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        written, writer = 0, None
+        try:
+            for page in self:
+                table = pyarrow.table({column: _arrow_array(values, column_type) for column, values, column_type
+                                       in zip(page.columns, page.data, self.types)})
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                written += page.row_count
+            if writer is None:
+                pyarrow.parquet.write_table(pyarrow.table(
+                    {column: _arrow_array([], column_type) for column, column_type in zip(self.columns, self.types)}),
+                    path)
+        finally:
+            if writer is not None:
+                writer.close()
+        return written
+
+    def cancel(self) -> None:
+        self._handle.cancel()
+
+    def close(self, discard: bool = False) -> None:
+        if self._connection is None:
+            return
+        self.exhausted = True
+        connection, self._connection = self._connection, None
+        with self._handle._lock:
+            self._handle._connection = None
+        try:
+            self._executor.dialect.close_cursor(connection, self._cursor)
+        except Exception:
+            discard = True
+        self._executor.pool.release(connection, discard=discard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+def query_sql(query) -> str:
+    """
+    The SQL to run for a ModelOutput (either model's) or a plain string.
+    Only final outputs, i.e. reviewed read-only SQL, are accepted, and
+    plain strings only when the local classifier reads them as read-only.
+    """
+    if not isinstance(query, str):
+        if not getattr(query, 'is_final_output', False):
+            raise ExecutionError("only final outputs can be executed, this answer was not approved")
+        verdict = getattr(query, 'cost_verdict', None)
+        if verdict is not None and verdict.needs_confirmation:
+            raise ConfirmationRequired(f"{verdict.reason}, confirm it to run it anyway")
+    sql = strip_code_fences(query if isinstance(query, str) else query.message)
+    # An LLM review can approve what the classifier knows modifies data
+    verdict = classify_sql(sql)
+    if verdict is Verdict.MODIFIES:
+        raise ExecutionError("the query modifies the database and can't be executed")
+    if verdict is Verdict.UNKNOWN and isinstance(query, str):
+        raise ExecutionError("only read-only queries can be executed, this one was not recognised as one")
+    return sql
+
+
+class QueryExecutor:
+    """
+    Runs generated SQL on a pooled connection with a statement timeout, in
+    a read-only transaction, and returns a columnar QueryResult. max_rows
+    caps how many rows are fetched (None for no cap). With a ResultCache,
+    execute and submit reuse the results of queries already run.
+    """
+
+    def __init__(self, dialect, max_connections: int = 10, statement_timeout: float = 30.0,
+                 max_rows: Optional[int] = 10000, pool_timeout: float = 30.0, cache=None) -> None:
+        self.dialect = dialect
+        self.cache = cache
+        self.statement_timeout = statement_timeout
+        self.max_rows = max_rows
+        self.pool = ConnectionPool(dialect.connect, max_connections, pool_timeout)
+        self._workers = ThreadPoolExecutor(max_workers=max_connections,
+                                           thread_name_prefix='nlp2sql-query')
+
+    def execute(self, query, timeout: Optional[float] = None, max_rows: Optional[int] = -1) -> QueryResult:
+        return self._cached_run(QueryHandle(query_sql(query), _dialect=self.dialect), timeout, max_rows)
+
+    def submit(self, query, timeout: Optional[float] = None, max_rows: Optional[int] = -1) -> QueryHandle:
+        handle = QueryHandle(query_sql(query), _dialect=self.dialect)
+        handle._future = self._workers.submit(self._cached_run, handle, timeout, max_rows)
+        return handle
+
+    def stream(self, query, page_size: int = 1000, max_rows: Optional[int] = -1,
+               timeout: Optional[float] = None) -> PagedResult:
+        """
+        Runs the query on a server-side cursor and returns a PagedResult
+        that fetches page_size rows at a time, up to max_rows in total
+        (the executor's max_rows by default, None for no cap)
+        """
+        handle = QueryHandle(query_sql(query), _dialect=self.dialect)
+        timeout = self.statement_timeout if timeout is None else timeout
+        max_rows = self.max_rows if max_rows == -1 else max_rows
+        connection = self.pool.acquire()
+        try:
+            with handle._lock:
+                handle._connection = connection
+            cursor = self.dialect.open_cursor(connection, handle.sql, timeout)
+        except BaseException as error:
+            with handle._lock:
+                handle._connection = None
+            self.pool.release(connection, discard=not (isinstance(error, Exception) and self._reset(connection)))
+            if isinstance(error, self.dialect.errors):
+                raise ExecutionError(str(error).strip()) from error
+            raise
+        return PagedResult(self, handle, connection, cursor, page_size, max_rows, timeout)
+
+    def explain(self, query, timeout: Optional[float] = None):
+        """
+        The planner's estimated (total cost, rows) for the query, without
+        running it
+        """
+        sql = query_sql(query)
+        timeout = self.statement_timeout if timeout is None else timeout
+        with self.pool.connection() as connection:
+            try:
+                return self.dialect.explain(connection, sql, timeout)
+            except self.dialect.errors as error:
+                raise ExecutionError(str(error).strip()) from error
+
+    def _cached_run(self, handle: QueryHandle, timeout: Optional[float], max_rows: Optional[int]) -> QueryResult:
+        if self.cache is None:
+            return self._run(handle, timeout, max_rows)
+        max_rows = self.max_rows if max_rows == -1 else max_rows
+        key, tables = make_result_key(handle.sql, max_rows)
+        if key is None:
+            return self._run(handle, timeout, max_rows)
+        # Versions are read before the query, a write during it then
+        # invalidates the result at the next poll
+        self.poll_table_versions(tables)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._run(handle, timeout, max_rows)
+            self.cache.set(key, tables, result)
+        return result
+
+    def poll_table_versions(self, tables: frozenset = frozenset()) -> list:
+        """
+        Reads the versions of the tables the cache wants to check and
+        invalidates those that changed, returns them
+        """
+        wanted = self.cache.tables_to_poll(tables)
+        if not wanted:
+            return []
+        with self.pool.connection() as connection:
+            try:
+                versions = self.dialect.table_versions(connection, wanted)
+            except self.dialect.errors as error:
+                raise ExecutionError(str(error).strip()) from error
+        return self.cache.update_versions(versions)
+
+    def _run(self, handle: QueryHandle, timeout: Optional[float], max_rows: Optional[int]) -> QueryResult:
+        timeout = self.statement_timeout if timeout is None else timeout
+        max_rows = self.max_rows if max_rows == -1 else max_rows
+        start = time.perf_counter()
+        connection = self.pool.acquire()
+        discard = False
+        try:
+            with handle._lock:
+                if handle._cancelled:
+                    raise QueryCancelled("the query was cancelled")
+                handle._connection = connection
+            try:
+                columns, types, rows = self.dialect.run(connection, handle.sql, timeout, max_rows)
+            except QueryTimeout as error:
+                if handle._cancelled:
+                    raise QueryCancelled("the query was cancelled") from error
+                raise
+            except self.dialect.errors as error:
+                if handle._cancelled:
+                    raise QueryCancelled("the query was cancelled") from error
+                raise ExecutionError(str(error).strip()) from error
+        except ExecutionError:
+            discard = not self._reset(connection)
+            raise
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            with handle._lock:
+                handle._connection = None
+            self.pool.release(connection, discard=discard)
+
+        truncated = max_rows is not None and len(rows) > max_rows
+        result = _columnar(columns, types, rows[:max_rows] if truncated else rows)
+        result.truncated = truncated
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def _reset(self, connection) -> bool:
+        try:
+            self.dialect.reset(connection)
+            return True
+        except Exception:
+            return False
+
+    def close(self) -> None:
+        self._workers.shutdown(wait=False, cancel_futures=True)
+        self.pool.close()
+
+
+def explain_validator(executor: QueryExecutor, timeout: float = 5.0):
+    """
+    A validator for options['escalation_validator'] that fails generated
+    SQL the database can't plan, e.g. because of a made up column
+    """
+    def validate(sql: str) -> str:
+        try:
+            executor.explain(strip_code_fences(sql), timeout)
+        except ExecutionError as error:
+            return f"the query could not be planned: {error}"
+        return ''
+    return validate
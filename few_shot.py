@@ -0,0 +1,208 @@
+import hashlib
+import math
+import re
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from query_templates import extract_slots, question_shape
+from schema_parser import load_schema
+from semantic_cache import STOP_WORDS, SYNONYMS
+from sql_classifier import strip_code_fences
+from tokens import estimate_tokens
+
+Example = namedtuple('Example', ['question', 'sql'])
+
+
+def _question_key(question: str) -> str:
+    return question.strip().rstrip('.;:?!').lower()
+
+_TERM_PATTERN = re.compile(r"\{[a-z]+\}|[a-z0-9_]+")
+
+
+def example_terms(question: str) -> list:
+    """
+    The terms a question is indexed and searched by: its words without
+    stop words, with synonyms folded, and its literals as their slot kind
+    ('{domain}', '{month}', ...), so examples are picked for the shape of
+    the question rather than for sharing a domain
+    """
+    shape = question_shape(question, extract_slots(question))
+    return [SYNONYMS.get(term, term) for term in _TERM_PATTERN.findall(shape) if term not in STOP_WORDS]
+
+
+def examples_from_suite(suite: dict) -> list:
+    """
+    The (question, sql) Examples of a test suite (see suite_runner.load_suite):
+    every input and its variants with the case's sql_output
+    """
+    examples = []
+    for case in suite.get('cases', []):
+        sql = case.get('sql_output', '')
+        if not sql:
+            continue
+        question = case.get('input', case.get('question', ''))
+        examples += [Example(text, sql) for text in [question] + list(case.get('variants', []))]
+    return examples
+
+
+class ExampleStore:
+    """
+    Question/SQL examples for few-shot generation prompts, in an in-memory
+    BM25 index, scoped to the schema they were written against. Postings
+    are NumPy arrays per term, examples added after a term's arrays were
+    built wait in lists that are merged when the term is next searched,
+    so accepted answers can be added while serving.
+    search() scores every example sharing a term with the question and
+    returns the best k whose rendered examples fit in token_budget. When
+    the question itself is stored, examples with its SQL are left out,
+    the case's variants included, so a suite is not answered from its
+    own expected SQL.
+    """
+
+    def __init__(self, k: int = 3, token_budget: int = 600, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k = k
+        self.token_budget = token_budget
+        self.k1 = k1
+        self.b = b
+        self._examples = []
+        self._seen = set()
+        self._postings = {}
+        self._pending = {}
+        self._lengths = np.zeros(1024, dtype=np.float32)
+        self._schema_ids = np.zeros(1024, dtype=np.int32)
+        self._schemas = {}
+        # The SQL stored for each (schema id, question), to keep a
+        # question's answers out of its own examples
+        self._answers = {}
+        self._total_length = 0
+        # Per term BM25 weights for the average length of _weighted_count
+        # examples, refreshed when the store has grown by more than 1%
+        self._weights = {}
+        self._average_length = 1.0
+        self._weighted_count = 0
+        self._lock = threading.Lock()
+        self.searches = 0
+
+    def add(self, question: str, sql: str, schema_hash: str) -> bool:
+        """
+        Adds an example, returns False for one that is already stored
+        """
+        return self.add_many([(question, sql)], schema_hash) == 1
+
+    def add_many(self, examples: list, schema_hash: str) -> int:
+        """
+        Adds (question, sql) pairs of one schema, returns how many were new
+        """
+        prepared = []
+        for question, sql in examples:
+            sql = strip_code_fences(sql)
+            digest = hashlib.sha1(f"{schema_hash}\0{question.strip().lower()}\0{sql}".encode('utf-8')).digest()
+            prepared.append((Example(question.strip(), sql), digest, example_terms(question)))
+
+        added = 0
+        with self._lock:
+            schema_id = self._schemas.setdefault(schema_hash, len(self._schemas))
+            for example, digest, terms in prepared:
+                if digest in self._seen or not terms:
+                    continue
+                self._seen.add(digest)
+                self._answers.setdefault((schema_id, _question_key(example.question)), set()).add(example.sql)
+                index = len(self._examples)
+                self._examples.append(example)
+                if index == len(self._lengths):
+                    self._lengths = np.concatenate([self._lengths, np.zeros_like(self._lengths)])
+                    self._schema_ids = np.concatenate([self._schema_ids, np.zeros_like(self._schema_ids)])
+                self._lengths[index] = len(terms)
+                self._schema_ids[index] = schema_id
+                self._total_length += len(terms)
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                for term, count in counts.items():
+                    self._pending.setdefault(term, ([], []))
+                    self._pending[term][0].append(index)
+                    self._pending[term][1].append(count)
+                added += 1
+        return added
+
+    def add_suite(self, suite: dict) -> int:
+        return self.add_many(examples_from_suite(suite), load_schema(suite.get('schema', '')).hash)
+
+    def _term_weights(self, term: str):
+        pending = self._pending.pop(term, None)
+        if pending is not None:
+            ids, counts = np.array(pending[0], dtype=np.int32), np.array(pending[1], dtype=np.float32)
+            postings = self._postings.get(term)
+            if postings is not None:
+                ids, counts = np.concatenate([postings[0], ids]), np.concatenate([postings[1], counts])
+            self._postings[term] = (ids, counts)
+            self._weights.pop(term, None)
+        weights = self._weights.get(term)
+        if weights is None and term in self._postings:
+            ids, counts = self._postings[term]
+            normalization = self.k1 * (1 - self.b + self.b * self._lengths[ids] / self._average_length)
+            weights = self._weights[term] = (ids, counts * (self.k1 + 1) / (counts + normalization))
+        return weights
+
+    def search(self, question: str, schema_hash: str, k: int = None, token_budget: int = None) -> list:
+        """
+        The most similar Examples of the schema, best first: at most k, and
+        only as many as fit in token_budget
+        """
+        k = self.k if k is None else k
+        token_budget = self.token_budget if token_budget is None else token_budget
+        terms = set(example_terms(question))
+        with self._lock:
+            self.searches += 1
+            count = len(self._examples)
+            schema_id = self._schemas.get(schema_hash)
+            if count == 0 or not terms or schema_id is None:
+                return []
+            if count > self._weighted_count * 1.01:
+                self._average_length = self._total_length / count
+                self._weighted_count = count
+                self._weights = {}
+            scores = np.zeros(count, dtype=np.float32)
+            for term in terms:
+                weights = self._term_weights(term)
+                if weights is None:
+                    continue
+                ids, term_weights = weights
+                idf = math.log(1 + (count - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += idf * term_weights
+            if len(self._schemas) > 1:
+                scores[self._schema_ids[:count] != schema_id] = 0.0
+            candidates = min(count, max(k * 4, 16))
+            top = np.argpartition(scores, -candidates)[-candidates:]
+            top = top[np.argsort(scores[top])[::-1]]
+            ranked = [self._examples[index] for index in top if scores[index] > 0]
+            key = _question_key(question)
+            answers = self._answers.get((schema_id, key), set())
+
+        selected, used = [], 0
+        for example in ranked:
+            if len(selected) == k:
+                break
+            if _question_key(example.question) == key or example.sql in answers:
+                continue
+            tokens = estimate_tokens(example.question) + estimate_tokens(example.sql)
+            if used + tokens > token_budget:
+                continue
+            selected.append(example)
+            used += tokens
+        return selected
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._examples)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'examples': len(self._examples),
+                'terms': len(set(self._postings) | set(self._pending)),
+                'schemas': len(self._schemas),
+                'searches': self.searches,
+            }
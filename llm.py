@@ -3,13 +3,28 @@ from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema import HumanMessage, SystemMessage, AIMessage
 
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+
+from cost_guard import CostVerdict
+from memory import ConversationMemory, memory_from_options
+from model_routing import StageRouter
+from response_cache import llm_config, make_cache_key
+from schema_parser import LoadedSchema, load_schema, prune_schema
+from session import ChatSession
+from sql_classifier import Verdict, classify_sql
+from stage_pipeline import LLMCall, Stage, StagePipeline, StreamEvent  # noqa: F401
+from tokens import estimate_tokens
+from tracing import Trace, tracing_enabled
 
 
 @dataclass
 class ModelOutput:
     message: str
     is_final_output: bool = False
+    metrics: dict = field(default_factory=dict)
+    trace: Trace = None
+    cost_verdict: CostVerdict = None
 
 
 class IBaseClass(ABC):
@@ -17,6 +32,10 @@ class IBaseClass(ABC):
     def predict(self, user_input: str) -> ModelOutput:
         pass
 
+    @abstractmethod
+    async def apredict(self, user_input: str) -> ModelOutput:
+        pass
+
 
 # Enumerators
 OutputTypes = Enum('OutputTypes', [
@@ -24,8 +43,11 @@ OutputTypes = Enum('OutputTypes', [
     # 'API' # This is for a later use case
 ])
 
+# Upper bound on the rendered system prompts kept per model
+MAX_COMPILED_PROMPTS = 64
+
 
-class NLP2SQL(IBaseClass):
+class NLP2SQL(StagePipeline, IBaseClass):
     """
     This class implements the Natural Language to the SQL 
     functionality of the package
@@ -38,8 +60,13 @@ class NLP2SQL(IBaseClass):
     def __init__(self, llm, options) -> None:
         self.llm = llm
         self.options = options
+        # The generation stage answers with clarifications as well as SQL,
+        # so there is no escalation here
+        self.router = StageRouter(llm, options.get('stage_llms'), prices=options.get('llm_prices'),
+                                  stages=('generation', 'review'), track_usage=options.get('router_stats', False))
 
-        self.schema = ''
+        self.loaded_schema = load_schema('')
+        self._compiled_prompts = {}
         self.system_prompt = """
         You are PostGreSQL Expert. You have to respond with PostGreSQL commands for the QUESTION asked by the user based on the DATABASE SCHEMA. 
         Make sure to follow the 'IMPORTANT NOTE' and 'GUIDELINES' provided. ALWAYS REMEMBER TO FOLLOW 'IMPORTANT NOTE' & 'GUIDELINES', DO NOT DEVIATE FROM IT.
@@ -64,57 +91,255 @@ class NLP2SQL(IBaseClass):
             Do not provide additional information or context. Stick strictly to the above guidelines.
         """.replace('  ', '').strip()
 
-        self.chat_history = []
-        self.memory_length = options['memory']*2 if 'memory' in options else 0
+        self.memory = memory_from_options(options)
 
-    def predict(self, user_input: str) -> ModelOutput:
-        if len(self.schema) == 0:
-            return ModelOutput("Schema not loaded", True)
-        if len(user_input) == 0:
-            return ModelOutput("I'm sorry, I don't understand your question.", False)
-        if user_input[-1] not in '.;:?!':
-            user_input += '.'
+    def predict(self, user_input: str, memory: ConversationMemory = None,
+                loaded_schema: LoadedSchema = None) -> ModelOutput:
+        return self._run_steps(self._pipeline(user_input, memory, loaded_schema))
+
+    async def apredict(self, user_input: str, memory: ConversationMemory = None,
+                       loaded_schema: LoadedSchema = None) -> ModelOutput:
+        """
+        Async counterpart of predict, uses the async LangChain message API
+        so many questions can be in flight on a single event loop
+        """
+        return await self._arun_steps(self._pipeline(user_input, memory, loaded_schema))
 
-        system_prompt = self.system_prompt.format(schema=self.schema)
-        messages = [SystemMessage(content=system_prompt),
-                    HumanMessage(content=user_input)]
-        response = self.llm.predict_messages(
-            messages=(self.chat_history + messages))
+    def predict_stream(self, user_input: str, memory: ConversationMemory = None,
+                       loaded_schema: LoadedSchema = None):
+        """
+        Generator version of predict that yields StreamEvents, so the
+        answer can be shown while it is being generated
+        """
+        return self._stream_steps(self._pipeline(user_input, memory, loaded_schema))
+
+    def _pipeline(self, user_input: str, memory: ConversationMemory = None,
+                  loaded_schema: LoadedSchema = None):
+        """
+        The stages of one question as a generator of stage_pipeline steps,
+        the only copy of them predict, apredict and predict_stream run
+        """
+        loaded_schema = loaded_schema if loaded_schema is not None else self.loaded_schema
+        user_input, early_output = self._validate_input(user_input, loaded_schema)
+        if early_output is not None:
+            return early_output
+
+        trace = Trace(user_input) if tracing_enabled(self.options) else None
+        memory = memory if memory is not None else self.memory
+        history = memory.snapshot()
+        cache_key, cached_output = self._cache_lookup(user_input, history, loaded_schema)
+        if cached_output is not None:
+            memory.add_turn(user_input, cached_output.message)
+            return (yield from self._finish(trace, cached_output, 'cache'))
+
+        metrics = {}
+        schema = self._prompt_schema(user_input, metrics, loaded_schema)
+        messages = history.messages('generation') + self._system_messages(user_input, schema)
+        yield Stage('generation')
+        response, metrics['generation_seconds'] = yield LLMCall('generation', messages, trace, streamed=True)
 
         final_output = False
+        branch = 'unreviewed'
 
         if self.options.get('review', False):
-            new_response = self.llm.predict_messages(messages=[SystemMessage(
-                content=self.review_prompt), HumanMessage(content="Content:\n"+response.content)])
-            if 'INVALID' not in new_response.content:
+            yield Stage('review')
+            new_response, metrics['review_seconds'] = yield LLMCall('review', self._review_messages(response), trace)
+            branch = 'rejected'
+            if 'INVALID' not in new_response:
                 final_output = True
+                branch = 'approved'
                 response = new_response
 
-        self.chat_history.append(HumanMessage(content=user_input))
-        self.chat_history.append(AIMessage(content=response.content))
-        if len(self.chat_history) > self.memory_length:
-            excess = len(self.chat_history) - self.memory_length
-            self.chat_history = self.chat_history[excess:]
+        memory.add_turn(user_input, response)
+
+        output = ModelOutput(response, final_output, metrics)
+        self._cache_store(cache_key, user_input, output, loaded_schema, history)
+        return (yield from self._finish(trace, output, branch))
+
+    def predict_many(self, questions: list, max_concurrency: int = 8,
+                     with_history: bool = False, loaded_schema: LoadedSchema = None) -> list:
+        """
+        Answers a batch of questions on a bounded pool of worker threads.
+        Outputs come back in input order, a question that raises gets an
+        output with the error in metrics['error'] instead of failing the
+        batch. Unless with_history is set, every question is answered on
+        its own and chat_history is left untouched.
+        """
+        def answer(question):
+            memory = self.memory if with_history else ConversationMemory(max_turns=0)
+            try:
+                return self.predict(question, memory=memory, loaded_schema=loaded_schema)
+            except Exception as error:
+                return ModelOutput(f"Error: {error}", False, {'error': repr(error)})
 
-        return ModelOutput(response.content, final_output)
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency),
+                                thread_name_prefix='nlp2sql-batch') as executor:
+            return list(executor.map(answer, questions))
+
+    def _validate_input(self, user_input: str, loaded_schema: LoadedSchema):
+        if len(loaded_schema.text) == 0:
+            return user_input, ModelOutput("Schema not loaded", True)
+        if len(user_input) == 0:
+            return user_input, ModelOutput("I'm sorry, I don't understand your question.", False)
+        if user_input[-1] not in '.;:?!':
+            user_input += '.'
+        return user_input, None
+
+    def _system_messages(self, user_input: str, schema: str) -> list:
+        return [self._system_message(self.system_prompt, schema),
+                HumanMessage(content=user_input)]
+
+    def _prompt_schema(self, user_input: str, metrics: dict, loaded_schema: LoadedSchema) -> str:
+        """
+        The schema to put in the prompt, pruned to the tables and columns
+        relevant to the question when options['schema_token_budget'] is set
+        """
+        token_budget = self.options.get('schema_token_budget')
+        if token_budget is None or loaded_schema.tokens <= token_budget:
+            return loaded_schema.text
+
+        schema = prune_schema(loaded_schema.parsed, user_input, token_budget)
+        prompt_schema_tokens = estimate_tokens(schema)
+        metrics['schema_tokens'] = loaded_schema.tokens
+        metrics['prompt_schema_tokens'] = prompt_schema_tokens
+        metrics['schema_reduction'] = 1 - prompt_schema_tokens / loaded_schema.tokens
+        return schema
+
+    def _review_messages(self, response: str) -> list:
+        return [self._system_message(self.review_prompt, None),
+                HumanMessage(content="Content:\n"+response)]
+
+    def _system_message(self, prompt: str, schema) -> SystemMessage:
+        """
+        Returns the SystemMessage for the prompt rendered with the schema,
+        reusing the one built for earlier calls. A schema of None means the
+        prompt is used as it is.
+        """
+        key = (prompt, schema)
+        message = self._compiled_prompts.get(key)
+        if message is None:
+            # Pruned schemas differ per question, keep the cache bounded
+            if len(self._compiled_prompts) >= MAX_COMPILED_PROMPTS:
+                self._compiled_prompts = {}
+            content = prompt if schema is None else prompt.format(schema=schema)
+            message = SystemMessage(content=content)
+            self._compiled_prompts[key] = message
+        return message
+
+    def _compile_prompts(self) -> None:
+        self._compiled_prompts = {}
+        self._system_message(self.system_prompt, self.schema)
+        self._system_message(self.review_prompt, None)
+
+    def _cache_lookup(self, user_input: str, history, loaded_schema: LoadedSchema):
+        cache_key = None
+        cache = self.options.get('cache')
+        if cache is not None:
+            prompts = [self.system_prompt, self.review_prompt]
+            config = {'review': self.options.get('review', False), 'llm': llm_config(self.llm)}
+            if self.router.config():
+                config['stages'] = self.router.config()
+            cache_key = make_cache_key(prompts, loaded_schema.text, user_input, history.messages(), config)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cached['metrics'] = {'cache': 'exact'}
+                return cache_key, ModelOutput(**cached)
+
+        # The semantic cache and the templates are keyed on the question
+        # alone, a follow-up only means the same thing in its conversation
+        standalone = not history.messages('generation')
+        semantic_cache = self.options.get('semantic_cache')
+        if semantic_cache is not None and standalone:
+            match = semantic_cache.lookup(user_input, loaded_schema.hash)
+            if match is not None:
+                cached, similarity = match
+                cached['metrics'] = {'cache': 'semantic', 'similarity': similarity}
+                return cache_key, ModelOutput(**cached)
+
+        templates = self.options.get('query_templates')
+        if templates is not None and standalone:
+            match = templates.match(user_input, loaded_schema.hash)
+            # Filled in SQL is new SQL, it only skips the pipeline when the
+            # classifier passes it, and is final only when answers are reviewed
+            if match is not None and classify_sql(match.sql) is Verdict.READ_ONLY:
+                return cache_key, ModelOutput(match.sql, self.options.get('review', False), {
+                    'cache': 'template', 'template_confidence': match.confidence,
+                    'template_support': match.support})
+
+        return cache_key, None
+
+    def _cache_store(self, cache_key, user_input: str, output: ModelOutput,
+                     loaded_schema: LoadedSchema, history) -> None:
+        # Timings belong to the call that produced the answer, not to hits
+        value = dict(asdict(output), metrics={}, trace=None, cost_verdict=None)
+        if cache_key is not None:
+            self.options['cache'].set(cache_key, value)
+        semantic_cache = self.options.get('semantic_cache')
+        standalone = not history.messages('generation')
+        if semantic_cache is not None and output.is_final_output and standalone:
+            # Only reviewed SQL is worth reusing for reworded questions
+            semantic_cache.insert(user_input, loaded_schema.hash, value)
+        templates = self.options.get('query_templates')
+        if templates is not None and output.is_final_output and standalone:
+            templates.learn(user_input, output.message, loaded_schema.hash)
 
     def override_system_prompt(self, new_system_prompt: str) -> None:
         if '{schema}' in new_system_prompt:
             self.system_prompt = new_system_prompt
+            self._compile_prompts()
 
     def override_review_prompt(self, new_review_prompt: str) -> None:
         self.review_prompt = new_review_prompt
+        self._compile_prompts()
 
     def load_schema_from_file(self, file_path: str) -> bool:
         with open(file_path, 'r', encoding='utf-8') as file:
             contents = file.read()
-            self.load_schema_as_string(contents)
+            return self.load_schema_as_string(contents)
 
     def load_schema_as_string(self, schema: str) -> bool:
-        self.schema = schema
+        """
+        Loads the schema and pre-renders the prompts for it. Returns False
+        without doing any work when the schema is the one already loaded.
+        """
+        loaded_schema = load_schema(schema)
+        if loaded_schema.hash == self.loaded_schema.hash:
+            return False
+
+        self.loaded_schema = loaded_schema
+        self._compile_prompts()
+        return True
+
+    @property
+    def schema(self) -> str:
+        return self.loaded_schema.text
+
+    @property
+    def schema_hash(self) -> str:
+        return self.loaded_schema.hash
+
+    @property
+    def schema_tokens(self) -> int:
+        return self.loaded_schema.tokens
+
+    @property
+    def parsed_schema(self):
+        return self.loaded_schema.parsed
+
+    @property
+    def chat_history(self) -> list:
+        return self.memory.messages()
 
     def clear_chat_history(self) -> None:
-        self.chat_history = []
+        self.memory.clear()
+
+    def new_session(self) -> ChatSession:
+        """
+        A per-user handle with its own chat history and schema. The model
+        keeps no per-user state, so one instance can serve many sessions
+        concurrently.
+        """
+        return ChatSession(self, memory_from_options(self.options))
 
 
 output_type_class_map = {
@@ -123,10 +348,15 @@ output_type_class_map = {
 }
 
 
-def initialize_model(llm, options={}, output_type: OutputTypes = OutputTypes.SQL):
+def initialize_model(llm, options={}, output_type: OutputTypes = OutputTypes.SQL,
+                     stage_llms: dict = None):
     """
-    Based on the Output Type the Model will be instantiated
+    Based on the Output Type the Model will be instantiated. stage_llms
+    maps stages ('generation', 'review') to the LLM to use for them, the
+    others use llm.
     """
+    if stage_llms is not None:
+        options = dict(options, stage_llms=stage_llms)
 
     model_class = output_type_class_map[output_type]
     model_instance = model_class(llm, options)
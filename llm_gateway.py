@@ -0,0 +1,397 @@
+import asyncio
+import contextvars
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from tokens import estimate_message_tokens, estimate_tokens
+from tracing import DEFAULT_BUCKETS, _Histogram, _labels
+
+# HTTP statuses worth retrying: rate limited, or the server had a bad moment
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Error classes of the openai client that carry no status but are transient
+RETRYABLE_ERRORS = {'RateLimitError', 'ServiceUnavailableError', 'APIConnectionError',
+                    'Timeout', 'APITimeoutError', 'InternalServerError'}
+
+_session = contextvars.ContextVar('nlp2sql_llm_session', default='')
+
+
+@contextmanager
+def llm_session(session_id: str):
+    """
+    Calls made inside are queued under session_id, ChatSession sets it so
+    every user gets a fair share of the gateway
+    """
+    token = _session.set(session_id)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def error_status(error: Exception) -> Optional[int]:
+    for source in (error, getattr(error, 'response', None)):
+        for name in ('http_status', 'status_code', 'status'):
+            status = getattr(source, name, None)
+            if isinstance(status, int):
+                return status
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    return error_status(error) in RETRYABLE_STATUSES or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def is_rate_limit(error: Exception) -> bool:
+    return error_status(error) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    # Seconds the server asked us to wait, when it said
+    for source in (error, getattr(error, 'response', None)):
+        headers = getattr(source, 'headers', None) or {}
+        try:
+            value = headers.get('retry-after') or headers.get('Retry-After')
+            return float(value) if value is not None else None
+        except (AttributeError, TypeError, ValueError):
+            continue
+    return None
+
+
+class TokenBucket:
+    """
+    Allows per_minute units a minute, in bursts of up to capacity (a
+    minute's worth by default). The level can go below zero when a call
+    turns out to have used more than it reserved.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None) -> None:
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """
+        Seconds until amount (at most capacity) can be taken
+        """
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+@dataclass
+class _Ticket:
+    session: str
+    tokens: int
+    enqueued: float = field(default_factory=time.monotonic)
+    granted: bool = False
+    event: threading.Event = None
+    future: object = None
+    loop: object = None
+
+    def notify(self) -> None:
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMGateway:
+    """
+    Process-wide front for the LangChain chat model behind NLP2SQL: pass
+    it as the llm to initialize_model and share it between all sessions.
+
+    Calls wait in a queue per session, served round robin, until a slot is
+    free (at most max_in_flight calls at once) and the requests and tokens
+    per minute buckets allow them; tokens are estimated from the messages
+    plus completion_tokens for the answer. The buckets hold burst_seconds
+    worth of their rate, OpenAI enforces its limits over short windows so
+    a minute's worth at once would still be rejected. Rate limits (429) and server
+    errors (5xx) are retried up to max_retries times with exponential
+    backoff and full jitter, a 429 also holds back every queued call until
+    the server's retry-after (or the backoff) has passed. Create the
+    wrapped ChatOpenAI with max_retries=0 so only the gateway retries.
+    """
+
+    def __init__(self, llm, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, max_in_flight: int = 8,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 completion_tokens: int = 256, burst_seconds: float = 1.0, seed: Optional[int] = None) -> None:
+        self.llm = llm
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.completion_tokens = completion_tokens
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute * burst_seconds / 60) \
+            if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute * burst_seconds / 60) \
+            if tokens_per_minute else None
+        self._queues = OrderedDict()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._timer = None
+        self._timer_at = 0.0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._wait_seconds = _Histogram(DEFAULT_BUCKETS)
+        self._recent_waits = deque(maxlen=1000)
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.max_queue_depth = 0
+
+    def __getattr__(self, name: str):
+        # model_name, temperature and the like come from the wrapped model
+        if name == 'llm':
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    # Scheduling
+
+    def _enqueue(self, ticket: _Ticket) -> None:
+        self._queues.setdefault(ticket.session, deque()).append(ticket)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue_depth())
+
+    def _queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _dispatch(self) -> None:
+        # Called with the lock held whenever a slot, tokens or a ticket may
+        # have become available
+        while self._queues and self._in_flight < self.max_in_flight:
+            now = time.monotonic()
+            session, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            delay = max(self._paused_until - now,
+                        self._requests.delay(1, now) if self._requests else 0.0,
+                        self._tokens.delay(ticket.tokens, now) if self._tokens else 0.0)
+            if delay > 0:
+                self._wake_up_in(delay)
+                return
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            if self._requests:
+                self._requests.take(1, now)
+            if self._tokens:
+                self._tokens.take(ticket.tokens, now)
+            self._in_flight += 1
+            ticket.granted = True
+            wait = now - ticket.enqueued
+            self._wait_seconds.observe(wait)
+            self._recent_waits.append(wait)
+            ticket.notify()
+
+    def _wake_up_in(self, delay: float) -> None:
+        wake_at = time.monotonic() + delay
+        if self._timer is not None and self._timer_at <= wake_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer_at = wake_at
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _acquire(self, tokens: int) -> _Ticket:
+        ticket = _Ticket(_session.get(), tokens, event=threading.Event())
+        with self._lock:
+            self._enqueue(ticket)
+            self._dispatch()
+        ticket.event.wait()
+        return ticket
+
+    async def _aacquire(self, tokens: int) -> _Ticket:
+        loop = asyncio.get_running_loop()
+        ticket = _Ticket(_session.get(), tokens, future=loop.create_future(), loop=loop)
+        with self._lock:
+            self._enqueue(ticket)
+            self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if ticket.granted:
+                    self._in_flight -= 1
+                    self._dispatch()
+                else:
+                    queue = self._queues.get(ticket.session)
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[ticket.session]
+            raise
+        return ticket
+
+    def _settle(self, ticket: _Ticket, prompt_tokens: int, content: str, error: BaseException, attempt: int):
+        """
+        Frees the slot and settles the token estimate against what was
+        used. After an error returns how long to back off before retrying,
+        or raises the error when it is not worth another attempt; a
+        cancellation is always raised again.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if self._tokens:
+                used = prompt_tokens + estimate_tokens(content)
+                self._tokens.take(used - ticket.tokens, time.monotonic())
+            delay = None
+            if error is None:
+                self.calls += 1
+            elif not isinstance(error, Exception):
+                # Cancelled or interrupted, the LLM didn't fail
+                pass
+            elif is_retryable(error) and attempt < self.max_retries:
+                self.retries += 1
+                delay = self._backoff(attempt, error)
+            else:
+                self.failures += 1
+            if error is not None and is_rate_limit(error):
+                self.rate_limited += 1
+                if delay is not None:
+                    # Everyone else would get a 429 too, hold the queue back
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._dispatch()
+        if error is not None and delay is None:
+            raise error
+        return delay
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # Exponential backoff with full jitter, or what the server asked for
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.backoff_max)
+        return self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # The LangChain calls NLP2SQL makes
+
+    def predict_messages(self, messages: list, **kwargs):
+        prompt_tokens = estimate_message_tokens(messages)
+        for attempt in itertools.count():
+            ticket = self._acquire(prompt_tokens + self.completion_tokens)
+            result, error = None, None
+            try:
+                result = self.llm.predict_messages(messages=messages, **kwargs)
+            except BaseException as caught:
+                # Also on KeyboardInterrupt and the like, the slot has to go back
+                error = caught
+            delay = self._settle(ticket, prompt_tokens, result.content if result else '', error, attempt)
+            if delay is None:
+                return result
+            time.sleep(delay)
+
+    async def apredict_messages(self, messages: list, **kwargs):
+        prompt_tokens = estimate_message_tokens(messages)
+        for attempt in itertools.count():
+            ticket = await self._aacquire(prompt_tokens + self.completion_tokens)
+            result, error = None, None
+            try:
+                result = await self.llm.apredict_messages(messages=messages, **kwargs)
+            except BaseException as caught:
+                # A cancelled call (asyncio.CancelledError) frees its slot too
+                error = caught
+            delay = self._settle(ticket, prompt_tokens, result.content if result else '', error, attempt)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+
+    def stream(self, messages: list, **kwargs):
+        """
+        Streams like the wrapped model. Only a call that failed before its
+        first chunk is retried, a partial answer can't be taken back.
+        """
+        prompt_tokens = estimate_message_tokens(messages)
+        for attempt in itertools.count():
+            ticket = self._acquire(prompt_tokens + self.completion_tokens)
+            content, error = '', None
+            try:
+                for chunk in self.llm.stream(messages, **kwargs):
+                    content += chunk.content
+                    yield chunk
+            except Exception as caught:
+                error = caught
+            finally:
+                if error is None:
+                    # Finished, or the consumer stopped reading early
+                    self._settle(ticket, prompt_tokens, content, None, attempt)
+            if error is None:
+                return
+            delay = self._settle(ticket, prompt_tokens, content, error,
+                                 self.max_retries if content else attempt)
+            time.sleep(delay)
+
+    # Metrics
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            return {
+                'queue_depth': self._queue_depth(),
+                'max_queue_depth': self.max_queue_depth,
+                'sessions_waiting': len(self._queues),
+                'in_flight': self._in_flight,
+                'calls': self.calls,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'failures': self.failures,
+                'wait_p50_seconds': waits[len(waits) // 2] if waits else 0.0,
+                'wait_p95_seconds': waits[int(len(waits) * 0.95)] if waits else 0.0,
+                'wait_seconds_total': self._wait_seconds.sum,
+            }
+
+    def prometheus_lines(self, prefix: str) -> list:
+        """
+        The gateway's metrics for PrometheusSink.register
+        """
+        name = f"{prefix}_llm"
+        with self._lock:
+            lines = [f"# HELP {name}_queue_depth Calls waiting for the LLM.",
+                     f"# TYPE {name}_queue_depth gauge",
+                     f"{name}_queue_depth {self._queue_depth()}",
+                     f"# HELP {name}_in_flight Calls running against the LLM.",
+                     f"# TYPE {name}_in_flight gauge",
+                     f"{name}_in_flight {self._in_flight}"]
+            for counter, value, help_text in (('calls', self.calls, 'Successful LLM calls.'),
+                                              ('retries', self.retries, 'LLM calls retried.'),
+                                              ('rate_limited', self.rate_limited, 'Rate limit (429) responses.'),
+                                              ('failures', self.failures, 'LLM calls that failed for good.')):
+                lines += [f"# HELP {name}_{counter}_total {help_text}",
+                          f"# TYPE {name}_{counter}_total counter",
+                          f"{name}_{counter}_total {value}"]
+            histogram = self._wait_seconds
+            lines += [f"# HELP {name}_wait_seconds Time calls spent queued.",
+                      f"# TYPE {name}_wait_seconds histogram"]
+            lines += [f"{name}_wait_seconds_bucket{_labels(le=bound)} {count}"
+                      for bound, count in zip(histogram.buckets, histogram.counts)]
+            lines += [f"{name}_wait_seconds_bucket{_labels(le='+Inf')} {histogram.count}",
+                      f"{name}_wait_seconds_sum {histogram.sum}",
+                      f"{name}_wait_seconds_count {histogram.count}"]
+        return lines
@@ -1,20 +1,49 @@
-from llm import initialize_model
-from langchain.chat_models import ChatOpenAI
 import streamlit as st
 
-api_key = st.secrets['OPENAI_API_KEY']
-llm = ChatOpenAI(model="gpt-4", openai_api_key=api_key, temperature=0)
+MODEL_NAME = "gpt-4"
+MEMORY_TURNS = 3
+# The account's OpenAI limits, shared by every session of this process
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 90000
+MAX_IN_FLIGHT = 16
 
-with open('dashboard.md', 'r') as file:
-    dashboard_md = file.read()
 
-with open('main_docs.md', 'r') as file:
-    main_docs = file.read()
+@st.cache_resource
+def get_llm(model_name):
+    # One client, and so one HTTP connection pool and rate limit, for every
+    # session; the gateway does the retrying. LangChain is imported here so
+    # pages render without waiting for it.
+    from langchain.chat_models import ChatOpenAI
+    from llm_gateway import LLMGateway
+    return LLMGateway(ChatOpenAI(model=model_name, openai_api_key=st.secrets['OPENAI_API_KEY'],
+                                 temperature=0, max_retries=0),
+                      requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                      max_in_flight=MAX_IN_FLIGHT)
 
-with open('connector_docs.md', 'r') as file:
-    connector_docs = file.read()
 
-documentation_md = main_docs + '\n\n' + connector_docs
+@st.cache_resource
+def get_model(model_name, memory_turns):
+    # The model keeps no per-user state, sessions hold history and schema
+    from llm import initialize_model
+    return initialize_model(llm=get_llm(model_name), options={'memory': memory_turns})
+
+
+def get_session():
+    # Created with the first question, showing a page never needs the model
+    if 'session' not in st.session_state:
+        st.session_state['session'] = get_model(
+            MODEL_NAME, MEMORY_TURNS).new_session()
+    return st.session_state['session']
+
+
+@st.cache_resource
+def load_markdown(*file_names):
+    # Read from disk once per process, not on every rerun
+    contents = []
+    for file_name in file_names:
+        with open(file_name, 'r') as file:
+            contents.append(file.read())
+    return '\n\n'.join(contents)
 
 
 def display_chatbot(schema_box, info_box):
@@ -27,7 +56,9 @@ def display_chatbot(schema_box, info_box):
             st.session_state.processing = True
 
             if prompt == "reset":
-                st.session_state.clear_chat_history()
+                if 'session' in st.session_state:
+                    st.session_state['session'].clear_chat_history()
+                st.session_state.messages = []
                 st.session_state.processing = False
             else:
                 with st.chat_message("user"):
@@ -35,9 +66,9 @@ def display_chatbot(schema_box, info_box):
                     st.session_state.messages.append(
                         {"role": "user", "content": prompt})
                 with st.chat_message("ai"):
-                    st.session_state['model'].load_schema_as_string(
-                        f"{schema_box}\n{info_box}")
-                    response = st.session_state['model'].predict(
+                    session = get_session()
+                    session.load_schema_as_string(f"{schema_box}\n{info_box}")
+                    response = session.predict(
                         prompt).message.replace('\n', '  \n')
                     st.markdown(response)
                     st.session_state.messages.append(
@@ -47,10 +78,6 @@ def display_chatbot(schema_box, info_box):
 
 def main():
 
-    if 'model' not in st.session_state:
-        st.session_state['model'] = initialize_model(
-            llm=llm, options={'memory': 3})
-
     if 'current_page' not in st.session_state:
         st.session_state['current_page'] = 'Dashboard'
 
@@ -72,14 +99,14 @@ def main():
 
     # Main content area
     if st.session_state['current_page'] == 'Dashboard':
-        st.markdown(dashboard_md)
+        st.markdown(load_markdown('dashboard.md'))
 
     elif st.session_state['current_page'] == 'Chatbot':
         st.title("Chatbot")
         display_chatbot(schema_box, info_box)
 
     elif st.session_state['current_page'] == 'Documentation':
-        st.markdown(documentation_md)
+        st.markdown(load_markdown('main_docs.md', 'connector_docs.md'))
 
     if "processing" not in st.session_state:
         st.session_state.processing = False
@@ -0,0 +1,131 @@
+import threading
+from collections import deque
+from typing import Optional
+
+from langchain.schema import HumanMessage, SystemMessage, AIMessage
+
+from tokens import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+# Hard cap on stored turns when only a token budget is configured
+DEFAULT_MAX_TURNS = 1000
+
+# Longest question/answer excerpt kept per turn in the running summary
+SUMMARY_EXCERPT_CHARS = 160
+
+
+def summarize_turn(user_input: str, response: str) -> str:
+    """
+    Default summarizer: a one line excerpt of the turn, no LLM call
+    """
+    def excerpt(text):
+        text = ' '.join(text.split())
+        return text if len(text) <= SUMMARY_EXCERPT_CHARS else text[:SUMMARY_EXCERPT_CHARS - 3] + '...'
+    return f"- Q: {excerpt(user_input)} A: {excerpt(response)}"
+
+
+class MemorySnapshot:
+    """
+    Immutable view of the memory taken at the start of a predict call, so
+    every stage of that call sees the same conversation
+    """
+
+    def __init__(self, summary: str, turns: tuple, stage_budgets: dict) -> None:
+        self.summary = summary
+        self.turns = turns
+        self.stage_budgets = stage_budgets
+
+    def messages(self, stage: Optional[str] = None) -> list:
+        """
+        The history to send with a stage's prompt: the most recent turns
+        that fit the stage's token budget, preceded by the summary if it
+        fits too. Without a budget for the stage everything is returned.
+        """
+        budget = self.stage_budgets.get(stage)
+        selected, used = [], 0
+        for human, ai, tokens in reversed(self.turns):
+            if budget is not None and used + tokens > budget:
+                break
+            selected[:0] = [human, ai]
+            used += tokens
+
+        if self.summary:
+            summary = SystemMessage(content="Summary of the earlier conversation:\n" + self.summary)
+            if budget is None or used + estimate_tokens(summary.content) + MESSAGE_OVERHEAD_TOKENS <= budget:
+                selected.insert(0, summary)
+        return selected
+
+
+class ConversationMemory:
+    """
+    Chat history capped by estimated tokens as well as by turns. Turns
+    pushed out of the budget are compacted into a running summary instead
+    of being dropped, as long as summary_tokens allows for one.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, max_turns: Optional[int] = None,
+                 summary_tokens: int = 0, stage_budgets: dict = None, summarizer=summarize_turn) -> None:
+        self.max_tokens = max_tokens
+        self.max_turns = DEFAULT_MAX_TURNS if max_turns is None else max_turns
+        self.summary_tokens = summary_tokens
+        self.stage_budgets = dict(stage_budgets or {})
+        self.summarizer = summarizer
+        # One spare slot: a new turn is appended before the oldest is compacted
+        self._turns = deque(maxlen=self.max_turns + 1)
+        self._tokens = 0
+        self._summary_lines = deque()
+        self._lock = threading.Lock()
+
+    def add_turn(self, user_input: str, response: str) -> None:
+        human, ai = HumanMessage(content=user_input), AIMessage(content=response)
+        tokens = estimate_tokens(user_input) + estimate_tokens(response) + 2 * MESSAGE_OVERHEAD_TOKENS
+        with self._lock:
+            self._turns.append((human, ai, tokens))
+            self._tokens += tokens
+            while self._turns and (len(self._turns) > self.max_turns or
+                                   (self.max_tokens is not None and self._tokens > self.max_tokens)):
+                self._compact_oldest()
+
+    def _compact_oldest(self) -> None:
+        human, ai, tokens = self._turns.popleft()
+        self._tokens -= tokens
+        if self.summary_tokens <= 0:
+            return
+        self._summary_lines.append(self.summarizer(human.content, ai.content))
+        # The summary is bounded too, its oldest lines go first
+        while len(self._summary_lines) > 1 and \
+                estimate_tokens('\n'.join(self._summary_lines)) > self.summary_tokens:
+            self._summary_lines.popleft()
+
+    def snapshot(self) -> MemorySnapshot:
+        with self._lock:
+            return MemorySnapshot('\n'.join(self._summary_lines), tuple(self._turns), self.stage_budgets)
+
+    def messages(self, stage: Optional[str] = None) -> list:
+        return self.snapshot().messages(stage)
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens
+
+    def clear(self) -> None:
+        with self._lock:
+            self._turns.clear()
+            self._summary_lines.clear()
+            self._tokens = 0
+
+
+def memory_from_options(options: dict) -> ConversationMemory:
+    """
+    Builds the memory described by the model options:
+    'memory' (turns), 'memory_tokens', 'memory_summary_tokens' and
+    'memory_stage_budgets' ({stage name: tokens})
+    """
+    max_tokens = options.get('memory_tokens')
+    default_turns = None if max_tokens is not None else 0
+    default_summary = 200 if max_tokens is not None else 0
+    return ConversationMemory(
+        max_tokens=max_tokens,
+        max_turns=options.get('memory', default_turns),
+        summary_tokens=options.get('memory_summary_tokens', default_summary),
+        stage_budgets=options.get('memory_stage_budgets'),
+    )
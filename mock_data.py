@@ -0,0 +1,460 @@
+"""
+Schema-driven mock data for load-testing the generated queries.
+
+Rows of a table of the schema are generated in chunks of NumPy arrays. The
+distributions come from the column names and types: skewed domains,
+countries, cities and industries, Zipf-distributed counts, dates in a
+range, and ranges that agree with the numbers they describe. Chunks are
+generated in parallel processes. Every chunk has its own seed, derived
+from seed and its position, so the output is the same for any number of
+processes. They are written to CSV, Parquet or PostgreSQL (COPY FROM
+STDIN) in order.
+
+    python mock_data.py --rows 1000000 --output website_aggregates.parquet [--processes 4] [--seed 0]
+    python mock_data.py --rows 10000000 --dsn postgresql://user@host/db
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import re
+from functools import partial
+
+import numpy as np
+
+from schema_parser import parse_schema
+
+COUNTRIES = [
+    'United States', 'India', 'United Kingdom', 'Germany', 'Canada', 'France', 'Australia', 'Brazil',
+    'Netherlands', 'Singapore', 'Japan', 'Spain', 'Sweden', 'Israel', 'Ireland', 'Switzerland',
+    'Mexico', 'Italy', 'Poland', 'South Africa', 'United Arab Emirates', 'South Korea', 'Denmark',
+    'Norway', 'Finland', 'Belgium', 'Austria', 'New Zealand', 'Argentina', 'Indonesia',
+]
+CITIES = [
+    'New York', 'San Francisco', 'London', 'Bangalore', 'Berlin', 'Toronto', 'Austin', 'Boston',
+    'Seattle', 'Chicago', 'Paris', 'Sydney', 'Amsterdam', 'Singapore', 'Tel Aviv', 'Dublin',
+    'Los Angeles', 'Denver', 'Atlanta', 'Mumbai', 'Stockholm', 'Munich', 'Zurich', 'Tokyo',
+]
+STATES = [
+    'California', 'New York', 'Texas', 'Massachusetts', 'Washington', 'Illinois', 'Colorado',
+    'Georgia', 'Florida', 'Karnataka', 'Maharashtra', 'Ontario', 'England', 'Bavaria', 'Berlin',
+    'New South Wales', 'North Holland', 'Ile-de-France', 'Leinster', 'Stockholm County',
+]
+# Lowercase, as the guidelines ask for industry names
+INDUSTRIES = [
+    'information technology & services', 'computer software', 'internet', 'marketing & advertising',
+    'financial services', 'hospital & health care', 'education management', 'retail',
+    'real estate', 'telecommunications', 'consumer goods', 'automotive', 'banking', 'insurance',
+    'management consulting', 'staffing & recruiting', 'logistics & supply chain', 'e-learning',
+    'media production', 'biotechnology',
+]
+FUNDING_STAGES = ['Seed', 'Angel', 'Series A', 'Series B', 'Series C', 'Series D', 'Private Equity',
+                  'Debt Financing', 'IPO', 'Venture (Round not Specified)']
+STATUSES = ['active', 'inactive', 'prospect', 'customer', 'churned']
+EMPLOYEE_BINS = [1, 11, 51, 201, 501, 1001, 5001, 10001]
+REVENUE_BINS = [0, 1e6, 10e6, 50e6, 100e6, 500e6, 1e9]
+
+_SYLLABLES = ['ar', 'be', 'co', 'da', 'el', 'fi', 'ga', 'ha', 'io', 'ja', 'ka', 'lo', 'ma', 'no',
+              'or', 'pa', 'qu', 'ra', 'sa', 'ta', 'um', 've', 'wa', 'xi', 'yo', 'ze', 'bri', 'cla',
+              'dro', 'fla', 'gri', 'kra', 'lux', 'mon', 'nex', 'pix', 'sol', 'tek', 'vio', 'zen']
+_TOP_LEVEL_DOMAINS = ['com', 'net', 'io', 'org', 'co', 'ai']
+
+_INTEGER_TYPES = {'INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'SERIAL', 'BIGSERIAL', 'SMALLSERIAL', 'INT2', 'INT4', 'INT8'}
+_FLOAT_TYPES = {'FLOAT', 'DOUBLE', 'REAL', 'NUMERIC', 'DECIMAL', 'FLOAT4', 'FLOAT8'}
+
+
+def _base_type(column_type: str) -> str:
+    return re.split(r'[\s(]', column_type.upper(), maxsplit=1)[0]
+
+
+def _zipf_cumulative(size: int, exponent: float) -> np.ndarray:
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return np.cumsum(weights) / weights.sum()
+
+
+def domain_pool(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    size distinct made up domains, e.g. 'nexora.io'
+    """
+    syllables = np.array(_SYLLABLES)
+    space = len(_SYLLABLES) ** 3 * len(_TOP_LEVEL_DOMAINS)
+    codes = rng.choice(space, size=min(size, space), replace=False)
+    codes, tld = np.divmod(codes, len(_TOP_LEVEL_DOMAINS))
+    codes, third = np.divmod(codes, len(_SYLLABLES))
+    first, second = np.divmod(codes, len(_SYLLABLES))
+    stems = np.char.add(np.char.add(syllables[first], syllables[second]), syllables[third])
+    return np.char.add(np.char.add(stems, '.'), np.array(_TOP_LEVEL_DOMAINS)[tld])
+
+
+def _range_labels(bins: list) -> list:
+    def short(value):
+        for divisor, suffix in ((1e9, 'B'), (1e6, 'M'), (1e3, 'K')):
+            if value >= divisor:
+                return f"{value / divisor:g}{suffix}"
+        return f"{value:g}"
+    labels = [f"{short(low)}-{short(high - 1 if high < 1e3 else high)}" for low, high in zip(bins, bins[1:])]
+    return labels + [f"{short(bins[-1])}+"]
+
+
+# Generators: called with the chunk's random generator, its row count, the
+# row offset of the chunk and the columns generated so far. Categorical
+# ones return (indices, vocabulary).
+
+def _sequence(rng, rows, start, columns):
+    return np.arange(start + 1, start + rows + 1, dtype=np.int64)
+
+
+def _dates(rng, rows, start, columns, first, days):
+    return np.datetime64(first, 'D') + rng.integers(0, days, rows)
+
+
+def _dates_after(rng, rows, start, columns, source, days):
+    return columns[source] + rng.integers(0, days, rows)
+
+
+def _categorical(rng, rows, start, columns, vocabulary, cumulative):
+    indices = np.searchsorted(cumulative, rng.random(rows), side='right')
+    return np.minimum(indices, len(vocabulary) - 1), vocabulary
+
+
+def _same_entity(rng, rows, start, columns, source, vocabulary):
+    # One value per value of the source column, e.g. a company name per domain
+    return columns[source][0], vocabulary
+
+
+def _binned(rng, rows, start, columns, source, bins, labels):
+    return np.clip(np.digitize(columns[source], bins) - 1, 0, len(labels) - 1), labels
+
+
+def _zipf(rng, rows, start, columns, exponent, maximum):
+    return np.minimum(rng.zipf(exponent, rows), maximum).astype(np.int64)
+
+
+def _multiple_of(rng, rows, start, columns, source, exponent, maximum):
+    # At least as many as the source, e.g. hits per visiting IP
+    return columns[source] * np.minimum(rng.zipf(exponent, rows), maximum)
+
+
+def _lognormal(rng, rows, start, columns, median, sigma, decimals):
+    values = np.round(median * rng.lognormal(0.0, sigma, rows), decimals)
+    return np.maximum(values, 1).astype(np.int64) if decimals == 0 else values
+
+
+def _uniform(rng, rows, start, columns, low, high, decimals):
+    return np.round(rng.uniform(low, high, rows), decimals)
+
+
+def _boolean(rng, rows, start, columns):
+    return rng.random(rows) < 0.5
+
+
+def _words(column: str, size: int) -> np.ndarray:
+    return np.char.add(f"{column}_", np.arange(size).astype(str))
+
+
+def _find_column(names: list, *words) -> str:
+    for name in names:
+        if all(word in name for word in words):
+            return name
+    return ''
+
+
+class MockDataGenerator:
+    """
+    Generates rows for table (the first of the schema by default) chunk
+    by chunk. vocabularies replaces the values a text column is drawn
+    from. generators replaces the generator of a column: a function
+    (rng, rows, start, columns) returning an array, which must be a
+    module level function (or a partial of one) to reach the processes.
+    """
+
+    def __init__(self, schema: str, table: str = None, seed: int = 0, start_date: str = '2023-01-01',
+                 end_date: str = '2023-12-31', chunk_rows: int = 100000, processes: int = None,
+                 customers: int = 500, leads: int = 50000, vocabularies: dict = None,
+                 generators: dict = None) -> None:
+        tables = parse_schema(schema).tables
+        if not tables:
+            raise ValueError("The schema has no tables")
+        matches = [candidate for candidate in tables if table is None or candidate.name == table]
+        if not matches:
+            raise ValueError(f"Table {table} is not in the schema")
+        self.table = matches[0]
+        self.seed = seed
+        self.start_date = start_date
+        self.days = max(1, int((np.datetime64(end_date) - np.datetime64(start_date)).astype(int)) + 1)
+        self.chunk_rows = chunk_rows
+        self.processes = processes or os.cpu_count() or 1
+        self.customers = customers
+        self.leads = leads
+        self.vocabularies = {name: np.array(values) for name, values in (vocabularies or {}).items()}
+        self._rng = np.random.default_rng([seed, 0])
+        self._plan = self._make_plan(generators or {})
+        # Arrow arrays of the vocabularies, converted once per process
+        self._dictionaries = {}
+
+    def __getstate__(self) -> dict:
+        # The cache is keyed by id(), which means nothing in another process
+        return dict(self.__dict__, _dictionaries={})
+
+    @property
+    def column_names(self) -> list:
+        return [column.name for column in self.table.columns]
+
+    def _categorical(self, name: str, vocabulary, exponent: float = 0.8):
+        vocabulary = self.vocabularies.get(name, np.asarray(vocabulary))
+        return partial(_categorical, vocabulary=vocabulary,
+                       cumulative=_zipf_cumulative(len(vocabulary), exponent))
+
+    def _column_generator(self, column, names: list):
+        """
+        The generator for a column and whether it needs other columns first
+        """
+        name, base_type = column.name.lower(), _base_type(column.type)
+        if (column.primary_key and base_type in _INTEGER_TYPES) or name == 'id':
+            return _sequence, False
+        if base_type in ('DATE', 'TIMESTAMP', 'TIMESTAMPTZ'):
+            if 'last' in name and 'dt' in names:
+                # A last visit on or after the day of the row
+                return partial(_dates_after, source='dt', days=30), True
+            return partial(_dates, first=self.start_date, days=self.days), False
+        if name.endswith('domain_name') and name[:-len('_name')] in names:
+            source = name[:-len('_name')]
+            return partial(_same_entity, source=source,
+                           vocabulary=self._domain_names(source)), True
+        if name.endswith('domain'):
+            return self._categorical(name, self._domains(name), exponent=1.1), False
+        if name.endswith('_range'):
+            if 'employee' in name and _find_column(names, 'employees'):
+                return partial(_binned, source=_find_column(names, 'employees'), bins=EMPLOYEE_BINS,
+                               labels=np.array(_range_labels(EMPLOYEE_BINS))), True
+            if 'revenue' in name and _find_column(names, 'annual_revenue'):
+                return partial(_binned, source='annual_revenue', bins=REVENUE_BINS,
+                               labels=np.array(_range_labels(REVENUE_BINS))), True
+        if 'country' in name:
+            return self._categorical(name, COUNTRIES, exponent=1.2), False
+        if 'city' in name:
+            return self._categorical(name, CITIES), False
+        if 'state' in name and base_type not in _INTEGER_TYPES:
+            return self._categorical(name, STATES), False
+        if 'industry' in name:
+            return self._categorical(name, INDUSTRIES), False
+        if 'stage' in name:
+            return self._categorical(name, FUNDING_STAGES, exponent=0.5), False
+        if 'status' in name:
+            return self._categorical(name, STATUSES), False
+        if base_type in _INTEGER_TYPES:
+            if 'hits' in name and _find_column(names, 'ips'):
+                return partial(_multiple_of, source=_find_column(names, 'ips'), exponent=2.0, maximum=200), True
+            if 'employees' in name:
+                return partial(_lognormal, median=80, sigma=1.6, decimals=0), False
+            return partial(_zipf, exponent=1.6, maximum=100000), False
+        if base_type in _FLOAT_TYPES:
+            if 'revenue' in name:
+                return partial(_lognormal, median=8e6, sigma=1.8, decimals=2), False
+            if 'funding' in name:
+                return partial(_lognormal, median=5e6, sigma=1.5, decimals=2), False
+            if 'score' in name:
+                return partial(_uniform, low=0.0, high=100.0, decimals=4), False
+            return partial(_uniform, low=0.0, high=1000.0, decimals=2), False
+        if base_type in ('BOOLEAN', 'BOOL'):
+            return _boolean, False
+        return self._categorical(name, _words(name, 1000)), False
+
+    def _domains(self, name: str) -> np.ndarray:
+        size = self.customers if 'customer' in name else self.leads
+        return self.vocabularies.get(name, domain_pool(size, self._rng))
+
+    def _domain_names(self, source: str) -> np.ndarray:
+        # 'nexora.io' -> 'Nexora', one name per domain of the source column
+        domains = self._plan_vocabulary(source)
+        return np.char.title(np.array([domain.split('.')[0] for domain in domains]))
+
+    def _plan_vocabulary(self, name: str) -> np.ndarray:
+        return self._generators[name].keywords['vocabulary']
+
+    def _make_plan(self, overrides: dict) -> list:
+        names = [column.name.lower() for column in self.table.columns]
+        self._generators, derived = {}, []
+        # Derived columns come after the columns they are computed from
+        for column in sorted(self.table.columns, key=lambda column: column.name.lower().endswith('domain_name')):
+            name = column.name.lower()
+            if column.name in overrides:
+                self._generators[name] = overrides[column.name]
+                continue
+            generator, needs_columns = self._column_generator(column, names)
+            self._generators[name] = generator
+            if needs_columns:
+                derived.append(name)
+        order = [name for name in names if name not in derived] + derived
+        return [(name, self._generators[name]) for name in order]
+
+    def chunk(self, index: int, rows: int):
+        """
+        The rows of chunk index as a pyarrow Table, the same for any
+        number of processes
+        """
+        import pyarrow as pa
+        rng = np.random.default_rng([self.seed, 1, index])
+        columns = {}
+        for name, generate in self._plan:
+            columns[name] = generate(rng, rows, index * self.chunk_rows, columns)
+        arrays = []
+        for column in self.table.columns:
+            values = columns[column.name.lower()]
+            if isinstance(values, tuple):
+                indices, vocabulary = values
+                # Dictionary encoded: Parquet keeps it, CSV writes the values
+                if id(vocabulary) not in self._dictionaries:
+                    self._dictionaries[id(vocabulary)] = (vocabulary, pa.array(vocabulary))
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()),
+                                                             self._dictionaries[id(vocabulary)][1]))
+            else:
+                arrays.append(pa.array(values))
+        return pa.Table.from_arrays(arrays, names=self.column_names)
+
+    def _jobs(self, rows: int) -> list:
+        return [(index, min(self.chunk_rows, rows - start))
+                for index, start in enumerate(range(0, rows, self.chunk_rows))]
+
+    def _map(self, function, rows: int):
+        jobs = self._jobs(rows)
+        if self.processes == 1 or len(jobs) == 1:
+            _init_worker(self)
+            yield from map(function, jobs)
+            return
+        with multiprocessing.Pool(min(self.processes, len(jobs)), initializer=_init_worker,
+                                  initargs=(self,)) as pool:
+            yield from pool.imap(function, jobs)
+
+    def tables(self, rows: int):
+        """
+        Yields the rows as pyarrow Tables of up to chunk_rows rows, in order
+        """
+        return self._map(_table_job, rows)
+
+    def csv_chunks(self, rows: int):
+        """
+        Yields the rows as CSV bytes without a header, chunk by chunk
+        """
+        return self._map(_csv_job, rows)
+
+    def to_csv(self, path: str, rows: int) -> int:
+        with open(path, 'wb') as file:
+            file.write((','.join(self.column_names) + '\n').encode('utf-8'))
+            for chunk in self.csv_chunks(rows):
+                file.write(chunk)
+        return rows
+
+    def to_parquet(self, path: str, rows: int) -> int:
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for table in self.tables(rows):
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def copy_to_postgres(self, connection, rows: int, table: str = None) -> int:
+        """
+        Streams the rows into table over a psycopg2 connection with COPY
+        FROM STDIN and commits. Serial columns get their values here, so
+        their sequences are not advanced.
+        """
+        columns = ', '.join(self.column_names)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table or self.table.name} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                               _ChunkReader(self.csv_chunks(rows)))
+        connection.commit()
+        return rows
+
+
+_worker_generator = None
+
+
+def _init_worker(generator: MockDataGenerator) -> None:
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _table_job(job):
+    return _worker_generator.chunk(*job)
+
+
+def _csv_job(job) -> bytes:
+    import pyarrow.csv
+    buffer = io.BytesIO()
+    pyarrow.csv.write_csv(_worker_generator.chunk(*job), buffer,
+                          pyarrow.csv.WriteOptions(include_header=False))
+    return buffer.getvalue()
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A file object over an iterator of byte chunks, what COPY reads from
+    """
+
+    def __init__(self, chunks) -> None:
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--schema', help='schema file, by default the website_aggregates one of the question suite')
+    parser.add_argument('--table')
+    parser.add_argument('--output', help='a .csv or .parquet file')
+    parser.add_argument('--dsn', help='load into PostgreSQL with COPY instead')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    parser.add_argument('--start-date', default='2023-01-01')
+    parser.add_argument('--end-date', default='2023-12-31')
+    args = parser.parse_args()
+
+    if args.schema:
+        with open(args.schema, 'r', encoding='utf-8') as file:
+            schema = file.read()
+    else:
+        suite_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'question_suite.json')
+        with open(suite_path, 'r', encoding='utf-8') as file:
+            schema = json.load(file)['schema']
+    generator = MockDataGenerator(schema, args.table, args.seed, args.start_date, args.end_date,
+                                  args.chunk_rows, args.processes)
+    if args.dsn:
+        import psycopg2
+        connection = psycopg2.connect(args.dsn)
+        try:
+            generator.copy_to_postgres(connection, args.rows)
+        finally:
+            connection.close()
+    elif args.output and args.output.endswith('.parquet'):
+        generator.to_parquet(args.output, args.rows)
+    elif args.output:
+        generator.to_csv(args.output, args.rows)
+    else:
+        parser.error('pass --output or --dsn')
+    print(f"{args.rows} rows of {generator.table.name} written")
+
+
+if __name__ == '__main__':
+    main()
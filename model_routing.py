@@ -0,0 +1,158 @@
+import threading
+
+from response_cache import llm_config
+from sql_classifier import Verdict, classify_sql
+from tokens import estimate_message_tokens, estimate_tokens
+from tracing import _labels
+
+# Stages of the two models that can be sent to their own LLM
+STAGES = ('relevancy', 'generation', 'review', 'clarification', 'structured')
+
+# USD per 1000 prompt and completion tokens, options['llm_prices'] adds to
+# or overrides these
+DEFAULT_PRICES = {
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-1106': (0.001, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-4-1106-preview': (0.01, 0.03),
+}
+
+
+def model_name(llm) -> str:
+    config = llm_config(llm)
+    return config['model_name'] or config['class']
+
+
+class StageRouter:
+    """
+    Picks the LLM for every stage: the one in stage_llms for it, or the
+    model's llm. With an escalation_llm, generated SQL that fails
+    validation (the local classifier can't read it as a single read-only
+    statement, or validator returns a reason) is generated again on it.
+    Every call is counted per stage and model with its latency, and with
+    track_usage its estimated tokens and cost, stats() and
+    prometheus_lines() report them so the routing table can be tuned.
+    Estimating tokens reads the whole prompt, schema included, so it is
+    skipped unless track_usage is set or the caller is tracing the call.
+    """
+
+    def __init__(self, llm, stage_llms: dict = None, escalation_llm=None, prices: dict = None,
+                 validator=None, stages: tuple = STAGES, track_usage: bool = False) -> None:
+        stage_llms = dict(stage_llms or {})
+        unknown = set(stage_llms) - set(stages)
+        if unknown:
+            raise ValueError(f"Unknown stages {', '.join(sorted(unknown))}, expected {', '.join(stages)}")
+        self.llm = llm
+        self.stage_llms = stage_llms
+        self.escalation_llm = escalation_llm
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self.validator = validator
+        self.track_usage = track_usage
+        self.escalations = 0
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def llm_for(self, stage: str):
+        return self.stage_llms.get(stage, self.llm)
+
+    def config(self) -> dict:
+        """
+        The routing as it goes into response cache keys, empty when every
+        stage uses the model's llm
+        """
+        config = {stage: llm_config(llm) for stage, llm in sorted(self.stage_llms.items())}
+        if self.escalation_llm is not None:
+            config['escalation'] = llm_config(self.escalation_llm)
+        return config
+
+    def cost(self, llm, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.prices.get(model_name(llm), (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def usage(self, llm, messages: list, response: str) -> dict:
+        """
+        The model, estimated tokens and cost of a call, as Trace.add_stage
+        takes them
+        """
+        prompt_tokens = estimate_message_tokens(messages)
+        completion_tokens = estimate_tokens(response)
+        return {'model': model_name(llm), 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'cost': self.cost(llm, prompt_tokens, completion_tokens)}
+
+    def describe(self, stage: str, messages: list, response: str) -> dict:
+        """
+        The usage of a call of the stage that was not traced when it was made
+        """
+        return self.usage(self.llm_for(stage), messages, response)
+
+    def record(self, stage: str, llm, seconds: float, messages: list, response: str,
+               traced: bool = False) -> dict:
+        """
+        Adds a call to the totals, returns its model, and its tokens and
+        cost when they were estimated (track_usage or traced), for the trace
+        """
+        if self.track_usage or traced:
+            usage = self.usage(llm, messages, response)
+        else:
+            usage = {'model': model_name(llm)}
+        with self._lock:
+            totals = self._totals.setdefault((stage, usage['model']), {
+                'calls': 0, 'seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            if self.track_usage:
+                totals['prompt_tokens'] += usage['prompt_tokens']
+                totals['completion_tokens'] += usage['completion_tokens']
+                totals['cost'] += usage['cost']
+        return usage
+
+    def escalation_reason(self, sql: str) -> str:
+        """
+        Why the generated SQL should be generated again on the
+        escalation_llm, empty when it passes or there is none
+        """
+        if self.escalation_llm is None:
+            return ''
+        verdict = classify_sql(sql)
+        if verdict is Verdict.UNKNOWN:
+            reason = 'the response is not a single SQL statement'
+        elif verdict is Verdict.MODIFIES:
+            reason = 'the query modifies the database'
+        else:
+            reason = self.validator(sql) if self.validator is not None else ''
+        if reason:
+            with self._lock:
+                self.escalations += 1
+        return reason
+
+    def stats(self) -> list:
+        """
+        One row per stage and model: calls, mean latency, and with
+        track_usage tokens and cost
+        """
+        with self._lock:
+            return [dict(totals, stage=stage, model=name, mean_seconds=totals['seconds'] / totals['calls'])
+                    for (stage, name), totals in sorted(self._totals.items())]
+
+    def prometheus_lines(self, prefix: str) -> list:
+        """
+        The per stage and model totals for PrometheusSink.register
+        """
+        name = f"{prefix}_stage_llm"
+        rows = self.stats()
+        lines = []
+        counters = [('calls', 'calls', 'LLM calls by stage and model.'),
+                    ('seconds', 'seconds', 'Time spent in LLM calls by stage and model.')]
+        if self.track_usage:
+            counters.append(('cost_usd', 'cost', 'Estimated LLM cost by stage and model.'))
+        for counter, key, help_text in counters:
+            lines += [f"# HELP {name}_{counter}_total {help_text}",
+                      f"# TYPE {name}_{counter}_total counter"]
+            lines += [f"{name}_{counter}_total{_labels(stage=row['stage'], model=row['model'])} {row[key]}"
+                      for row in rows]
+        lines += [f"# HELP {prefix}_escalations_total Generations retried on the escalation LLM.",
+                  f"# TYPE {prefix}_escalations_total counter",
+                  f"{prefix}_escalations_total {self.escalations}"]
+        return lines
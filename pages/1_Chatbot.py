@@ -1,11 +1,56 @@
 import streamlit as st
-from langchain.chat_models import ChatOpenAI
-from llm import initialize_model
+from cost_guard import CostGuard, wrap_with_limit
+from executor import ConfirmationRequired, ExecutionError, PostgresDialect, QueryExecutor, query_sql
 
 
-api_key = st.secrets['OPENAI_API_KEY']
-llm = ChatOpenAI(model="gpt-3.5-turbo-16k",
-                 openai_api_key=api_key, temperature=0)
+MODEL_NAME = "gpt-3.5-turbo-16k"
+MEMORY_TURNS = 3
+# The account's OpenAI limits, shared by every session of this process
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 90000
+MAX_IN_FLIGHT = 16
+RESULT_PAGE_SIZE = 500
+RESULT_MAX_ROWS = 10000
+MAX_QUERY_COST = 1e6
+
+
+@st.cache_resource
+def get_llm(model_name):
+    # One client, and so one HTTP connection pool and rate limit, for every
+    # session; the gateway does the retrying. LangChain is imported here so
+    # the page renders without waiting for it.
+    from langchain.chat_models import ChatOpenAI
+    from llm_gateway import LLMGateway
+    return LLMGateway(ChatOpenAI(model=model_name, openai_api_key=st.secrets['OPENAI_API_KEY'],
+                                 temperature=0, max_retries=0),
+                      requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                      max_in_flight=MAX_IN_FLIGHT)
+
+
+@st.cache_resource
+def get_model(model_name, memory_turns):
+    # The model keeps no per-user state, sessions hold history and schema.
+    # Only reviewed answers are final, and only final answers are run.
+    from llm import initialize_model
+    options = {'memory': memory_turns, 'review': True}
+    if 'DATABASE_URL' in st.secrets:
+        options['cost_guard'] = CostGuard(get_executor(st.secrets['DATABASE_URL']), max_cost=MAX_QUERY_COST,
+                                          max_rows=RESULT_MAX_ROWS, on_exceed='confirm')
+    return initialize_model(llm=get_llm(model_name), options=options)
+
+
+@st.cache_resource
+def get_executor(dsn):
+    # Every session shares the pool, a connection is only held while a page is fetched
+    return QueryExecutor(PostgresDialect(dsn=dsn), max_connections=20, max_rows=RESULT_MAX_ROWS)
+
+
+def get_session():
+    # Created with the first question, showing the page never needs the model
+    if 'session' not in st.session_state:
+        st.session_state['session'] = get_model(
+            MODEL_NAME, MEMORY_TURNS).new_session()
+    return st.session_state['session']
 
 # with open('dashboard.md', 'r') as file:
 #     dashboard_md = file.read()
@@ -32,7 +77,10 @@ def display_chatbot(schema, guidelines):
             st.session_state.processing = True
 
             if prompt == "reset":
-                st.session_state.clear_chat_history()
+                if 'session' in st.session_state:
+                    st.session_state['session'].clear_chat_history()
+                st.session_state.messages = []
+                close_result()
                 st.session_state.processing = False
             else:
                 with st.chat_message("user"):
@@ -40,21 +88,116 @@ def display_chatbot(schema, guidelines):
                     st.session_state.messages.append(
                         {"role": "user", "content": prompt})
                 with st.chat_message("ai"):
-                    st.session_state['model'].load_schema_as_string(
-                        f"{schema}\n{guidelines}")
-                    response = st.session_state['model'].predict(
-                        prompt).message.replace('\n', '  \n')
-                    st.markdown(response)
+                    session = get_session()
+                    session.load_schema_as_string(f"{schema}\n{guidelines}")
+                    output = render_stream(session.predict_stream(prompt))
+                    response = output.message.replace('\n', '  \n')
                     st.session_state.messages.append(
                         {"role": "ai", "content": response})
+                    if output.is_final_output and 'DATABASE_URL' in st.secrets:
+                        run_query(output)
                     st.session_state.processing = False
 
+    display_result()
 
-def main():
 
-    if 'model' not in st.session_state:
-        st.session_state['model'] = initialize_model(
-            llm=llm, options={'memory': 3})
+def run_query(output):
+    """
+    Runs the answer and keeps only the first page. "Load more" runs it
+    again with an OFFSET, so no connection is held between pages; pages
+    follow the query's ORDER BY, without one rows may move between pages.
+    """
+    close_result()
+    try:
+        sql = query_sql(output)
+    except ConfirmationRequired:
+        st.session_state['pending_output'] = output
+        return
+    except ExecutionError as error:
+        st.error(f"The query failed: {error}")
+        return
+    st.session_state['result_sql'] = sql
+    load_more()
+
+
+def load_more():
+    data = st.session_state.get('result_data')
+    offset = len(next(iter(data.values()), [])) if data else 0
+    limit = min(RESULT_PAGE_SIZE, RESULT_MAX_ROWS - offset)
+    try:
+        # One row over the page tells whether there are more
+        page = get_executor(st.secrets['DATABASE_URL']).execute(
+            wrap_with_limit(st.session_state['result_sql'], limit + 1, offset), max_rows=limit)
+    except ExecutionError as error:
+        st.error(f"The query failed: {error}")
+        return
+    if data is None:
+        st.session_state['result_data'] = page.to_dict()
+    else:
+        for column, values in page.to_dict().items():
+            data[column].extend(values)
+    st.session_state['result_more'] = page.truncated
+
+
+def confirm_query():
+    output = st.session_state.pop('pending_output')
+    output.cost_verdict.confirm()
+    run_query(output)
+
+
+def close_result():
+    st.session_state['result_sql'] = None
+    st.session_state['result_data'] = None
+    st.session_state['result_more'] = False
+    st.session_state['pending_output'] = None
+
+
+def display_result():
+    pending = st.session_state.get('pending_output')
+    if pending is not None:
+        st.warning(f"This query was not run because {pending.cost_verdict.reason}.")
+        st.button('Run anyway', on_click=confirm_query)
+    data = st.session_state.get('result_data')
+    if data is None:
+        return
+    st.dataframe(data)
+    shown = len(next(iter(data.values()), []))
+    if st.session_state['result_more'] and shown < RESULT_MAX_ROWS:
+        st.button('Load more', on_click=load_more)
+        st.caption(f"Showing the first {shown} rows")
+    elif st.session_state['result_more']:
+        st.caption(f"Showing {shown} rows, the result was cut at {RESULT_MAX_ROWS}")
+    else:
+        st.caption(f"{shown} rows")
+
+
+def render_stream(events):
+    """
+    Shows the stage the model is in and the answer as it is generated,
+    then replaces it with the final answer
+    """
+    placeholder = st.empty()
+    streamed = ''
+    for event in events:
+        if event.type == 'stage':
+            if event.stage == 'escalation':
+                streamed = ''  # The query is being generated again
+            placeholder.markdown(f"{streamed}\n\n_{event.stage.capitalize()}..._")
+        elif event.type == 'token':
+            streamed += event.content
+            placeholder.markdown(streamed)
+        elif event.type == 'output':
+            output = event.output
+    placeholder.markdown(output.message.replace('\n', '  \n'))
+
+    metrics = output.metrics
+    if 'time_to_first_token_seconds' in metrics:
+        st.caption(f"First token in {metrics['time_to_first_token_seconds']:.2f}s, "
+                   f"answered in {metrics['total_seconds']:.2f}s")
+    return output
+
+
+def main():
 
     with st.sidebar:
         schema = st.text_area(
@@ -0,0 +1,444 @@
+import calendar
+import datetime
+import json
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from response_cache import normalize_question
+from result_cache import canonicalize_sql
+from sql_classifier import Verdict, classify_sql, strip_code_fences
+from tracing import _labels
+
+# A typed value found in a question: its kind ('domain', 'date', 'month',
+# 'year', 'country', 'number'), where it is and its normalized value
+Slot = namedtuple('Slot', ['kind', 'start', 'end', 'value'])
+
+# How a literal of the SQL is filled from a slot: the derivation of the
+# slot's value (e.g. a month's 'start' or 'next' day), the text around it
+# inside a string literal and whether the literal is a quoted string
+Binding = namedtuple('Binding', ['slot', 'derivation', 'prefix', 'suffix', 'quoted'])
+
+TemplateMatch = namedtuple('TemplateMatch', ['sql', 'confidence', 'support', 'shape'])
+
+# Country names as the guidelines want them in SQL, spelled out in full
+COUNTRIES = [
+    'Argentina', 'Australia', 'Austria', 'Bangladesh', 'Belgium', 'Brazil', 'Bulgaria', 'Canada', 'Chile',
+    'China', 'Colombia', 'Costa Rica', 'Croatia', 'Czech Republic', 'Denmark', 'Egypt', 'Estonia',
+    'Finland', 'France', 'Germany', 'Ghana', 'Greece', 'Hong Kong', 'Hungary', 'Iceland', 'India',
+    'Indonesia', 'Ireland', 'Israel', 'Italy', 'Japan', 'Kenya', 'Latvia', 'Lithuania', 'Luxembourg',
+    'Malaysia', 'Mexico', 'Morocco', 'Netherlands', 'New Zealand', 'Nigeria', 'Norway', 'Pakistan',
+    'Peru', 'Philippines', 'Poland', 'Portugal', 'Romania', 'Saudi Arabia', 'Serbia', 'Singapore',
+    'Slovakia', 'Slovenia', 'South Africa', 'South Korea', 'Spain', 'Sri Lanka', 'Sweden',
+    'Switzerland', 'Taiwan', 'Thailand', 'Turkey', 'Ukraine', 'United Arab Emirates', 'United Kingdom',
+    'United States', 'Uruguay', 'Vietnam',
+]
+
+# Abbreviations are only matched in capitals, "us" is usually not a country
+COUNTRY_ALIASES = {
+    'US': 'United States', 'U.S.': 'United States', 'USA': 'United States', 'U.S.A.': 'United States',
+    'UK': 'United Kingdom', 'U.K.': 'United Kingdom', 'UAE': 'United Arab Emirates',
+}
+
+_MONTHS = {name: number for number in range(1, 13)
+           for name in (calendar.month_name[number].lower(), calendar.month_abbr[number].lower())}
+_MONTHS['sept'] = 9
+
+_SCALES = {'k': 1e3, 'thousand': 1e3, 'm': 1e6, 'mn': 1e6, 'million': 1e6,
+           'b': 1e9, 'bn': 1e9, 'billion': 1e9}
+
+# In the order they claim text, a month claims its year before numbers do
+_SLOT_PATTERNS = [
+    ('date', re.compile(r'\b\d{4}-\d{2}-\d{2}\b')),
+    ('month', re.compile(r'\b(' + '|'.join(sorted(_MONTHS, key=len, reverse=True)) + r')\.?,?\s+(\d{4})\b',
+                         re.IGNORECASE)),
+    ('domain', re.compile(r'\b[a-z0-9](?:[a-z0-9-]*[a-z0-9])?(?:\.[a-z0-9](?:[a-z0-9-]*[a-z0-9])?)*'
+                          r'\.[a-z]{2,24}\b', re.IGNORECASE)),
+    ('country', re.compile(r'(?<![\w.])(?:' + '|'.join(re.escape(alias) for alias in
+                                                        sorted(COUNTRY_ALIASES, key=len, reverse=True))
+                           + r')(?![\w])')),
+    ('country', re.compile(r'\b(?:' + '|'.join(re.escape(country) for country in
+                                                sorted(COUNTRIES, key=len, reverse=True)) + r')\b',
+                           re.IGNORECASE)),
+    ('number', re.compile(r'(?<![\w.])(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?)'
+                          r'(?:\s*(thousand|million|billion)\b|(k|mn|m|bn|b)\b)?(?![\w.])', re.IGNORECASE)),
+]
+
+_COUNTRY_NAMES = {country.lower(): country for country in COUNTRIES}
+
+
+def _slot_value(kind: str, match):
+    text = match.group(0)
+    if kind == 'date':
+        try:
+            return datetime.date.fromisoformat(text)
+        except ValueError:
+            return None
+    if kind == 'month':
+        return int(match.group(2)), _MONTHS[match.group(1).lower()]
+    if kind == 'domain':
+        return text.lower()
+    if kind == 'country':
+        return COUNTRY_ALIASES.get(text) or _COUNTRY_NAMES[text.lower()]
+    number = float(match.group(1).replace(',', ''))
+    scale = match.group(2) or match.group(3)
+    if scale:
+        return number * _SCALES[scale.lower()]
+    return number
+
+
+def extract_slots(question: str) -> list:
+    """
+    The domains, dates, months, years, countries and numbers of a
+    question, in the order they appear
+    """
+    slots, taken = [], []
+    for kind, pattern in _SLOT_PATTERNS:
+        for match in pattern.finditer(question):
+            start, end = match.span()
+            if any(start < taken_end and taken_start < end for taken_start, taken_end in taken):
+                continue
+            value = _slot_value(kind, match)
+            if value is None:
+                continue
+            if kind == 'number' and value.is_integer() and 1900 <= value < 2100 and match.group(0).isdigit():
+                slots.append(Slot('year', start, end, int(value)))
+            else:
+                slots.append(Slot(kind, start, end, value))
+            taken.append((start, end))
+    return sorted(slots, key=lambda slot: slot.start)
+
+
+def question_shape(question: str, slots: list) -> str:
+    """
+    The normalized question with every slot replaced by its kind, e.g.
+    'how many visitors did {domain} get in {month}'
+    """
+    parts, position = [], 0
+    for slot in slots:
+        parts += [question[position:slot.start], '{' + slot.kind + '}']
+        position = slot.end
+    parts.append(question[position:])
+    return normalize_question(''.join(parts))
+
+
+def _number_text(number: float) -> str:
+    return str(int(number)) if float(number).is_integer() else repr(number)
+
+
+def _month_bounds(year: int, month: int):
+    first = datetime.date(year, month, 1)
+    last = first.replace(day=calendar.monthrange(year, month)[1])
+    return first, last, last + datetime.timedelta(days=1)
+
+
+def derivations(slot: Slot) -> dict:
+    """
+    The ways a slot's value can appear in SQL: name -> (text, number or
+    None), in order of preference
+    """
+    if slot.kind in ('domain', 'country'):
+        return {'value': (slot.value, None)}
+    if slot.kind == 'number':
+        return {'value': (_number_text(slot.value), slot.value)}
+    if slot.kind == 'date':
+        return {'value': (slot.value.isoformat(), None),
+                'next': ((slot.value + datetime.timedelta(days=1)).isoformat(), None)}
+    if slot.kind == 'month':
+        first, last, following = _month_bounds(*slot.value)
+    else:
+        first, last, following = datetime.date(slot.value, 1, 1), datetime.date(slot.value, 12, 31), \
+            datetime.date(slot.value + 1, 1, 1)
+    values = {'start': (first.isoformat(), None), 'end': (last.isoformat(), None),
+              'next': (following.isoformat(), None)}
+    if slot.kind == 'year':
+        values = dict({'value': (str(slot.value), slot.value)}, **values)
+    return values
+
+
+def _slot_key(slot: Slot) -> str:
+    return f"{slot.kind}:{slot.value}"
+
+
+def _literal_pieces(sql: str, tokens: list) -> Optional[list]:
+    # The text between the literals of the statement, so a filled template
+    # keeps the formatting of the SQL it was learned from
+    pieces, cursor, start = [], 0, 0
+    for token in tokens:
+        position = sql.find(token.value, cursor)
+        if position == -1:
+            return None
+        if token.kind in ('string', 'number'):
+            pieces.append(sql[start:position])
+            start = position + len(token.value)
+        cursor = position + len(token.value)
+    pieces.append(sql[start:])
+    return pieces
+
+
+def _bind(literal: str, slots: list):
+    """
+    The Binding of a SQL literal to the one slot it was filled from, the
+    literal itself when it comes from no slot and None when several
+    slots could have produced it
+    """
+    quoted = literal.startswith("'")
+    if not quoted and not literal[0].isdigit() and literal[0] != '.':
+        return literal
+    content = literal[1:-1].replace("''", "'") if quoted else None
+    found = {}
+    for index, slot in enumerate(slots):
+        for derivation, (text, number) in derivations(slot).items():
+            if quoted:
+                position = content.lower().find(text.lower())
+                if position == -1:
+                    continue
+                prefix, suffix = content[:position], content[position + len(text):]
+                # A number must not be part of a longer one, e.g. 10 in '2010-01-01'
+                if (prefix and prefix[-1].isalnum()) or (suffix and suffix[0].isalnum()):
+                    continue
+                found.setdefault(index, Binding(index, derivation, prefix, suffix, True))
+            elif number is not None and float(literal) == number:
+                found.setdefault(index, Binding(index, derivation, '', '', False))
+    if len(found) > 1:
+        return None
+    return next(iter(found.values()), literal)
+
+
+def _same_literals(first: list, second: list) -> bool:
+    if len(first) != len(second):
+        return False
+    for one, other in zip(first, second):
+        if one == other:
+            continue
+        try:
+            if float(one) != float(other):
+                return False
+        except ValueError:
+            return False
+    return True
+
+
+@dataclass
+class QueryTemplate:
+    """
+    The SQL answer to one question shape: the text between its literals,
+    every literal either as it was or bound to a slot of the question, and
+    the values of the question's slots that did not end up in the SQL,
+    which a new question has to repeat
+    """
+    shape: str
+    pieces: list
+    literals: list
+    fixed: dict
+    canonical: str
+    support: int = 1
+    example: str = ''
+    bound_slots: list = field(default_factory=list)
+
+    def render(self, slots: list) -> str:
+        parts = [self.pieces[0]]
+        for literal, piece in zip(self.literals, self.pieces[1:]):
+            if isinstance(literal, Binding):
+                text = derivations(slots[literal.slot])[literal.derivation][0]
+                if literal.quoted:
+                    literal = "'" + (literal.prefix + text + literal.suffix).replace("'", "''") + "'"
+                else:
+                    literal = text
+            parts += [literal, piece]
+        return ''.join(parts)
+
+    def signature(self) -> tuple:
+        return self.canonical, tuple(self.literals), tuple(sorted(self.fixed.items()))
+
+
+class TemplateLibrary:
+    """
+    Parameterized SQL templates learned from final answers. A question's
+    domains, dates, countries and numbers become typed slots, the rest of
+    it is the question's shape, and the literals of its SQL are bound to
+    the slots they came from. A new question of a learned shape gets its
+    SQL by filling the template with its own slot values, without calling
+    the LLM. A shape whose answers disagreed (the share of the most common
+    template is its confidence) or was seen fewer than min_support times
+    is left to the LLM, as is a filled query that no longer canonicalizes
+    to the template or isn't read-only. Least recently used shapes are
+    dropped past capacity.
+    """
+
+    def __init__(self, min_confidence: float = 0.8, min_support: int = 2, capacity: int = 10000) -> None:
+        self.min_confidence = min_confidence
+        self.min_support = min_support
+        self.capacity = capacity
+        self._shapes = OrderedDict()
+        self._lock = threading.Lock()
+        self.learned = 0
+        self.unlearnable = 0
+        self.hits = 0
+        self.fallbacks = {'no_template': 0, 'low_confidence': 0, 'fixed_value': 0, 'invalid': 0}
+
+    def build(self, question: str, sql: str) -> Optional[QueryTemplate]:
+        """
+        The template of a question and its SQL answer, or None when the
+        SQL can't be parsed or a literal could come from several slots
+        """
+        sql = strip_code_fences(sql)
+        canonical = canonicalize_sql(sql)
+        if canonical is None:
+            return None
+        text, literals, tokens = canonical
+        pieces = _literal_pieces(sql, tokens)
+        if pieces is None:
+            return None
+        slots = extract_slots(question)
+        bound = [_bind(literal, slots) for literal in literals]
+        if any(binding is None for binding in bound):
+            return None
+        used = {binding.slot for binding in bound if isinstance(binding, Binding)}
+        fixed = {index: _slot_key(slot) for index, slot in enumerate(slots) if index not in used}
+        template = QueryTemplate(question_shape(question, slots), pieces, bound, fixed, text,
+                                 example=question, bound_slots=sorted(used))
+        # Filling the template with the question's own values has to give
+        # back the same query
+        rendered = canonicalize_sql(template.render(slots))
+        if rendered is None or rendered[0] != text or not _same_literals(rendered[1], literals):
+            return None
+        return template
+
+    def learn(self, question: str, sql: str, schema_hash: str) -> bool:
+        """
+        Adds the answer of a question to the template of its shape, returns
+        False when no template can be built from it
+        """
+        template = self.build(question, sql)
+        with self._lock:
+            if template is None:
+                self.unlearnable += 1
+                return False
+            key = (schema_hash, template.shape)
+            templates = self._shapes.setdefault(key, {})
+            self._shapes.move_to_end(key)
+            existing = templates.get(template.signature())
+            if existing is not None:
+                existing.support += 1
+            else:
+                templates[template.signature()] = template
+            self.learned += 1
+            while len(self._shapes) > self.capacity:
+                self._shapes.popitem(last=False)
+            return True
+
+    def learn_many(self, examples: list, schema_hash: str) -> int:
+        """
+        Learns (question, sql) pairs, e.g. from logged final outputs,
+        returns how many gave a template
+        """
+        return sum(self.learn(question, sql, schema_hash) for question, sql in examples)
+
+    def _best(self, key: tuple):
+        templates = self._shapes.get(key)
+        if not templates:
+            return None, 0.0
+        self._shapes.move_to_end(key)
+        best = max(templates.values(), key=lambda template: template.support)
+        return best, best.support / sum(template.support for template in templates.values())
+
+    def match(self, question: str, schema_hash: str) -> Optional[TemplateMatch]:
+        """
+        The SQL for the question filled from the template of its shape, or
+        None when it should go to the LLM
+        """
+        slots = extract_slots(question)
+        shape = question_shape(question, slots)
+        with self._lock:
+            template, confidence = self._best((schema_hash, shape))
+            reason = ''
+            if template is None:
+                reason = 'no_template'
+            elif template.support < self.min_support or confidence < self.min_confidence:
+                reason = 'low_confidence'
+            elif any(_slot_key(slots[index]) != value for index, value in template.fixed.items()):
+                reason = 'fixed_value'
+            if reason:
+                self.fallbacks[reason] += 1
+                return None
+            support = template.support
+
+        sql = template.render(slots)
+        rendered = canonicalize_sql(sql)
+        valid = rendered is not None and rendered[0] == template.canonical and \
+            classify_sql(sql) is Verdict.READ_ONLY
+        with self._lock:
+            if not valid:
+                self.fallbacks['invalid'] += 1
+                return None
+            self.hits += 1
+        return TemplateMatch(sql, confidence, support, shape)
+
+    def save(self, path: str) -> None:
+        """
+        Writes the templates as JSON lines, one per template
+        """
+        with self._lock:
+            rows = [dict(asdict(template), schema_hash=schema_hash)
+                    for (schema_hash, _), templates in self._shapes.items()
+                    for template in templates.values()]
+        with open(path, 'w', encoding='utf-8') as file:
+            for row in rows:
+                file.write(json.dumps(row) + '\n')
+
+    def load(self, path: str) -> int:
+        """
+        Adds the templates saved by save, returns how many were read
+        """
+        count = 0
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                row = json.loads(line)
+                schema_hash = row.pop('schema_hash')
+                row['literals'] = [Binding(*literal) if isinstance(literal, list) else literal
+                                   for literal in row['literals']]
+                row['fixed'] = {int(index): value for index, value in row['fixed'].items()}
+                template = QueryTemplate(**row)
+                with self._lock:
+                    self._shapes.setdefault((schema_hash, template.shape), {})[template.signature()] = template
+                count += 1
+        return count
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(templates) for templates in self._shapes.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            misses = sum(self.fallbacks.values())
+            lookups = self.hits + misses
+            return {
+                'shapes': len(self._shapes),
+                'learned': self.learned,
+                'unlearnable': self.unlearnable,
+                'hits': self.hits,
+                'misses': misses,
+                'fallbacks': dict(self.fallbacks),
+                'served_locally': self.hits / lookups if lookups else 0.0,
+            }
+
+    def prometheus_lines(self, prefix: str) -> list:
+        """
+        Lookup counters for PrometheusSink.register
+        """
+        stats = self.stats()
+        name = f"{prefix}_template"
+        lines = [f"# HELP {name}_hits_total Questions answered from a learned query template.",
+                 f"# TYPE {name}_hits_total counter",
+                 f"{name}_hits_total {stats['hits']}",
+                 f"# HELP {name}_fallbacks_total Questions left to the LLM, by reason.",
+                 f"# TYPE {name}_fallbacks_total counter"]
+        lines += [f"{name}_fallbacks_total{_labels(reason=reason)} {count}"
+                  for reason, count in sorted(stats['fallbacks'].items())]
+        lines += [f"# HELP {name}_shapes Question shapes with a learned template.",
+                  f"# TYPE {name}_shapes gauge",
+                  f"{name}_shapes {stats['shapes']}"]
+        return lines
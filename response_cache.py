@@ -0,0 +1,187 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercases the question, collapses whitespace and drops the trailing
+    punctuation predict adds, so trivially different spellings share a key
+    """
+    return re.sub(r'\s+', ' ', question).strip().rstrip('.;:?!').strip().lower()
+
+
+def llm_config(llm) -> dict:
+    """
+    The parts of a LangChain model that change its answers
+    """
+    # An LLMGateway only schedules the calls of the model it wraps
+    llm = getattr(llm, 'llm', llm)
+    return {
+        'class': type(llm).__name__,
+        'model_name': getattr(llm, 'model_name', None),
+        'temperature': getattr(llm, 'temperature', None),
+    }
+
+
+def make_cache_key(prompts: list, schema: str, question: str, history: list, config: dict) -> str:
+    """
+    Hashes everything that decides the model's answer: the prompt
+    templates, the schema, the normalized question, the history that will
+    be sent with it and the model configuration
+    """
+    payload = json.dumps({
+        'prompts': prompts,
+        'schema': schema,
+        'question': normalize_question(question),
+        'history': [(message.type, message.content) for message in history],
+        'config': config,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SQLiteCacheBackend:
+    """
+    On-disk cache tier so cached answers survive restarts. Entries expire
+    after the ttl given to set(), or the backend's own ttl without one.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None) -> None:
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+
+    def lookup(self, key: str) -> Optional[tuple]:
+        """
+        The value and when it expires (time.time(), None for never), None
+        when the key is missing or expired
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value), expires_at
+
+    def set(self, key: str, value: dict, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at))
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM response_cache WHERE expires_at IS NOT NULL AND expires_at < ?",
+                (time.time(),))
+        return cursor.rowcount
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM response_cache")
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of model outputs: an in-memory LRU with size and TTL
+    limits, optionally backed by a persistent tier such as SQLiteCacheBackend.
+    Entries are written to the backend with the same ttl, and a backend hit
+    is kept in memory only for what is left of it. Values are the
+    ModelOutput fields as a dict.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600, backend=None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(value)
+                del self._entries[key]
+                self.expirations += 1
+
+        entry = self.backend.lookup(key) if self.backend is not None else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            self.disk_hits += 1
+            self._store(key, value, None if expires_at is None else expires_at - time.time())
+        return dict(value)
+
+    def set(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._store(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def _store(self, key: str, value: dict, remaining: Optional[float] = None) -> None:
+        now = time.monotonic()
+        expires_at = now + self.ttl if self.ttl else None
+        if remaining is not None:
+            expires_at = now + remaining if expires_at is None else min(expires_at, now + remaining)
+        self._entries[key] = (expires_at, dict(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
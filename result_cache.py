@@ -0,0 +1,280 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Optional
+
+from sql_classifier import SQLTokenizeError, split_statements, strip_code_fences, tokenize
+
+# Words after which a table name follows
+_TABLE_KEYWORDS = {'FROM', 'JOIN', 'UPDATE', 'INTO', 'TABLE'}
+
+# Words that end a FROM item, so they are not taken for an alias
+_CLAUSE_KEYWORDS = {
+    'WHERE', 'GROUP', 'ORDER', 'HAVING', 'LIMIT', 'OFFSET', 'UNION', 'INTERSECT',
+    'EXCEPT', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'CROSS', 'NATURAL', 'ON',
+    'USING', 'WINDOW', 'FETCH', 'FOR', 'LATERAL', 'TABLESAMPLE', 'RETURNING',
+}
+
+# Functions that take a FROM inside their arguments, e.g. EXTRACT(YEAR FROM dt)
+_FROM_FUNCTIONS = {'EXTRACT', 'SUBSTRING', 'TRIM', 'OVERLAY', 'POSITION'}
+
+# Functions whose result changes from one run to the next, a query calling
+# one is not cached
+VOLATILE_FUNCTIONS = {
+    'now', 'random', 'clock_timestamp', 'statement_timestamp', 'transaction_timestamp',
+    'timeofday', 'gen_random_uuid', 'uuid_generate_v4', 'setseed', 'randomblob',
+    'unixepoch', 'changes', 'last_insert_rowid', 'total_changes',
+}
+
+# Keywords read as the current time without parentheses
+VOLATILE_KEYWORDS = {'CURRENT_DATE', 'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'LOCALTIME', 'LOCALTIMESTAMP'}
+
+
+def _identifier(token) -> str:
+    if token.kind == 'quoted_identifier':
+        return token.value[1:-1].replace('""', '"')
+    return token.value.lower()
+
+
+def canonicalize_sql(sql: str):
+    """
+    Splits a single statement into its canonical text and literals:
+    keywords and unquoted identifiers are lowercased, whitespace, comments
+    and a trailing semicolon are dropped and every string or number
+    becomes a ? placeholder. Returns (text, literals, tokens), or None for
+    SQL that doesn't tokenize or holds several statements.
+    """
+    try:
+        statements = split_statements(tokenize(strip_code_fences(sql)))
+    except SQLTokenizeError:
+        return None
+    if len(statements) != 1:
+        return None
+    parts, literals = [], []
+    for token in statements[0]:
+        if token.kind in ('string', 'number'):
+            parts.append('?')
+            literals.append(token.value)
+        elif token.kind == 'word':
+            parts.append(token.value.lower())
+        else:
+            parts.append(token.value)
+    return ' '.join(parts), literals, statements[0]
+
+
+def is_volatile(tokens: list) -> bool:
+    """
+    Whether a statement reads the clock or a random source, such as now(),
+    CURRENT_DATE, random() or SQLite's date('now')
+    """
+    for index, token in enumerate(tokens):
+        if token.kind == 'word':
+            if token.value.upper() in VOLATILE_KEYWORDS:
+                return True
+            following = tokens[index + 1] if index + 1 < len(tokens) else None
+            if following is not None and following.value == '(' and token.value.lower() in VOLATILE_FUNCTIONS:
+                return True
+        elif token.kind == 'string' and token.value[1:-1].strip().lower() == 'now':
+            return True
+    return False
+
+
+def referenced_tables(tokens: list) -> frozenset:
+    """
+    The tables a statement reads, by unqualified name, leaving out the
+    names of its CTEs
+    """
+    tables, ctes = set(), set()
+    in_function = [False]
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        following = tokens[index + 1: index + 3]
+        if token.value == '(':
+            in_function.append(index > 0 and tokens[index - 1].value.upper() in _FROM_FUNCTIONS)
+        elif token.value == ')' and len(in_function) > 1:
+            in_function.pop()
+        if token.kind in ('word', 'quoted_identifier') and [t.value.upper() for t in following] == ['AS', '(']:
+            ctes.add(_identifier(token))
+        if token.kind == 'word' and token.value.upper() in _TABLE_KEYWORDS and not in_function[-1]:
+            index = _read_from_items(tokens, index + 1, tables)
+            continue
+        index += 1
+    return frozenset(tables - ctes)
+
+
+def _read_from_items(tokens: list, index: int, tables: set) -> int:
+    # FROM a, schema.b AS x, (SELECT ...) y: take every name up to a clause keyword
+    while index < len(tokens):
+        token = tokens[index]
+        if token.kind not in ('word', 'quoted_identifier') or token.value.upper() in _CLAUSE_KEYWORDS:
+            return index
+        if token.kind == 'word' and token.value.upper() == 'ONLY':
+            index += 1  # FROM ONLY parent, leaving out its inheritors
+            continue
+        name = _identifier(token)
+        index += 1
+        while index + 1 < len(tokens) and tokens[index].value == '.':
+            name = _identifier(tokens[index + 1])
+            index += 2
+        if index < len(tokens) and tokens[index].value == '(':
+            return index  # a function call such as generate_series(...)
+        tables.add(name)
+        while index < len(tokens) and tokens[index].kind in ('word', 'quoted_identifier') \
+                and tokens[index].value.upper() not in _CLAUSE_KEYWORDS:
+            index += 1  # AS alias
+        if index < len(tokens) and tokens[index].value == ',':
+            index += 1
+            continue
+        return index
+    return index
+
+
+def make_result_key(sql: str, max_rows: Optional[int]):
+    """
+    Cache key and referenced tables of a query, or (None, None) when it
+    can't be cached, or reads the clock or a random source. Queries that
+    differ only in spacing or keyword case share a key; the bound literals
+    are part of it.
+    """
+    canonical = canonicalize_sql(sql)
+    if canonical is None:
+        return None, None
+    text, literals, tokens = canonical
+    if is_volatile(tokens):
+        return None, None
+    payload = json.dumps({'sql': text, 'literals': literals, 'max_rows': max_rows})
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest(), referenced_tables(tokens)
+
+
+class ResultCache:
+    """
+    LRU cache of QueryResults for QueryExecutor.execute, keyed on the
+    canonical SQL. Entries expire after ttl seconds and are dropped when a
+    table they read is invalidated, either through invalidate(table) or,
+    with poll_interval set, when the executor sees the table's version
+    change in the database. Results over max_result_rows are not kept.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: Optional[float] = 300,
+                 max_result_rows: int = 100000, poll_interval: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_result_rows = max_result_rows
+        self.poll_interval = poll_interval
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self._versions = {}
+        self._last_poll = time.monotonic()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.skipped = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, tables, result = entry
+                if expires_at is None or expires_at >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return replace(result, data=[list(values) for values in result.data], cached=True)
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def set(self, key: str, tables: frozenset, result) -> None:
+        if result.row_count > self.max_result_rows:
+            with self._lock:
+                self.skipped += 1
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        result = replace(result, data=[list(values) for values in result.data])
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, tables, result)
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for table in entry[1]:
+            keys = self._keys_by_table.get(table)
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_table[table]
+
+    def invalidate(self, table: str) -> int:
+        """
+        Drops every result that read the table, returns how many
+        """
+        with self._lock:
+            return self._invalidate(table if table in self._keys_by_table else table.lower())
+
+    def _invalidate(self, table: str) -> int:
+        keys = list(self._keys_by_table.get(table, ()))
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def tables_to_poll(self, tables: frozenset) -> list:
+        """
+        The tables whose version the executor should read now: those of a
+        query not seen before, plus every cached table once poll_interval
+        has passed
+        """
+        if self.poll_interval is None:
+            return []
+        with self._lock:
+            wanted = {table for table in tables if table not in self._versions}
+            if self._keys_by_table and time.monotonic() - self._last_poll >= self.poll_interval:
+                wanted.update(self._keys_by_table)
+                self._last_poll = time.monotonic()
+            return sorted(wanted)
+
+    def update_versions(self, versions: dict) -> list:
+        """
+        Takes the current version of each table (any comparable value, such
+        as a pg_stat change counter) and invalidates the tables whose
+        version moved since the last poll. Returns those tables.
+        """
+        with self._lock:
+            changed = [table for table, version in versions.items()
+                       if table in self._versions and self._versions[table] != version]
+            self._versions.update(versions)
+            for table in changed:
+                self._invalidate(table)
+            return changed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_table.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'skipped': self.skipped,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,243 @@
+import hashlib
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional
+
+from tokens import estimate_tokens
+
+_TABLE_PATTERN = re.compile(r'\b(?:CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|TABLE)\s+([\w."]+)\s*\(', re.IGNORECASE)
+_REFERENCES_PATTERN = re.compile(r'\bREFERENCES\s+([\w."]+)\s*(?:\(\s*([\w"]+)\s*\))?', re.IGNORECASE)
+_KEY_COLUMNS_PATTERN = re.compile(r'\bKEY\s*\(([^)]*)\)', re.IGNORECASE)
+_CONSTRAINT_KEYWORDS = ('PRIMARY', 'FOREIGN', 'CONSTRAINT', 'UNIQUE', 'CHECK', 'EXCLUDE', 'INDEX', 'KEY')
+
+# Words too common to say anything about which table a question is about
+_STOP_WORDS = {
+    'the', 'for', 'of', 'and', 'or', 'in', 'on', 'at', 'by', 'to', 'is', 'are',
+    'was', 'be', 'it', 'if', 'me', 'my', 'all', 'any', 'use', 'with', 'from',
+    'what', 'which', 'how', 'many', 'much', 'show', 'list', 'give', 'get',
+    'did', 'do', 'does', 'should', 'must', 'always', 'never', 'you', 'per',
+    'that', 'this', 'there', 'their', 'when', 'where', 'just', 'don',
+}
+
+
+@dataclass
+class Column:
+    name: str
+    type: str
+    definition: str
+    primary_key: bool = False
+    references: Optional[tuple] = None  # (table, column)
+
+
+@dataclass
+class Table:
+    name: str
+    columns: list = field(default_factory=list)
+    constraints: list = field(default_factory=list)
+
+    def render(self, column_names=None) -> str:
+        columns = [column for column in self.columns
+                   if column_names is None or column.name in column_names]
+        lines = [column.definition for column in columns]
+        names = {column.name.lower() for column in columns}
+        for constraint in self.constraints:
+            # Keep table constraints whose columns all made it in
+            key_columns = _constraint_columns(constraint)
+            if key_columns and key_columns <= names:
+                lines.append(constraint)
+        return f"CREATE TABLE {self.name} (\n    " + ",\n    ".join(lines) + "\n);"
+
+
+@dataclass
+class Schema:
+    tables: list
+    notes: str  # Everything outside the table blocks, e.g. guidelines
+
+    def render(self, selection: dict = None) -> str:
+        """
+        Renders the selected tables ({table name: column names or None for
+        all columns}), or the whole schema, followed by the notes
+        """
+        blocks = [table.render(None if selection is None else selection[table.name])
+                  for table in self.tables if selection is None or table.name in selection]
+        if self.notes:
+            blocks.append(self.notes)
+        return '\n\n'.join(blocks)
+
+
+def _unquote(name: str) -> str:
+    return name.replace('"', '')
+
+
+def _constraint_columns(constraint: str) -> set:
+    match = _KEY_COLUMNS_PATTERN.search(constraint)
+    if match is None:
+        return set()
+    return {_unquote(name.strip()).lower() for name in match.group(1).split(',')}
+
+
+def _split_top_level(body: str) -> list:
+    parts, depth, current = [], 0, []
+    for char in body:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _parse_table(name: str, body: str) -> Table:
+    table = Table(_unquote(name))
+    primary_keys, references = set(), {}
+    for item in _split_top_level(body):
+        words = item.split()
+        reference = _REFERENCES_PATTERN.search(item)
+        if reference is not None:
+            reference = (_unquote(reference.group(1)), _unquote(reference.group(2) or ''))
+
+        if words[0].upper() in _CONSTRAINT_KEYWORDS:
+            # Table level constraint, e.g. PRIMARY KEY (a, b)
+            table.constraints.append(item)
+            key_columns = _constraint_columns(item)
+            if 'PRIMARY KEY' in item.upper():
+                primary_keys |= key_columns
+            if reference is not None:
+                references.update(dict.fromkeys(key_columns, reference))
+            continue
+
+        column_type = words[1] if len(words) > 1 else ''
+        table.columns.append(Column(_unquote(words[0]), column_type, item,
+                                    'PRIMARY KEY' in item.upper(), reference))
+
+    for column in table.columns:
+        column.primary_key = column.primary_key or column.name.lower() in primary_keys
+        column.references = column.references or references.get(column.name.lower())
+    return table
+
+
+def parse_schema(text: str) -> Schema:
+    """
+    Parses 'CREATE TABLE name (...)' and 'TABLE name (...)' blocks into
+    tables, columns, types and keys. Text outside the blocks is kept as notes.
+    """
+    tables, notes, position = [], [], 0
+    for match in _TABLE_PATTERN.finditer(text):
+        if match.start() < position:
+            continue
+        depth, index = 1, match.end()
+        while index < len(text) and depth:
+            depth += {'(': 1, ')': -1}.get(text[index], 0)
+            index += 1
+        if depth:
+            break
+        tables.append(_parse_table(match.group(1), text[match.end():index - 1]))
+        notes.append(text[position:match.start()])
+        end = index
+        while end < len(text) and text[end] in ' \t;':
+            end += 1
+        position = end
+    notes.append(text[position:])
+    return Schema(tables, '\n'.join(part.strip() for part in notes if part.strip()))
+
+
+@dataclass(frozen=True)
+class LoadedSchema:
+    """
+    A schema ready for prompting. Immutable, so one instance can be shared
+    by every model and session using the same schema text.
+    """
+    text: str
+    hash: str
+    tokens: int
+    parsed: Schema
+
+
+@lru_cache(maxsize=32)
+def load_schema(text: str) -> LoadedSchema:
+    """
+    Hashes, measures and parses the schema text. Results are cached, so
+    sessions loading the same schema do the work once.
+    """
+    return LoadedSchema(text, hashlib.sha256(text.encode('utf-8')).hexdigest(),
+                        estimate_tokens(text), parse_schema(text))
+
+
+def _stem(word: str) -> str:
+    for suffix in ('ing', 'ors', 'ers', 'ies', 'es', 's', 'ed', 'or', 'er'):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def _terms(text: str) -> set:
+    # Splits snake_case and CamelCase identifiers as well as prose
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', text)
+    return {_stem(word) for word in re.split(r'[^A-Za-z0-9]+', text.lower())
+            if len(word) > 1 and word not in _STOP_WORDS}
+
+
+def prune_schema(schema: Schema, question: str, token_budget: int) -> str:
+    """
+    Renders only the tables and columns relevant to the question within
+    the token budget. Tables are ranked by lexical overlap with the
+    question (and with the notes lines the question touches), then tables
+    one foreign key away from a match are pulled in so joins still work.
+    The whole schema is returned unchanged when it already fits.
+    """
+    full = schema.render()
+    if estimate_tokens(full) <= token_budget or not schema.tables:
+        return full
+
+    question_words = set(re.findall(r'\w+', question.lower()))
+    question_terms = _terms(question)
+    # Guidelines like 'for visitors use no_of_visiting_ips' link words in
+    # the question to columns that don't share them
+    for line in schema.notes.splitlines():
+        if question_terms & _terms(line):
+            question_terms |= _terms(line)
+
+    scores, matched = {}, {}
+    for table in schema.tables:
+        table_hit = bool(_terms(table.name) & question_terms) + (table.name.lower() in question_words)
+        columns = {column.name for column in table.columns if _terms(column.name) & question_terms}
+        exact = sum(column.name.lower() in question_words for column in table.columns)
+        scores[table.name] = 3 * table_hit + len(columns) + 2 * exact
+        matched[table.name] = columns
+
+    tables_by_name = {table.name.lower(): table for table in schema.tables}
+    for table in schema.tables:
+        for column in table.columns:
+            target = tables_by_name.get((column.references or ('',))[0].lower())
+            if target is None or not (scores[table.name] or scores[target.name]):
+                continue
+            # Bridge tables: make both ends of a foreign key reachable
+            for name in (table.name, target.name):
+                scores[name] = max(scores[name], 0.5)
+            matched[table.name].add(column.name)
+
+    ranked = sorted((table for table in schema.tables if scores[table.name] > 0),
+                    key=lambda table: -scores[table.name])
+    if not ranked:
+        ranked = list(schema.tables)
+
+    selection, used = {}, estimate_tokens(schema.notes)
+    for table in ranked:
+        keys = {column.name for column in table.columns if column.primary_key or column.references}
+        for columns in (None, keys | matched[table.name]):
+            cost = estimate_tokens(table.render(columns))
+            if used + cost <= token_budget:
+                selection[table.name] = columns
+                used += cost
+                break
+    if not selection:
+        first = ranked[0]
+        selection[first.name] = {column.name for column in first.columns
+                                 if column.primary_key or column.name in matched[first.name]}
+    return schema.render(selection)
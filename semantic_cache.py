@@ -0,0 +1,203 @@
+import hashlib
+import re
+import threading
+from typing import Optional
+
+import numpy as np
+
+from response_cache import normalize_question
+
+_WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9.\-_@]*[a-z0-9]|[a-z0-9]")
+
+# Tokens that carry a literal value (domains, numbers, dates, emails), two
+# questions only count as duplicates when these match exactly
+_LITERAL_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|\b[\w\-]+(?:\.[\w\-]+)+\b|\b\w*\d\w*\b")
+
+STOP_WORDS = {
+    'a', 'an', 'the', 'of', 'for', 'to', 'in', 'on', 'at', 'by', 'with',
+    'from', 'and', 'or', 'is', 'are', 'was', 'were', 'be', 'did', 'do',
+    'does', 'get', 'got', 'give', 'me', 'show', 'list', 'what', 'which',
+    'how', 'please', 'can', 'you', 'i', 'we', 'all', 'that', 'this',
+    'there', 'have', 'has', 'had', 'find', 'tell', 'return',
+}
+
+# Follows the chatbot guidelines, e.g. visitors and users are interchangeable
+SYNONYMS = {
+    'users': 'visitors', 'user': 'visitors', 'visitor': 'visitors',
+    'visits': 'visitors', 'hit': 'hits', 'domains': 'domain',
+}
+
+# Words that change what is computed or which rows are kept, a question
+# with another aggregate or a negation needs other SQL however alike it reads
+AGGREGATE_WORDS = {
+    'count', 'many', 'number', 'sum', 'total', 'average', 'avg', 'mean',
+    'median', 'min', 'minimum', 'max', 'maximum', 'highest', 'lowest',
+    'most', 'least', 'top', 'bottom', 'distinct', 'unique',
+}
+NEGATION_WORDS = {'not', 'no', 'without', 'except', 'excluding', 'never', 'none', 'nor'}
+
+
+def extract_literals(question: str) -> frozenset:
+    return frozenset(match.strip('\'"') for match in _LITERAL_PATTERN.findall(question.lower()))
+
+
+def extract_match_terms(question: str) -> frozenset:
+    """
+    The terms two questions must share to be duplicates: their literals,
+    aggregate words and negations ("didn't" counts as 'not')
+    """
+    normalized = normalize_question(question)
+    words = set(_WORD_PATTERN.findall(normalized)) & (AGGREGATE_WORDS | NEGATION_WORDS)
+    if "n't" in normalized:
+        words.add('not')
+    return extract_literals(question) | words
+
+
+class HashingEmbedder:
+    """
+    Offline embedder: hashes words and character trigrams of the normalized
+    question into a fixed size, L2 normalized vector (the hashing trick)
+    """
+
+    def __init__(self, dim: int = 256, synonyms: dict = None, stop_words: set = None) -> None:
+        self.dim = dim
+        self.synonyms = SYNONYMS if synonyms is None else synonyms
+        self.stop_words = STOP_WORDS if stop_words is None else stop_words
+
+    def _features(self, text: str) -> list:
+        words = [self.synonyms.get(word, word)
+                 for word in _WORD_PATTERN.findall(normalize_question(text))
+                 if word not in self.stop_words]
+        features = [(word, 1.0) for word in words]
+        for word in words:
+            padded = f'<{word}>'
+            features.extend((padded[i:i + 3], 0.3) for i in range(len(padded) - 2))
+        return features
+
+    def _bucket(self, feature: str):
+        digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        return digest % self.dim, 1.0 if digest >> 63 else -1.0
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                index, sign = self._bucket(feature)
+                vectors[row, index] += sign * weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+class LangChainEmbedder:
+    """
+    Adapts any LangChain Embeddings (e.g. OpenAIEmbeddings) to the embedder
+    interface used by SemanticCache
+    """
+
+    def __init__(self, embeddings, dim: int) -> None:
+        self.embeddings = embeddings
+        self.dim = dim
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.asarray(self.embeddings.embed_documents(
+            [normalize_question(text) for text in texts]), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+class SemanticCache:
+    """
+    Near-duplicate question cache. Questions are embedded into rows of a
+    fixed capacity matrix (optionally memory-mapped) and looked up by cosine
+    similarity, scoped to the schema they were answered against. When full,
+    the oldest entries are overwritten.
+    """
+
+    def __init__(self, embedder=None, threshold: float = 0.85, capacity: int = 10000,
+                 mmap_path: Optional[str] = None) -> None:
+        self.embedder = embedder if embedder is not None else HashingEmbedder()
+        self.threshold = threshold
+        self.capacity = capacity
+        dim = self.embedder.dim
+        if mmap_path is None:
+            self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        else:
+            self._vectors = np.memmap(mmap_path, dtype=np.float32, mode='w+', shape=(capacity, dim))
+        self._schema_ids = np.full(capacity, -1, dtype=np.int32)
+        self._schemas = {}
+        self._entries = [None] * capacity
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _schema_id(self, schema_hash: str) -> int:
+        return self._schemas.setdefault(schema_hash, len(self._schemas))
+
+    def lookup(self, question: str, schema_hash: str):
+        """
+        Returns (value, similarity) of the closest cached question for the
+        schema, or None when nothing is above the threshold
+        """
+        vector = self.embedder.embed([question])[0]
+        terms = extract_match_terms(question)
+        with self._lock:
+            schema_id = self._schemas.get(schema_hash)
+            if schema_id is None or self._size == 0:
+                self.misses += 1
+                return None
+            scores = self._vectors[:self._size] @ vector
+            if len(self._schemas) > 1:
+                scores[self._schema_ids[:self._size] != schema_id] = -1.0
+            # Best candidates first, a near match with different literals
+            # (another domain or date), aggregates or negations must not
+            # reuse the stored SQL
+            candidates = np.argpartition(scores, -min(5, self._size))[-5:]
+            for index in candidates[np.argsort(scores[candidates])[::-1]]:
+                if scores[index] < self.threshold:
+                    break
+                entry_terms, value = self._entries[index]
+                if entry_terms == terms:
+                    self.hits += 1
+                    return dict(value), float(scores[index])
+            self.misses += 1
+            return None
+
+    def insert(self, question: str, schema_hash: str, value: dict) -> None:
+        self.insert_many([question], schema_hash, [value])
+
+    def insert_many(self, questions: list, schema_hash: str, values: list, vectors: np.ndarray = None) -> None:
+        """
+        Batch insert, embeds all questions in one call. Precomputed vectors
+        (rows L2 normalized) can be passed to skip embedding.
+        """
+        if vectors is None:
+            vectors = self.embedder.embed(questions)
+        with self._lock:
+            schema_id = self._schema_id(schema_hash)
+            for start in range(0, len(questions), self.capacity):
+                count = min(self.capacity, len(questions) - start)
+                rows = (self._next + np.arange(count)) % self.capacity
+                self.evictions += max(0, self._size + count - self.capacity)
+                self._vectors[rows] = vectors[start:start + count]
+                self._schema_ids[rows] = schema_id
+                for row, question, value in zip(rows, questions[start:start + count], values[start:start + count]):
+                    self._entries[row] = (extract_match_terms(question), dict(value))
+                self._next = (self._next + count) % self.capacity
+                self._size = min(self.capacity, self._size + count)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
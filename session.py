@@ -0,0 +1,61 @@
+import uuid
+
+from llm_gateway import llm_session
+from memory import ConversationMemory
+from schema_parser import load_schema
+
+
+class ChatSession:
+    """
+    One user's conversation with a shared model: the chat history and the
+    schema they are asking about. The model itself keeps no per-user state,
+    so a single instance (and its LLM client) can serve every session from
+    any thread. Its LLM calls are queued under session_id when the model
+    runs behind an LLMGateway.
+    """
+
+    def __init__(self, model, memory: ConversationMemory) -> None:
+        self.model = model
+        self.memory = memory
+        self.loaded_schema = model.loaded_schema
+        self.session_id = uuid.uuid4().hex
+
+    def load_schema_as_string(self, schema: str) -> bool:
+        """
+        Switches this session to the schema, returns False when it is the
+        one already loaded
+        """
+        loaded_schema = load_schema(schema)
+        if loaded_schema.hash == self.loaded_schema.hash:
+            return False
+        self.loaded_schema = loaded_schema
+        return True
+
+    def load_schema_from_file(self, file_path: str) -> bool:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return self.load_schema_as_string(file.read())
+
+    def predict(self, user_input: str):
+        with llm_session(self.session_id):
+            return self.model.predict(user_input, memory=self.memory, loaded_schema=self.loaded_schema)
+
+    async def apredict(self, user_input: str):
+        with llm_session(self.session_id):
+            return await self.model.apredict(user_input, memory=self.memory, loaded_schema=self.loaded_schema)
+
+    def predict_stream(self, user_input: str):
+        events = self.model.predict_stream(user_input, memory=self.memory, loaded_schema=self.loaded_schema)
+        while True:
+            # Only set while the model runs, not while the caller has the event
+            with llm_session(self.session_id):
+                event = next(events, None)
+            if event is None:
+                return
+            yield event
+
+    @property
+    def chat_history(self) -> list:
+        return self.memory.messages()
+
+    def clear_chat_history(self) -> None:
+        self.memory.clear()
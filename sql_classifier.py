@@ -0,0 +1,207 @@
+import re
+from collections import namedtuple
+from enum import Enum
+
+# Enumerators
+Verdict = Enum('Verdict', [
+    'READ_ONLY',
+    'MODIFIES',
+    'UNKNOWN',  # Left for the LLM review to decide
+])
+
+Token = namedtuple('Token', ['kind', 'value'])
+
+# Statements that only read, EXPLAIN is unwrapped before this is checked
+READ_ONLY_STATEMENTS = {'SELECT', 'WITH', 'VALUES', 'TABLE', 'SHOW'}
+
+# Statements that change data, schema, permissions or server state
+MODIFYING_STATEMENTS = {
+    'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'UPSERT', 'ALTER', 'DROP',
+    'TRUNCATE', 'COPY', 'GRANT', 'REVOKE', 'CREATE', 'COMMENT', 'REINDEX',
+    'VACUUM', 'CLUSTER', 'REFRESH', 'LOCK', 'CALL', 'DO', 'IMPORT',
+    'SECURITY', 'REASSIGN', 'DISCARD', 'LOAD', 'NOTIFY',
+}
+
+# Data changing keywords that can hide inside a read-looking statement,
+# e.g. a write CTE such as WITH x AS (DELETE FROM t RETURNING *) SELECT ...
+EMBEDDED_WRITE_KEYWORDS = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'TRUNCATE'}
+
+# Functions with side effects, matched on the unqualified lowercase name
+DENIED_FUNCTIONS = {
+    'nextval', 'setval', 'set_config', 'pg_sleep', 'pg_sleep_for',
+    'pg_sleep_until', 'pg_terminate_backend', 'pg_cancel_backend',
+    'pg_reload_conf', 'pg_rotate_logfile', 'pg_switch_wal',
+    'pg_create_restore_point', 'pg_promote', 'pg_stat_reset',
+    'pg_stat_reset_shared', 'pg_stat_reset_single_table_counters',
+    'pg_read_file', 'pg_read_binary_file', 'pg_ls_dir', 'pg_stat_file',
+    'pg_file_write', 'pg_file_unlink', 'pg_file_rename',
+    'lo_import', 'lo_export', 'lo_unlink', 'lo_create', 'lo_from_bytea',
+    'lo_put', 'dblink', 'dblink_exec', 'dblink_connect', 'dblink_send_query',
+    'pg_advisory_lock', 'pg_advisory_xact_lock', 'pg_try_advisory_lock',
+    'pg_advisory_lock_shared', 'pg_try_advisory_xact_lock',
+    'pg_logical_emit_message', 'pg_replication_origin_create',
+    'pg_create_logical_replication_slot', 'pg_drop_replication_slot',
+    'txid_current', 'pg_current_xact_id', 'pg_notify',
+}
+
+_TOKEN_PATTERN = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<line_comment>--[^\n]*)
+    | (?P<block_comment>/\*)
+    | (?P<dollar_string>\$(?P<tag>[A-Za-z_][A-Za-z0-9_]*)?\$)
+    | (?P<escape_string>[Ee]'(?:[^'\\]|''|\\.)*')
+    | (?P<string>[BbXxNn]?'(?:[^']|'')*')
+    | (?P<quoted_identifier>"(?:[^"]|"")*")
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<param>\$\d+|%\(\w+\)s|%s|:[A-Za-z_]\w*)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    | (?P<punct>::|<>|!=|<=|>=|\|\||[(),;:.\[\]])
+    | (?P<operator>[-+*/<>=~!@#%^&|`?]+)
+""", re.VERBOSE)
+
+
+class SQLTokenizeError(ValueError):
+    pass
+
+
+def strip_code_fences(sql: str) -> str:
+    """
+    Removes the markdown code fences models like to wrap SQL in
+    """
+    sql = sql.strip()
+    if sql.startswith('```'):
+        sql = sql.split('\n', 1)[1] if '\n' in sql else ''
+    if sql.endswith('```'):
+        sql = sql[:-3]
+    return sql.strip()
+
+
+def tokenize(sql: str) -> list:
+    """
+    Splits a PostgreSQL string into tokens, dropping whitespace and
+    comments. Keywords and identifiers are both returned as 'word' tokens.
+    """
+    tokens = []
+    position = 0
+    while position < len(sql):
+        match = _TOKEN_PATTERN.match(sql, position)
+        if match is None:
+            raise SQLTokenizeError(f"Unexpected character {sql[position]!r} at {position}")
+        kind = match.lastgroup
+        end = match.end()
+
+        if kind == 'block_comment':
+            end = _block_comment_end(sql, position)
+        elif kind == 'dollar_string':
+            closing = sql.find(match.group('dollar_string'), end)
+            if closing == -1:
+                raise SQLTokenizeError(f"Unterminated dollar quote at {position}")
+            end = closing + len(match.group('dollar_string'))
+            tokens.append(Token('string', sql[position:end]))
+        elif kind == 'escape_string':
+            tokens.append(Token('string', match.group(kind)))
+        elif kind not in ('space', 'line_comment'):
+            tokens.append(Token(kind, match.group(kind)))
+        position = end
+    return tokens
+
+
+def _block_comment_end(sql: str, position: int) -> int:
+    # Block comments nest in PostgreSQL
+    depth = 0
+    while position < len(sql):
+        if sql.startswith('/*', position):
+            depth += 1
+            position += 2
+        elif sql.startswith('*/', position):
+            depth -= 1
+            position += 2
+            if depth == 0:
+                return position
+        else:
+            position += 1
+    raise SQLTokenizeError("Unterminated block comment")
+
+
+def split_statements(tokens: list) -> list:
+    """
+    Groups tokens into statements on top level semicolons
+    """
+    statements = [[]]
+    for token in tokens:
+        if token.kind == 'punct' and token.value == ';':
+            statements.append([])
+        else:
+            statements[-1].append(token)
+    return [statement for statement in statements if statement]
+
+
+def classify_statement(tokens: list) -> Verdict:
+    words = [token.value.upper() if token.kind == 'word' else None for token in tokens]
+
+    # EXPLAIN ANALYZE runs the statement, so classify what it explains
+    while words and words[0] == 'EXPLAIN':
+        tokens, words = tokens[1:], words[1:]
+        if tokens and tokens[0].value == '(':
+            closing = next((i for i, token in enumerate(tokens) if token.value == ')'), None)
+            if closing is None:
+                return Verdict.UNKNOWN
+            tokens, words = tokens[closing + 1:], words[closing + 1:]
+        while words and words[0] in ('ANALYZE', 'ANALYSE', 'VERBOSE'):
+            tokens, words = tokens[1:], words[1:]
+
+    # (SELECT ...) UNION (SELECT ...) starts with a parenthesis
+    leading = next((word for word in words if word is not None), None)
+    if leading is None or any(token.value != '(' for token in tokens[:words.index(leading)]):
+        return Verdict.UNKNOWN
+    if leading in MODIFYING_STATEMENTS:
+        return Verdict.MODIFIES
+    if leading not in READ_ONLY_STATEMENTS:
+        return Verdict.UNKNOWN
+
+    depth = 0
+    for index, (token, word) in enumerate(zip(tokens, words)):
+        if token.value == '(':
+            depth += 1
+        elif token.value == ')':
+            depth -= 1
+        if word is None:
+            continue
+
+        previous = words[index - 1] if index > 0 else None
+        qualified = index > 0 and tokens[index - 1].value == '.'
+        following = tokens[index + 1] if index + 1 < len(tokens) else None
+
+        if word in EMBEDDED_WRITE_KEYWORDS and not qualified:
+            # Also catches the FOR UPDATE / FOR NO KEY UPDATE row locks
+            return Verdict.MODIFIES
+        elif word in ('SHARE', 'KEY') and previous == 'FOR':
+            return Verdict.MODIFIES
+        elif word == 'INTO' and depth == 0:
+            # SELECT ... INTO new_table creates a table
+            return Verdict.MODIFIES
+        elif following is not None and following.value == '(' and token.value.lower() in DENIED_FUNCTIONS:
+            return Verdict.MODIFIES
+
+    return Verdict.READ_ONLY
+
+
+def classify_sql(sql: str) -> Verdict:
+    """
+    Decides whether a (possibly multi statement) PostgreSQL string modifies
+    the database, without calling the model. Returns Verdict.UNKNOWN for
+    anything it can't tokenize or doesn't recognise.
+    """
+    try:
+        statements = split_statements(tokenize(strip_code_fences(sql)))
+    except SQLTokenizeError:
+        return Verdict.UNKNOWN
+    if not statements:
+        return Verdict.UNKNOWN
+
+    verdicts = [classify_statement(statement) for statement in statements]
+    if Verdict.MODIFIES in verdicts:
+        return Verdict.MODIFIES
+    if Verdict.UNKNOWN in verdicts:
+        return Verdict.UNKNOWN
+    return Verdict.READ_ONLY
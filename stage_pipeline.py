@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import time
+from dataclasses import dataclass
+
+from tracing import Trace, emit_trace
+
+
+@dataclass
+class StreamEvent:
+    """
+    Yielded by predict_stream: 'stage' when a stage starts, 'token' for
+    every streamed chunk of the answer and a final 'output' with the
+    ModelOutput. The tokens of an 'escalation' stage replace the answer
+    streamed before it.
+    """
+    type: str
+    stage: str = ''
+    content: str = ''
+    output: object = None
+
+
+# The steps a pipeline yields. A model writes its pipeline once, as a
+# generator of these steps that gets each step's result sent back, and
+# predict, apredict and predict_stream only differ in how they run them.
+
+@dataclass
+class Stage:
+    """
+    A stage starts, shown by predict_stream
+    """
+    name: str
+
+
+@dataclass
+class LLMCall:
+    """
+    Sends messages to the stage's LLM (or llm), the result is the answer
+    and the seconds it took. predict_stream streams it when streamed is set.
+    """
+    stage: str
+    messages: list
+    trace: Trace = None
+    llm: object = None
+    streamed: bool = False
+
+
+@dataclass
+class Speculate:
+    """
+    Starts the call in the background, the result is a handle for Join or
+    Discard. A handle neither joined nor discarded is cancelled when the
+    pipeline ends.
+    """
+    call: LLMCall
+
+
+@dataclass
+class Join:
+    """
+    Waits for a speculative call, the result is the LLMCall's
+    """
+    handle: object
+
+
+@dataclass
+class Discard:
+    """
+    Cancels a speculative call, the result is whether its request had
+    already gone out
+    """
+    handle: object
+
+
+@dataclass
+class Guard:
+    """
+    Runs options['cost_guard'] on the output
+    """
+    output: object
+    trace: Trace = None
+
+
+class StagePipeline:
+    """
+    Runs the generator of steps returned by a model's _pipeline with
+    blocking calls, on an event loop or streaming StreamEvents. Models
+    mixing it in have a router and options, and a _speculation_pool when
+    their pipeline speculates.
+    """
+    _speculation_pool = None
+
+    def _run_steps(self, steps):
+        pending = {}
+        result, error = None, None
+        try:
+            while True:
+                try:
+                    step = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    result, error = self._run_step(step, pending), None
+                except Exception as caught:
+                    result, error = None, caught
+        finally:
+            for handle in pending:
+                handle.cancel()
+
+    def _run_step(self, step, pending: dict):
+        if isinstance(step, LLMCall):
+            return self._timed_predict(step.messages, step.trace, step.stage, step.llm)
+        if isinstance(step, Speculate):
+            call = step.call
+            handle = self._speculation_pool.submit(contextvars.copy_context().run, self._timed_predict,
+                                                   call.messages, call.trace, call.stage, call.llm)
+            pending[handle] = call
+            return handle
+        if isinstance(step, Join):
+            del pending[step.handle]
+            return step.handle.result()
+        if isinstance(step, Discard):
+            del pending[step.handle]
+            # Threads can't be interrupted, a call that has started finishes
+            # in the background and its result is thrown away
+            return not step.handle.cancel()
+        if isinstance(step, Guard):
+            return self._guard(step.output, step.trace)
+        return None
+
+    async def _arun_steps(self, steps):
+        pending = {}
+        result, error = None, None
+        try:
+            while True:
+                try:
+                    step = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    result, error = await self._arun_step(step, pending), None
+                except Exception as caught:
+                    result, error = None, caught
+        finally:
+            for handle in pending:
+                handle.cancel()
+
+    async def _arun_step(self, step, pending: dict):
+        if isinstance(step, LLMCall):
+            return await self._atimed_predict(step.messages, step.trace, step.stage, step.llm)
+        if isinstance(step, Speculate):
+            call = step.call
+            handle = asyncio.ensure_future(self._atimed_predict(call.messages, call.trace, call.stage, call.llm))
+            pending[handle] = call
+            return handle
+        if isinstance(step, Join):
+            del pending[step.handle]
+            return await step.handle
+        if isinstance(step, Discard):
+            del pending[step.handle]
+            # The task started before the step that discards it, so its
+            # request is out; once it has finished it is known whether the
+            # answer is too
+            step.handle.cancel()
+            await asyncio.gather(step.handle, return_exceptions=True)
+            return True
+        if isinstance(step, Guard):
+            if self.options.get('cost_guard') is None:
+                return step.output
+            # EXPLAIN is a blocking database round trip, keep it off the loop
+            return await asyncio.get_running_loop().run_in_executor(None, self._guard, step.output, step.trace)
+        return None
+
+    def _stream_steps(self, steps):
+        timings = {'start': time.perf_counter()}
+        pending = {}
+        result, error = None, None
+        try:
+            while True:
+                try:
+                    step = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration as stop:
+                    yield StreamEvent('output', output=stop.value)
+                    return
+                try:
+                    if isinstance(step, Stage):
+                        yield StreamEvent('stage', step.name)
+                        result = None
+                    elif isinstance(step, LLMCall) and step.streamed:
+                        result = yield from self._stream_tokens(step, timings)
+                    elif isinstance(step, Join):
+                        call = pending[step.handle]
+                        result = self._run_step(step, pending)
+                        # Not streamed, the whole answer comes at once
+                        yield StreamEvent('token', call.stage, result[0])
+                    else:
+                        if isinstance(step, Guard):
+                            step.output.metrics['total_seconds'] = time.perf_counter() - timings['start']
+                            if 'time_to_first_token_seconds' in timings:
+                                step.output.metrics['time_to_first_token_seconds'] = \
+                                    timings['time_to_first_token_seconds']
+                        result = self._run_step(step, pending)
+                    error = None
+                except Exception as caught:
+                    result, error = None, caught
+        finally:
+            for handle in pending:
+                handle.cancel()
+
+    def _timed_predict(self, messages: list, trace: Trace = None, stage: str = '', llm=None):
+        llm = llm if llm is not None else self.router.llm_for(stage)
+        start = time.perf_counter()
+        content = llm.predict_messages(messages=messages).content
+        seconds = time.perf_counter() - start
+        routed = self.router.record(stage, llm, seconds, messages, content, trace is not None)
+        if trace is not None:
+            trace.add_stage(stage, seconds, messages, content, **routed)
+        return content, seconds
+
+    async def _atimed_predict(self, messages: list, trace: Trace = None, stage: str = '', llm=None):
+        llm = llm if llm is not None else self.router.llm_for(stage)
+        start = time.perf_counter()
+        content = (await llm.apredict_messages(messages=messages)).content
+        seconds = time.perf_counter() - start
+        routed = self.router.record(stage, llm, seconds, messages, content, trace is not None)
+        if trace is not None:
+            trace.add_stage(stage, seconds, messages, content, **routed)
+        return content, seconds
+
+    def _stream_tokens(self, call: LLMCall, timings: dict):
+        llm = call.llm if call.llm is not None else self.router.llm_for(call.stage)
+        start = time.perf_counter()
+        content = ''
+        for chunk in llm.stream(call.messages):
+            if 'time_to_first_token_seconds' not in timings:
+                timings['time_to_first_token_seconds'] = time.perf_counter() - timings['start']
+            content += chunk.content
+            yield StreamEvent('token', call.stage, chunk.content)
+        seconds = time.perf_counter() - start
+        routed = self.router.record(call.stage, llm, seconds, call.messages, content, call.trace is not None)
+        if call.trace is not None:
+            call.trace.add_stage(call.stage, seconds, call.messages, content, **routed)
+        return content, seconds
+
+    def _guard(self, output, trace: Trace = None):
+        cost_guard = self.options.get('cost_guard')
+        if cost_guard is not None:
+            cost_guard.apply(output, trace)
+        return output
+
+    def _finish(self, trace: Trace, output, branch: str):
+        """
+        Runs options['cost_guard'] on the output, attaches the trace and
+        hands it to the sinks in options['trace_sinks']
+        """
+        yield Guard(output, trace)
+        if trace is not None:
+            trace.finish(branch, output.metrics.get('cache', ''))
+            output.trace = trace
+            emit_trace(trace, self.options.get('trace_sinks'))
+        return output
@@ -0,0 +1,78 @@
+import json
+from dataclasses import dataclass
+
+from sql_classifier import strip_code_fences
+
+_TRUE_WORDS = {'true', 'yes', 'y', '1'}
+_FALSE_WORDS = {'false', 'no', 'n', '0'}
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+@dataclass
+class StructuredAnswer:
+    relevant: bool
+    sql: str
+    read_only: bool
+    clarification: str
+
+
+def _extract_object(text: str) -> dict:
+    # Models add fences or a sentence around the JSON despite being told
+    # not to, so parse from the first '{' to the matching last '}'
+    text = strip_code_fences(text)
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end < start:
+        raise StructuredOutputError("no JSON object in the response")
+    try:
+        value = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as error:
+        raise StructuredOutputError(f"invalid JSON: {error}") from error
+    if not isinstance(value, dict):
+        raise StructuredOutputError("the response is not a JSON object")
+    return value
+
+
+def _boolean(value, name: str) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in _TRUE_WORDS | _FALSE_WORDS:
+        return value.strip().lower() in _TRUE_WORDS
+    raise StructuredOutputError(f"'{name}' must be true or false, got {value!r}")
+
+
+def _text(value, name: str) -> str:
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise StructuredOutputError(f"'{name}' must be a string, got {value!r}")
+    return value.strip()
+
+
+def parse_structured_answer(text: str) -> StructuredAnswer:
+    """
+    Parses and validates the JSON verdict of the single-call pipeline:
+    {"relevant": bool, "sql": str, "read_only": bool, "clarification": str}.
+    Raises StructuredOutputError when the response is malformed or
+    inconsistent, e.g. relevant without any SQL.
+    """
+    value = _extract_object(text)
+    if 'relevant' not in value:
+        raise StructuredOutputError("'relevant' is missing")
+
+    relevant = _boolean(value['relevant'], 'relevant')
+    sql = strip_code_fences(_text(value.get('sql'), 'sql'))
+    clarification = _text(value.get('clarification'), 'clarification')
+    if relevant:
+        if not sql:
+            raise StructuredOutputError("relevant but 'sql' is empty")
+        if 'read_only' not in value:
+            raise StructuredOutputError("'read_only' is missing")
+        read_only = _boolean(value['read_only'], 'read_only')
+    else:
+        if not clarification:
+            raise StructuredOutputError("not relevant but 'clarification' is empty")
+        read_only = False
+    return StructuredAnswer(relevant, sql, read_only, clarification)
@@ -0,0 +1,346 @@
+"""
+Headless accuracy test-suite runner.
+
+Every test is an input (plus its variants) with the expected answer. Each
+input is asked `repetitions` times on a bounded pool of workers, and two
+assertions are checked per run. The first is whether the output is final
+as expected. The second, when the test has a sql_output, is whether the
+query matches it.
+
+Finished runs are appended to a checkpoint file, keyed on a hash of the
+prompt templates, schema, model configuration and the run itself. An
+interrupted run resumes where it stopped. After a change, only the runs
+it affects are asked again, and the runs of other suites and
+configurations stay in the file for when they are tested again.
+
+    python suite_runner.py [benchmarks/question_suite.json] [--repetitions 10] [--workers 8] [--rpm 3500]
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+
+from executor import ExecutionError
+from llm_gateway import is_rate_limit, is_retryable, llm_session
+from memory import ConversationMemory
+from response_cache import llm_config
+from result_cache import canonicalize_sql
+
+# Prompt templates either model may have, they all decide the answers
+PROMPT_ATTRIBUTES = ('system_prompt', 'relevancy_prompt', 'generation_prompt', 'review_prompt',
+                     'clarification_prompt', 'structured_prompt')
+
+DEFAULT_SUITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'question_suite.json')
+
+CSV_FIELDS = ['category', 'input', 'repetition', 'expected_final', 'is_final_output', 'final_ok', 'sql_ok',
+              'seconds', 'reused', 'error', 'message']
+
+
+@dataclass
+class SuiteCase:
+    """
+    One run of a test: an input (the test's question or one of its
+    variants), the repetition number and what should come back. key is
+    the content hash it is checkpointed under.
+    """
+    category: str
+    input: str
+    repetition: int
+    sql_output: str = ''
+    final: bool = True
+    description: str = ''
+    key: str = ''
+
+
+def load_suite(path: str) -> dict:
+    """
+    Reads a suite: {"schema": ..., "cases": [...]}, where every case has an
+    "input" (or "question"), optional "variants", "category",
+    "sql_output", "final" and "description"
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def expand_cases(suite: dict, repetitions: int = 1) -> list:
+    cases = []
+    for test in suite['cases']:
+        question = test.get('input', test.get('question', ''))
+        for text in [question] + list(test.get('variants', [])):
+            for repetition in range(repetitions):
+                cases.append(SuiteCase(test.get('category', 'uncategorized'), text, repetition,
+                                       test.get('sql_output', ''), test.get('final', True),
+                                       test.get('description', '')))
+    return cases
+
+
+def model_fingerprint(model, schema: str) -> str:
+    """
+    Hashes what decides the model's answers: prompt templates, schema, LLM
+    configuration, per-stage routing and the plain (not object) options
+    """
+    options = {name: value for name, value in model.options.items()
+               if isinstance(value, (str, int, float, bool, type(None)))}
+    router = getattr(model, 'router', None)
+    payload = json.dumps({
+        'prompts': [getattr(model, name, None) for name in PROMPT_ATTRIBUTES],
+        'schema': schema,
+        'llm': llm_config(model.llm),
+        'stages': router.config() if router is not None else {},
+        'options': options,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def case_key(fingerprint: str, case: SuiteCase) -> str:
+    payload = json.dumps([fingerprint, case.category, case.input, case.repetition,
+                          case.sql_output, case.final])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def same_sql(actual: str, expected: str, executor=None) -> bool:
+    """
+    With an executor both queries are run and their rows compared in any
+    order, otherwise their canonical forms (case, whitespace, literals)
+    """
+    if executor is not None:
+        try:
+            actual_rows = sorted(map(repr, executor.execute(actual).rows()))
+        except ExecutionError:
+            return False
+        try:
+            expected_rows = sorted(map(repr, executor.execute(expected).rows()))
+        except ExecutionError:
+            # An expected query that doesn't run can't be matched
+            return False
+        return actual_rows == expected_rows
+    actual_canonical, expected_canonical = canonicalize_sql(actual), canonicalize_sql(expected)
+    if actual_canonical is None or expected_canonical is None:
+        return actual.strip().lower() == expected.strip().lower()
+    return actual_canonical[:2] == expected_canonical[:2]
+
+
+def check_output(output, case: SuiteCase, executor=None) -> dict:
+    """
+    The assertions of one run, None where one doesn't apply
+    """
+    sql_ok = None
+    if case.sql_output:
+        sql_ok = output.is_final_output and same_sql(output.message, case.sql_output, executor)
+    return {'final_ok': output.is_final_output == case.final, 'sql_ok': sql_ok}
+
+
+class Checkpoint:
+    """
+    Finished runs as JSON lines, appended as they come in. A line cut
+    short by an interrupted run is skipped when the file is read back.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['key']] = record
+        return records
+
+    def append(self, record: dict) -> None:
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line)
+                file.flush()
+
+    def compact(self, records: list, fingerprint: str) -> None:
+        """
+        Rewrites the file with records as the runs of fingerprint. Runs of
+        the fingerprint's cases that are no longer in the suite are
+        dropped, the runs of other suites and configurations are kept.
+        """
+        with self._lock:
+            kept = [record for record in self.load().values() if record.get('fingerprint') != fingerprint]
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+                file.writelines(json.dumps(record) + '\n' for record in kept + records)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def _run_case(model, case: SuiteCase, executor, max_retries: int) -> dict:
+    record = dict(asdict(case), reused=False, error='', message='', is_final_output=False,
+                  final_ok=None, sql_ok=None, seconds=0.0)
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            with llm_session(f'suite-{case.category}'):
+                output = model.predict(case.input, memory=ConversationMemory(max_turns=0))
+        except Exception as error:
+            # Rate limits are the LLMGateway's to retry and pace, one that
+            # gets here has outlasted its retries
+            if is_rate_limit(error) or not is_retryable(error) or attempt == max_retries:
+                record['error'] = repr(error)
+                return record
+            time.sleep(min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0))
+            continue
+        record['seconds'] = time.perf_counter() - start
+        record['message'] = output.message
+        record['is_final_output'] = output.is_final_output
+        record.update(check_output(output, case, executor))
+        return record
+
+
+def run_suite(model, suite: dict, repetitions: int = 1, workers: int = 8, checkpoint_path: str = None,
+              executor=None, max_retries: int = 5, progress=None) -> dict:
+    """
+    Runs every case of the suite that the checkpoint has no result for
+    under the current fingerprint, and returns the report. Runs that
+    fail with an error are reported but not checkpointed, so they are
+    retried next time. progress(done, total) is called as runs finish.
+    Other transient failures are retried up to max_retries times, rate
+    limits are left to the LLMGateway the model's LLM should be wrapped in.
+    The model should have no response cache, it would answer repetitions.
+    """
+    started_at = time.time()
+    model.load_schema_as_string(suite['schema'])
+    fingerprint = model_fingerprint(model, suite['schema'])
+    cases = expand_cases(suite, repetitions)
+    for case in cases:
+        case.key = case_key(fingerprint, case)
+
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+    done = checkpoint.load() if checkpoint is not None else {}
+    records = {case.key: dict(done[case.key], reused=True) for case in cases if case.key in done}
+    pending = [case for case in cases if case.key not in records]
+
+    def run_and_save(case):
+        record = dict(_run_case(model, case, executor, max_retries), fingerprint=fingerprint)
+        # Saved by the worker, so runs that finish during an interrupt count
+        if checkpoint is not None and not record['error']:
+            checkpoint.append(record)
+        return record
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='nlp2sql-suite')
+    try:
+        for future in as_completed([pool.submit(run_and_save, case) for case in pending]):
+            record = future.result()
+            records[record['key']] = record
+            if progress is not None:
+                progress(len(records), len(cases))
+    finally:
+        # On an interrupt the runs not started yet are dropped
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    results = [records[case.key] for case in cases]
+    if checkpoint is not None:
+        checkpoint.compact([record for record in results if not record['error']], fingerprint)
+    report = summarize(results, repetitions)
+    report.update(fingerprint=fingerprint, started_at=started_at, seconds=time.time() - started_at)
+    report['results'] = results
+    return report
+
+
+def summarize(results: list, repetitions: int) -> dict:
+    """
+    Totals in the shape the Dashboard's Testing Results show them
+    """
+    by_category, by_assertion = {}, {}
+    for record in results:
+        if record['error']:
+            continue
+        category = by_category.setdefault(record['category'], {'passed': 0, 'failed': 0})
+        for assertion in ('final_ok', 'sql_ok'):
+            if record[assertion] is None:
+                continue
+            outcome = 'passed' if record[assertion] else 'failed'
+            category[outcome] += 1
+            by_assertion.setdefault(assertion[:-3], {'passed': 0, 'failed': 0})[outcome] += 1
+
+    passed = sum(totals['passed'] for totals in by_category.values())
+    failed = sum(totals['failed'] for totals in by_category.values())
+    inputs = len({(record['category'], record['input']) for record in results})
+    tests = sum(1 for record in results if not record['error'])
+    return {
+        'categories': len(by_category),
+        'variants_per_category': round(inputs / len(by_category), 1) if by_category else 0,
+        'repetitions': repetitions,
+        'assertions_per_test': round((passed + failed) / tests, 1) if tests else 0,
+        'assertions': passed + failed,
+        'passed': passed,
+        'failed': failed,
+        'errors': sum(1 for record in results if record['error']),
+        'reused': sum(1 for record in results if record['reused']),
+        'by_category': by_category,
+        'by_assertion': by_assertion,
+    }
+
+
+def write_report(report: dict, path: str) -> tuple:
+    """
+    Writes the report as path.json and one row per run as path.csv
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.json', 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    with open(path + '.csv', 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows({**record, 'expected_final': record['final']} for record in report['results'])
+    return path + '.json', path + '.csv'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('suite', nargs='?', default=DEFAULT_SUITE_PATH)
+    parser.add_argument('--repetitions', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rpm', type=float, default=3500, help='requests per minute allowed by the API key')
+    parser.add_argument('--tpm', type=float, default=90000, help='tokens per minute allowed by the API key')
+    parser.add_argument('--model', default='gpt-3.5-turbo-16k')
+    parser.add_argument('--pipeline', default='_llm', choices=['_llm', 'llm'], help='which NLP2SQL model to test')
+    parser.add_argument('--no-review', dest='review', action='store_false',
+                        help="turn off llm.py's review stage, without it no answer is final")
+    parser.add_argument('--checkpoint', default='reports/test_suite_checkpoint.jsonl')
+    parser.add_argument('--report', default='reports/test_suite_report', help='written as .json and .csv')
+    args = parser.parse_args()
+
+    from langchain.chat_models import ChatOpenAI
+    from llm_gateway import LLMGateway
+    if args.pipeline == 'llm':
+        from llm import initialize_model
+    else:
+        from _llm import initialize_model
+
+    llm = LLMGateway(ChatOpenAI(model=args.model, openai_api_key=os.environ['OPENAI_API_KEY'],
+                                temperature=0, max_retries=0),
+                     requests_per_minute=args.rpm, tokens_per_minute=args.tpm, max_in_flight=args.workers)
+    model = initialize_model(llm, {'review': args.review})
+    os.makedirs(os.path.dirname(args.checkpoint) or '.', exist_ok=True)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} runs", end='', flush=True)
+
+    report = run_suite(model, load_suite(args.suite), args.repetitions, args.workers,
+                       args.checkpoint, progress=progress)
+    json_path, csv_path = write_report(report, args.report)
+    print(f"\n{report['passed']}/{report['assertions']} assertions passed, {report['failed']} failed, "
+          f"{report['errors']} runs failed with errors, {report['reused']} reused from the checkpoint")
+    print(f"Report: {json_path}, {csv_path}")
+
+
+if __name__ == '__main__':
+    main()
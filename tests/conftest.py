@@ -0,0 +1,76 @@
+import json
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'benchmarks')]
+
+import _llm  # noqa: E402
+import llm  # noqa: E402
+from fake_llm import FakeChatModel  # noqa: E402
+from memory import ConversationMemory  # noqa: E402
+
+SUITE_PATH = ROOT / 'benchmarks' / 'question_suite.json'
+
+QUESTION = "What is the number of hits for hardy.net?"
+
+_DOMAIN_PATTERN = re.compile(r"[a-z0-9-]+\.(?:com|net|org|io)")
+
+
+class EchoChatModel(FakeChatModel):
+    """
+    A FakeChatModel whose SQL filters on every domain asked about in the
+    conversation, so an answer shows the context it was generated in
+    """
+
+    def _answer(self, messages: list, stage: str) -> str:
+        if stage == 'generation':
+            domains = []
+            for message in messages:
+                if message.type == 'human':
+                    domains += [domain for domain in _DOMAIN_PATTERN.findall(message.content)
+                                if domain not in domains]
+            listed = ', '.join(f"'{domain}'" for domain in domains)
+            return f"SELECT SUM(no_of_hits) FROM website_aggregates WHERE customer_domain IN ({listed});"
+        if stage == 'review' and messages[-1].content.startswith('Content:'):
+            # llm.py's review answers with the SQL it approves
+            return messages[-1].content[len('Content:'):].strip()
+        return super()._answer(messages, stage)
+
+
+def make_model(module, llm_, suite: dict, **options):
+    options.setdefault('review_backend', 'local')
+    options.setdefault('review', True)
+    model = module.initialize_model(llm_, options)
+    model.load_schema_as_string(suite['schema'])
+    return model
+
+
+def ask_follow_up(model, question: str):
+    # The first question is a standalone one of another shape
+    memory = ConversationMemory(max_turns=3)
+    model.predict("Which industries visited meta.com?", memory=memory)
+    return model.predict(question, memory=memory)
+
+
+def standalone(model, question: str):
+    return model.predict(question, memory=ConversationMemory(max_turns=0))
+
+
+@pytest.fixture(scope='session')
+def suite() -> dict:
+    with open(SUITE_PATH, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+@pytest.fixture
+def echo_llm() -> EchoChatModel:
+    return EchoChatModel(latency_ms=0, latency_sigma=0, relevant_ratio=1.0)
+
+
+@pytest.fixture(params=[_llm, llm], ids=['_llm', 'llm'])
+def module(request):
+    return request.param
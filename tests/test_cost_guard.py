@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import _llm
+import llm
+from conftest import make_model
+from cost_guard import CostAction, CostGuard, wrap_with_limit
+from memory import ConversationMemory
+
+
+class SlowExplainExecutor:
+    """
+    Stands in for a QueryExecutor whose EXPLAIN takes a database round trip
+    """
+
+    def __init__(self, seconds: float, cost: float = 10.0, rows: float = 10.0) -> None:
+        self.seconds = seconds
+        self.cost = cost
+        self.rows = rows
+        self.threads = set()
+
+    def explain(self, sql: str, timeout: float):
+        self.threads.add(threading.get_ident())
+        time.sleep(self.seconds)
+        return self.cost, self.rows
+
+
+@pytest.mark.parametrize('module', [_llm, llm], ids=['_llm', 'llm'])
+def test_apredict_explains_off_the_event_loop(module, echo_llm, suite):
+    executor = SlowExplainExecutor(0.2)
+    model = make_model(module, echo_llm, suite, cost_guard=CostGuard(executor))
+
+    async def ask_many():
+        loop_thread = threading.get_ident()
+        start = time.perf_counter()
+        outputs = await asyncio.gather(*[
+            model.apredict(f"What is the number of hits for site{index}.com?",
+                           memory=ConversationMemory(max_turns=0)) for index in range(4)])
+        return loop_thread, time.perf_counter() - start, outputs
+
+    loop_thread, seconds, outputs = asyncio.run(ask_many())
+    assert all(output.cost_verdict.action is CostAction.ALLOW for output in outputs)
+    assert loop_thread not in executor.threads
+    # Run on the loop the four EXPLAINs would take 0.8s one after another
+    assert seconds < 0.6
+
+
+def test_rows_over_the_limit_are_wrapped_with_a_limit(echo_llm, suite):
+    executor = SlowExplainExecutor(0, rows=1e6)
+    model = make_model(_llm, echo_llm, suite, cost_guard=CostGuard(executor, on_exceed='limit', limit=50))
+    output = asyncio.run(model.apredict("What is the number of hits for hardy.net?",
+                                        memory=ConversationMemory(max_turns=0)))
+    assert output.cost_verdict.action is CostAction.LIMIT
+    assert output.message == wrap_with_limit(output.cost_verdict.sql, 50)
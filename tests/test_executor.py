@@ -0,0 +1,97 @@
+import sqlite3
+import sys
+import types
+
+import pytest
+
+from _llm import ModelOutput
+from executor import ExecutionError, PostgresDialect, QueryExecutor, SQLiteDialect, query_sql
+
+
+@pytest.fixture
+def executor(tmp_path):
+    path = str(tmp_path / 'data.db')
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE website_aggregates (customer_domain TEXT, no_of_hits INT)")
+    connection.executemany("INSERT INTO website_aggregates VALUES (?, ?)", [('hardy.net', 3), ('meta.com', 5)])
+    connection.commit()
+    connection.close()
+    executor = QueryExecutor(SQLiteDialect(path), max_connections=2)
+    yield executor
+    executor.close()
+
+
+@pytest.fixture
+def psycopg2(monkeypatch):
+    """
+    A stand-in psycopg2 that records the connect() arguments
+    """
+    module = types.ModuleType('psycopg2')
+    module.errors = types.ModuleType('psycopg2.errors')
+    module.errors.QueryCanceled = type('QueryCanceled', (Exception,), {})
+    module.Error = Exception
+    module.connected = []
+
+    class Connection:
+        def set_session(self, **kwargs):
+            self.session = kwargs
+
+    def connect(**kwargs):
+        module.connected.append(kwargs)
+        return Connection()
+
+    module.connect = connect
+    monkeypatch.setitem(sys.modules, 'psycopg2', module)
+    monkeypatch.setitem(sys.modules, 'psycopg2.errors', module.errors)
+    return module
+
+
+@pytest.mark.parametrize('sql', [
+    "DELETE FROM website_aggregates",
+    "SELECT 1; DELETE FROM website_aggregates",
+    "SET statement_timeout = 0",
+    "COMMIT",
+])
+def test_query_sql_refuses_strings_that_are_not_read_only(sql):
+    with pytest.raises(ExecutionError):
+        query_sql(sql)
+
+
+def test_query_sql_accepts_read_only_strings():
+    assert query_sql("```sql\nSELECT 1;\n```") == "SELECT 1;"
+
+
+def test_query_sql_refuses_outputs_that_are_not_final_or_modify():
+    with pytest.raises(ExecutionError):
+        query_sql(ModelOutput("SELECT 1;", False))
+    # An LLM review may approve it, the classifier still says no
+    with pytest.raises(ExecutionError):
+        query_sql(ModelOutput("SELECT 1; DROP TABLE website_aggregates;", True))
+
+
+def test_executor_runs_select_and_refuses_writes(executor):
+    result = executor.execute("SELECT no_of_hits FROM website_aggregates WHERE customer_domain = 'meta.com'")
+    assert list(result.rows()) == [(5,)]
+    with pytest.raises(ExecutionError):
+        executor.execute("SELECT 1; DELETE FROM website_aggregates")
+    assert list(executor.execute("SELECT COUNT(*) FROM website_aggregates").rows()) == [(2,)]
+
+
+@pytest.mark.parametrize('method', ['run', 'explain', 'open_cursor'])
+def test_postgres_dialect_refuses_multiple_statements(psycopg2, method):
+    dialect = PostgresDialect(dsn='postgresql://localhost/test')
+    args = (None, "SELECT 1; COMMIT; DELETE FROM website_aggregates", 1.0)
+    if method == 'run':
+        args += (None,)
+    with pytest.raises(ExecutionError, match='single SQL statement'):
+        getattr(dialect, method)(*args)
+
+
+def test_postgres_connections_are_read_only_with_a_statement_timeout(psycopg2):
+    connection = PostgresDialect(statement_timeout=5, dsn='postgresql://localhost/test',
+                                 options='-c search_path=analytics').connect()
+    options = psycopg2.connected[0]['options']
+    assert options.startswith('-c search_path=analytics ')
+    assert '-c default_transaction_read_only=on' in options
+    assert '-c statement_timeout=5000' in options
+    assert connection.session['readonly'] is True
@@ -0,0 +1,57 @@
+import _llm
+from conftest import QUESTION, ask_follow_up, make_model, standalone
+from few_shot import ExampleStore
+from response_cache import ResponseCache
+from schema_parser import load_schema
+
+SUITE_SQL = "SELECT SUM(no_of_visiting_ips) FROM website_aggregates WHERE customer_domain ILIKE 'acme.com';"
+
+
+def test_example_store_only_learns_fresh_standalone_answers(echo_llm, suite):
+    store = ExampleStore()
+    model = make_model(_llm, echo_llm, suite, example_store=store, cache=ResponseCache())
+
+    ask_follow_up(model, QUESTION)
+    # Only the question the follow-up came after
+    assert len(store) == 1
+    standalone(model, QUESTION)
+    assert len(store) == 2
+    assert standalone(model, "What is the number of hits for acme.com?").metrics['few_shot_examples'] == 2
+    # An exact cache hit is not a new answer
+    standalone(model, "What is the number of hits for acme.com?")
+    assert len(store) == 3
+
+
+def test_example_store_is_scoped_by_schema(suite):
+    store = ExampleStore()
+    assert store.add_suite(suite) > 0
+    suite_schema = load_schema(suite['schema']).hash
+    other_schema = load_schema("CREATE TABLE orders (id INT, total FLOAT);").hash
+
+    assert store.search("How many visitors did acme.com get in May 2023?", suite_schema)
+    assert store.search("How many visitors did acme.com get in May 2023?", other_schema) == []
+    store.add("How many orders were placed in May 2023?", "SELECT COUNT(*) FROM orders;", other_schema)
+    assert [example.sql for example in store.search("How many orders were placed in June 2023?", other_schema)] \
+        == ["SELECT COUNT(*) FROM orders;"]
+
+
+def test_a_suite_case_is_not_answered_from_its_own_variants(suite):
+    variants = ["How many visitors did acme.com have?", "Give me the visitor count of acme.com",
+                "What is the number of users of acme.com?"]
+    small_suite = {'schema': suite['schema'], 'cases': [
+        {'input': variants[0], 'variants': variants[1:], 'sql_output': SUITE_SQL},
+        {'input': "How many visitors did shop.io have in 2023?",
+         'sql_output': "SELECT SUM(no_of_visiting_ips) FROM website_aggregates "
+                       "WHERE customer_domain ILIKE 'shop.io' AND dt >= '2023-01-01';"},
+    ]}
+    store = ExampleStore()
+    store.add_suite(small_suite)
+    schema_hash = load_schema(suite['schema']).hash
+
+    for question in variants:
+        examples = store.search(question, schema_hash)
+        assert examples
+        assert SUITE_SQL not in [example.sql for example in examples]
+    # A question the store has no answer for still gets the case as an example
+    assert SUITE_SQL in [example.sql for example in store.search("How many visitors did meta.com have?",
+                                                                 schema_hash)]
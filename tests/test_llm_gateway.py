@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from langchain.schema import HumanMessage
+
+import _llm
+from fake_llm import FakeChatModel
+from llm_gateway import LLMGateway
+
+MESSAGES = [HumanMessage(content="Which industries visited meta.com?")]
+
+
+def test_cancelled_async_call_frees_its_slot():
+    gateway = LLMGateway(FakeChatModel(latency_ms=200, latency_sigma=0), max_in_flight=4)
+
+    async def cancel_mid_call():
+        task = asyncio.ensure_future(gateway.apredict_messages(MESSAGES))
+        await asyncio.sleep(0.05)
+        assert gateway.stats()['in_flight'] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_mid_call())
+    stats = gateway.stats()
+    assert (stats['in_flight'], stats['failures'], stats['calls']) == (0, 0, 0)
+
+
+def test_interrupted_sync_call_frees_its_slot():
+    class Interrupted(FakeChatModel):
+        def _answer(self, messages, stage):
+            raise KeyboardInterrupt
+
+    gateway = LLMGateway(Interrupted(latency_ms=0, latency_sigma=0), max_in_flight=1)
+    with pytest.raises(KeyboardInterrupt):
+        gateway.predict_messages(MESSAGES)
+    assert gateway.stats()['in_flight'] == 0
+    assert gateway.stats()['failures'] == 0
+
+
+def test_discarded_speculation_does_not_leak_slots():
+    # Every question is irrelevant, so every speculative generation is cancelled
+    gateway = LLMGateway(FakeChatModel(latency_ms=20, latency_sigma=0, relevant_ratio=0.0), max_in_flight=4)
+    model = _llm.initialize_model(gateway, {'speculative': True, 'review_backend': 'local'})
+    model.load_schema_as_string("CREATE TABLE website_aggregates (customer_domain TEXT, no_of_hits INT);")
+
+    async def ask(question):
+        return await model.apredict(question, memory=_llm.ConversationMemory(max_turns=0))
+
+    for question in ("Which industries visited meta.com?", "What is the weather?", "Who won?"):
+        output = asyncio.run(ask(question))
+        assert output.metrics['speculation_kept'] is False
+        assert gateway.stats()['in_flight'] == 0
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import _llm
+import llm
+from conftest import QUESTION, make_model
+from fake_llm import FakeChatModel
+from memory import ConversationMemory
+
+# Only predict_stream measures these
+STREAM_METRICS = {'total_seconds', 'time_to_first_token_seconds'}
+
+CONFIGURATIONS = [
+    (_llm, {}),
+    (_llm, {'speculative': True}),
+    (_llm, {'pipeline': 'structured'}),
+    (_llm, {'review_backend': 'llm'}),
+    (llm, {}),
+    (llm, {'review': False}),
+]
+
+
+def answer(model, runner: str, question: str):
+    memory = ConversationMemory(max_turns=0)
+    if runner == 'predict':
+        return model.predict(question, memory=memory)
+    if runner == 'apredict':
+        return asyncio.run(model.apredict(question, memory=memory))
+    events = list(model.predict_stream(question, memory=memory))
+    assert [event.type for event in events[-1:]] == ['output']
+    return events[-1].output
+
+
+@pytest.mark.parametrize('relevant_ratio', [1.0, 0.0])
+@pytest.mark.parametrize('module, options', CONFIGURATIONS,
+                         ids=[f"{module.__name__}-{options}" for module, options in CONFIGURATIONS])
+def test_predict_apredict_and_predict_stream_run_the_same_stages(suite, module, options, relevant_ratio):
+    outputs = {}
+    for runner in ('predict', 'apredict', 'predict_stream'):
+        fake = FakeChatModel(latency_ms=0, latency_sigma=0, relevant_ratio=relevant_ratio)
+        model = make_model(module, fake, suite, trace=True, **options)
+        output = answer(model, runner, QUESTION)
+        stages = sorted(call['stage'] for call in fake.reset())
+        if output.metrics.get('speculation_kept') is False and 'generation' in stages:
+            # A discarded speculative call may or may not have gone out yet
+            stages.remove('generation')
+        outputs[runner] = (output.message, output.is_final_output, output.trace.branch,
+                           [stage.stage for stage in output.trace.stages], stages,
+                           sorted(set(output.metrics) - STREAM_METRICS))
+
+    assert outputs['predict'] == outputs['apredict'] == outputs['predict_stream']
+
+
+def test_predict_stream_reports_stages_and_streams_tokens(suite):
+    model = make_model(_llm, FakeChatModel(latency_ms=0, latency_sigma=0, relevant_ratio=1.0), suite,
+                       speculative=True)
+    events = list(model.predict_stream(QUESTION, memory=ConversationMemory(max_turns=0)))
+    assert [event.stage for event in events if event.type == 'stage'] == ['relevancy', 'generation', 'review']
+    output = events[-1].output
+    assert ''.join(event.content for event in events if event.type == 'token') == output.message
+    assert output.metrics['speculation_kept'] is True
+    assert output.metrics['total_seconds'] > 0
@@ -0,0 +1,59 @@
+import pytest
+
+import _llm
+import llm
+from conftest import QUESTION, ask_follow_up, make_model, standalone
+from query_templates import TemplateLibrary
+
+
+def test_templates_only_learn_and_answer_standalone_questions(module, echo_llm, suite):
+    templates = TemplateLibrary(min_support=2)
+    model = make_model(module, echo_llm, suite, query_templates=templates)
+    for domain in ('acme.com', 'shop.io', 'stripe.com'):
+        ask_follow_up(model, f"What is the number of hits for {domain}?")
+    assert standalone(model, QUESTION).metrics.get('cache') is None
+
+    for domain in ('acme.com', 'shop.io'):
+        standalone(model, f"What is the number of hits for {domain}?")
+    assert standalone(model, QUESTION).metrics.get('cache') == 'template'
+    assert ask_follow_up(model, "What is the number of hits for example.org?").metrics.get('cache') is None
+
+
+def learned_library(suite) -> TemplateLibrary:
+    templates = TemplateLibrary(min_support=2)
+    schema_hash = make_model(_llm, None, suite).schema_hash
+    for domain in ('acme.com', 'shop.io'):
+        templates.learn(f"What is the number of hits for {domain}?",
+                        f"SELECT SUM(no_of_hits) FROM website_aggregates WHERE customer_domain = '{domain}';",
+                        schema_hash)
+    return templates
+
+
+@pytest.mark.parametrize('module, options, final', [
+    (_llm, {}, True),
+    (llm, {'review': True}, True),
+    # llm.py answers are only final once reviewed, template answers too
+    (llm, {'review': False}, False),
+])
+def test_template_answers_are_final_like_pipeline_answers(echo_llm, suite, module, options, final):
+    model = make_model(module, echo_llm, suite, query_templates=learned_library(suite), **options)
+    output = standalone(model, QUESTION)
+    assert output.metrics.get('cache') == 'template'
+    assert output.is_final_output is final
+    assert output.is_final_output is standalone(make_model(module, echo_llm, suite, **options),
+                                                QUESTION).is_final_output
+
+
+def test_template_sql_the_classifier_rejects_is_not_served(module, echo_llm, suite):
+    class Modifying:
+        def learn(self, question, sql, schema_hash):
+            return False
+
+        def match(self, question, schema_hash):
+            return learned_library(suite).match(question, schema_hash)._replace(
+                sql="DELETE FROM website_aggregates WHERE customer_domain = 'hardy.net';")
+
+    model = make_model(module, echo_llm, suite, query_templates=Modifying())
+    output = standalone(model, QUESTION)
+    assert output.metrics.get('cache') is None
+    assert output.message.startswith("SELECT")
@@ -0,0 +1,16 @@
+import time
+
+from response_cache import ResponseCache, SQLiteCacheBackend
+
+
+def test_disk_cache_entries_expire_with_the_cache_ttl(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    ResponseCache(ttl=0.3, backend=SQLiteCacheBackend(path)).set('key', {'message': 'SELECT 1'})
+
+    restarted = ResponseCache(ttl=0.3, backend=SQLiteCacheBackend(path))
+    time.sleep(0.1)
+    assert restarted.get('key') == {'message': 'SELECT 1'}
+    time.sleep(0.3)
+    # Neither the copy put in memory by the disk hit nor the disk entry outlive the ttl
+    assert restarted.get('key') is None
+    assert SQLiteCacheBackend(path).get('key') is None
@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from executor import QueryExecutor, SQLiteDialect
+from result_cache import ResultCache, canonicalize_sql, make_result_key, referenced_tables
+
+
+def tables(sql: str) -> set:
+    return set(referenced_tables(canonicalize_sql(sql)[2]))
+
+
+def test_spacing_and_case_share_a_key_but_literals_do_not():
+    key, _ = make_result_key("SELECT * FROM t WHERE a = 1", None)
+    assert make_result_key("select *\n  from T where A = 1;", None)[0] == key
+    assert make_result_key("SELECT * FROM t WHERE a = 2", None)[0] != key
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM website_aggregates w JOIN public.industries AS i ON i.id = w.id",
+     {'website_aggregates', 'industries'}),
+    ("WITH recent AS (SELECT * FROM visits) SELECT * FROM recent", {'visits'}),
+    ("SELECT EXTRACT(YEAR FROM dt) FROM visits", {'visits'}),
+    ("SELECT * FROM ONLY website_aggregates", {'website_aggregates'}),
+    ("SELECT * FROM ONLY public.visits v, ONLY industries", {'visits', 'industries'}),
+])
+def test_referenced_tables(sql, expected):
+    assert tables(sql) == expected
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM visits WHERE dt > now() - INTERVAL '1 day'",
+    "SELECT * FROM visits WHERE dt = CURRENT_DATE",
+    "SELECT current_timestamp, localtimestamp",
+    "SELECT * FROM visits ORDER BY random() LIMIT 5",
+    "SELECT clock_timestamp()",
+    "SELECT * FROM visits WHERE dt > date('now', '-7 days')",
+    "SELECT 'now'::timestamp",
+])
+def test_queries_reading_the_clock_or_random_are_not_cached(sql):
+    assert make_result_key(sql, None) == (None, None)
+
+
+def test_executor_reuses_results_and_skips_volatile_queries(tmp_path):
+    path = str(tmp_path / 'data.db')
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE visits (customer_domain TEXT, no_of_hits INT)")
+    connection.execute("INSERT INTO visits VALUES ('hardy.net', 3)")
+    connection.commit()
+    connection.close()
+    cache = ResultCache()
+    executor = QueryExecutor(SQLiteDialect(path), max_connections=1, cache=cache)
+    try:
+        assert not executor.execute("SELECT * FROM visits").cached
+        assert executor.execute("select * from visits;").cached
+        for _ in range(2):
+            assert not executor.execute("SELECT random() FROM visits").cached
+        assert cache.invalidate('visits') == 1
+        assert cache.stats()['size'] == 0
+    finally:
+        executor.close()
@@ -0,0 +1,49 @@
+import pytest
+
+from conftest import QUESTION, ask_follow_up, make_model, standalone
+from semantic_cache import SemanticCache
+
+SQL = {'message': "SELECT 1;", 'is_final_output': True}
+
+
+def test_follow_up_is_not_answered_from_semantic_cache(module, echo_llm, suite):
+    model = make_model(module, echo_llm, suite, semantic_cache=SemanticCache())
+    assert "'hardy.net'" in standalone(model, QUESTION).message
+
+    output = ask_follow_up(model, QUESTION)
+    assert output.metrics.get('cache') is None
+    assert "'meta.com'" in output.message
+
+
+def test_follow_up_is_not_stored_in_semantic_cache(module, echo_llm, suite):
+    model = make_model(module, echo_llm, suite, semantic_cache=SemanticCache())
+    ask_follow_up(model, QUESTION)
+
+    output = standalone(model, QUESTION)
+    assert output.metrics.get('cache') is None
+    assert "'meta.com'" not in output.message
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ("What is the number of hits for hardy.net?", "Show me the number of hits for hardy.net"),
+    ("How many users visited meta.com in 2023?", "how many visitors visited meta.com in 2023"),
+])
+def test_rewordings_hit(cached, asked):
+    cache = SemanticCache()
+    cache.insert(cached, 'schema', SQL)
+    assert cache.lookup(asked, 'schema') is not None
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ("count of hits for meta.com", "sum of hits for meta.com"),
+    ("total hits for meta.com", "average hits for meta.com"),
+    ("top industries by visitors for meta.com", "industries by visitors for meta.com"),
+    ("visitors from united states for meta.com", "visitors not from united states for meta.com"),
+    ("visitors from united states for meta.com", "visitors except united states for meta.com"),
+    ("industries that visited meta.com", "industries that didn't visit meta.com"),
+    ("hits for meta.com in 2023", "hits for meta.com in 2022"),
+])
+def test_other_aggregates_negations_and_literals_miss(cached, asked):
+    cache = SemanticCache()
+    cache.insert(cached, 'schema', SQL)
+    assert cache.lookup(asked, 'schema') is None
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import _llm
+from conftest import ROOT
+from fake_llm import FakeChatModel
+from sql_classifier import Verdict, classify_sql
+
+with open(ROOT / 'benchmarks' / 'review_corpus.json', 'r', encoding='utf-8') as file:
+    CORPUS = json.load(file)
+
+
+def test_corpus_has_both_verdicts():
+    assert {case['llm_verdict'] for case in CORPUS} == {'yes', 'no'}
+
+
+@pytest.mark.parametrize('case', CORPUS, ids=[case['sql'][:40] for case in CORPUS])
+def test_classifier_agrees_with_the_llm_review(case):
+    verdict = classify_sql(case['sql'])
+    # UNKNOWN is left to the LLM, it never contradicts it
+    if verdict is not Verdict.UNKNOWN:
+        assert ('yes' if verdict is Verdict.READ_ONLY else 'no') == case['llm_verdict']
+
+
+@pytest.mark.parametrize('sql', [
+    "EXPLAIN ANALYZE DELETE FROM website_aggregates",
+    "WITH gone AS (DELETE FROM website_aggregates RETURNING *) SELECT * FROM gone",
+    "SELECT * FROM website_aggregates FOR UPDATE",
+    "SELECT customer_domain INTO backup FROM website_aggregates",
+    "SELECT pg_sleep(10)",
+    "SELECT 1; DROP TABLE website_aggregates",
+    "```sql\nDELETE FROM website_aggregates;\n```",
+])
+def test_hidden_writes_are_caught(sql):
+    assert classify_sql(sql) is Verdict.MODIFIES
+
+
+@pytest.mark.parametrize('sql', ["Sum the hits of meta.com", "SELECT 1 /* unterminated"])
+def test_what_it_cannot_read_is_unknown(sql):
+    assert classify_sql(sql) is Verdict.UNKNOWN
+
+
+def test_local_review_falls_back_to_the_llm_only_when_unknown():
+    fake = FakeChatModel(latency_ms=0, latency_sigma=0)
+    model = _llm.initialize_model(fake, {'review_backend': 'local'})
+    model.load_schema_as_string("CREATE TABLE website_aggregates (customer_domain TEXT, no_of_hits INT);")
+
+    def review(sql):
+        return model._run_steps(model._review(sql, model.schema))
+
+    assert review("DELETE FROM website_aggregates") == (False, 'local')
+    assert review(CORPUS[0]['sql']) == (True, 'local')
+    assert fake.reset() == []
+    assert review("Sum the hits of meta.com") == (True, 'llm')
+    assert [call['stage'] for call in fake.reset()] == ['review']
@@ -0,0 +1,122 @@
+import sqlite3
+
+import pytest
+
+import _llm
+import llm
+import suite_runner
+from executor import QueryExecutor, SQLiteDialect
+from fake_llm import FakeChatModel, FakeRateLimitError
+from sql_classifier import Verdict, classify_sql
+
+
+@pytest.fixture
+def executor(tmp_path):
+    path = str(tmp_path / 'data.db')
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE website_aggregates (customer_domain TEXT, no_of_hits INT)")
+    connection.executemany("INSERT INTO website_aggregates VALUES (?, ?)", [('hardy.net', 3), ('meta.com', 5)])
+    connection.commit()
+    connection.close()
+    executor = QueryExecutor(SQLiteDialect(path), max_connections=2)
+    yield executor
+    executor.close()
+
+
+def test_final_cases_have_read_only_expected_sql(suite):
+    for case in suite['cases']:
+        if case['final']:
+            assert classify_sql(case['sql_output']) is Verdict.READ_ONLY, case['question']
+        else:
+            assert 'sql_output' not in case
+
+
+def test_same_sql_compares_rows(executor):
+    assert suite_runner.same_sql("SELECT SUM(no_of_hits) FROM website_aggregates",
+                                 "SELECT 8", executor)
+    assert not suite_runner.same_sql("SELECT SUM(no_of_hits) FROM website_aggregates",
+                                     "SELECT 5", executor)
+
+
+def test_same_sql_fails_when_the_expected_query_does_not_run(executor):
+    assert not suite_runner.same_sql("SELECT SUM(no_of_hits) FROM website_aggregates",
+                                     "SELECT SUM(no_of_visiting_ips) FROM website_aggregates", executor)
+
+
+def test_checkpoint_keeps_the_runs_of_other_configurations(tmp_path, suite):
+    small_suite = {'schema': suite['schema'], 'cases': suite['cases'][:3] + suite['cases'][-2:]}
+    path = str(tmp_path / 'checkpoint.jsonl')
+
+    def run(module, options):
+        model = module.initialize_model(FakeChatModel(latency_ms=0, latency_sigma=0), options)
+        return suite_runner.run_suite(model, small_suite, workers=2, checkpoint_path=path)
+
+    first = run(_llm, {'review_backend': 'local'})
+    assert first['reused'] == 0
+    other = run(llm, {'review': True})
+    assert other['fingerprint'] != first['fingerprint']
+    again = run(_llm, {'review_backend': 'local'})
+    assert again['reused'] == len(suite_runner.expand_cases(small_suite))
+    assert again['passed'] == first['passed']
+
+
+@pytest.mark.parametrize('argv, module, review', [
+    ([], _llm, True),
+    (['--pipeline', 'llm'], llm, True),
+    (['--pipeline', 'llm', '--no-review'], llm, False),
+])
+def test_main_tests_a_pipeline_that_can_give_final_answers(monkeypatch, tmp_path, argv, module, review):
+    import langchain.chat_models
+    built = []
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.setattr(langchain.chat_models, 'ChatOpenAI', lambda **kwargs: FakeChatModel())
+    monkeypatch.setattr(module, 'initialize_model', lambda llm_, options: built.append(options) or 'model')
+    monkeypatch.setattr(suite_runner, 'run_suite', lambda model, *args, **kwargs: {
+        'passed': 0, 'assertions': 0, 'failed': 0, 'errors': 0, 'reused': 0})
+    monkeypatch.setattr(suite_runner, 'write_report', lambda report, path: (path + '.json', path + '.csv'))
+    monkeypatch.setattr('sys.argv', ['suite_runner.py', '--checkpoint', str(tmp_path / 'checkpoint.jsonl')] + argv)
+
+    suite_runner.main()
+    assert built == [{'review': review}]
+
+
+class FailingModel:
+    """
+    Raises error on the first `failures` calls of predict, then answers
+    """
+
+    def __init__(self, error: Exception, failures: int) -> None:
+        self.error = error
+        self.failures = failures
+        self.calls = 0
+
+    def predict(self, question, memory=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return _llm.ModelOutput("SELECT 1;", True)
+
+
+def test_rate_limits_are_left_to_the_gateway():
+    model = FailingModel(FakeRateLimitError("Rate limit reached for requests"), failures=1)
+    record = suite_runner._run_case(model, suite_runner.SuiteCase('aggregation', 'question', 0), None, 3)
+    assert model.calls == 1
+    assert 'FakeRateLimitError' in record['error']
+
+
+def test_other_transient_failures_are_retried():
+    model = FailingModel(FakeRateLimitError("The server is overloaded", http_status=503), failures=1)
+    record = suite_runner._run_case(model, suite_runner.SuiteCase('aggregation', 'question', 0), None, 3)
+    assert model.calls == 2
+    assert record['error'] == '' and record['final_ok'] is True
+
+
+def test_report_covers_the_categories_and_variants_of_the_suite(suite):
+    model = _llm.initialize_model(FakeChatModel(latency_ms=0, latency_sigma=0), {'review_backend': 'local'})
+    report = suite_runner.run_suite(model, suite, workers=4)
+    categories = {case['category'] for case in suite['cases']}
+    inputs = sum(1 + len(case.get('variants', [])) for case in suite['cases'])
+    assert report['categories'] == len(categories) > 1
+    assert set(report['by_category']) == categories
+    assert len(report['results']) == inputs > len(suite['cases'])
+    assert report['variants_per_category'] == round(inputs / len(categories), 1)
@@ -0,0 +1,16 @@
+from tracing import PrometheusSink, Trace
+
+
+def test_prometheus_label_values_are_escaped():
+    trace = Trace('question')
+    trace.add_stage('review', 0.2, backend='local "fast"\\path\nnext', prompt_tokens=3, completion_tokens=1)
+    trace.finish('approved', cache='semantic')
+    sink = PrometheusSink()
+    sink.emit(trace)
+
+    lines = sink.render().splitlines()
+    assert 'nlp2sql_requests_total{branch="approved"} 1' in lines
+    assert 'nlp2sql_cache_hits_total{cache="semantic"} 1' in lines
+    assert 'nlp2sql_stage_seconds_count{stage="review",backend="local \\"fast\\"\\\\path\\nnext"} 1' in lines
+    # The newline in the label doesn't break the sample over two lines
+    assert all(line.startswith(('#', 'nlp2sql_')) for line in lines)
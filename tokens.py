@@ -0,0 +1,25 @@
+import re
+
+# Rough stand-in for a BPE tokenizer that works offline: words are split
+# into chunks of up to four characters and every punctuation mark counts
+# as its own token, which lands close to the OpenAI tokenizers on SQL and
+# English prose
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+# Every chat message carries a few tokens of role/formatting overhead
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens in the text without calling the model
+    """
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def estimate_message_tokens(messages: list) -> int:
+    """
+    Estimates the number of prompt tokens a list of chat messages costs
+    """
+    return sum(estimate_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+               for message in messages)
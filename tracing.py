@@ -0,0 +1,226 @@
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tokens import estimate_message_tokens, estimate_tokens
+
+# Upper bounds in seconds of the Prometheus latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+@dataclass
+class StageTrace:
+    stage: str
+    seconds: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    backend: str = 'llm'
+    model: str = ''
+    cost: float = 0.0
+
+
+@dataclass
+class Trace:
+    """
+    What happened during one predict call: the stages that ran, with wall
+    time and estimated tokens, the branch taken ('approved', 'rejected',
+    'unreviewed', 'clarification' or 'cache') and the kind of cache hit
+    """
+    question: str
+    started_at: float = field(default_factory=time.time)
+    stages: list = field(default_factory=list)
+    branch: str = ''
+    cache: str = ''
+    total_seconds: float = 0.0
+    _start: float = field(default_factory=time.perf_counter, repr=False)
+
+    def add_stage(self, stage: str, seconds: float, messages: list = None, response: str = '',
+                  backend: str = 'llm', model: str = '', cost: float = 0.0,
+                  prompt_tokens: int = None, completion_tokens: int = None) -> None:
+        # The router passes the tokens it already estimated
+        if prompt_tokens is None:
+            prompt_tokens = estimate_message_tokens(messages) if messages else 0
+        if completion_tokens is None:
+            completion_tokens = estimate_tokens(response)
+        self.stages.append(StageTrace(stage, seconds, prompt_tokens, completion_tokens, backend, model, cost))
+
+    def finish(self, branch: str, cache: str = '') -> None:
+        self.branch = branch
+        self.cache = cache
+        self.total_seconds = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        trace = asdict(self)
+        del trace['_start']
+        return trace
+
+
+def tracing_enabled(options: dict) -> bool:
+    """
+    Traces are only built when options['trace'] is set or sinks are
+    configured in options['trace_sinks'], so they cost nothing otherwise
+    """
+    return bool(options.get('trace') or options.get('trace_sinks'))
+
+
+def emit_trace(trace: Trace, sinks) -> None:
+    for sink in sinks or ():
+        sink.emit(trace)
+
+
+class RingBufferSink:
+    """
+    Keeps the most recent traces in memory
+    """
+
+    def __init__(self, capacity: int = 1000) -> None:
+        self._traces = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def emit(self, trace: Trace) -> None:
+        with self._lock:
+            self._traces.append(trace)
+
+    def traces(self) -> list:
+        with self._lock:
+            return list(self._traces)
+
+
+class JSONLinesSink:
+    """
+    Appends every trace to a file as one JSON object per line
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict()) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line)
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape_label(value) -> str:
+    # The exposition format only escapes these three in label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+class PrometheusSink:
+    """
+    Aggregates traces into counters and latency histograms and renders
+    them in the Prometheus text exposition format. serve() exposes them
+    on /metrics from a background thread.
+    """
+
+    def __init__(self, prefix: str = 'nlp2sql', buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._requests = {}
+        self._cache_hits = {}
+        self._tokens = {}
+        self._request_seconds = _Histogram(self.buckets)
+        self._stage_seconds = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, collector) -> None:
+        """
+        Adds the lines of collector.prometheus_lines(prefix) to every
+        render, e.g. the queue metrics of an LLMGateway
+        """
+        self._collectors.append(collector)
+
+    def emit(self, trace: Trace) -> None:
+        with self._lock:
+            self._requests[trace.branch] = self._requests.get(trace.branch, 0) + 1
+            if trace.cache:
+                self._cache_hits[trace.cache] = self._cache_hits.get(trace.cache, 0) + 1
+            self._request_seconds.observe(trace.total_seconds)
+            for stage in trace.stages:
+                key = (stage.stage, stage.backend)
+                if key not in self._stage_seconds:
+                    self._stage_seconds[key] = _Histogram(self.buckets)
+                self._stage_seconds[key].observe(stage.seconds)
+                for kind, tokens in (('prompt', stage.prompt_tokens), ('completion', stage.completion_tokens)):
+                    self._tokens[(stage.stage, kind)] = self._tokens.get((stage.stage, kind), 0) + tokens
+
+    def _histogram_lines(self, name: str, histogram: _Histogram, **labels) -> list:
+        lines = [f"{name}_bucket{_labels(**labels, le=bound)} {count}"
+                 for bound, count in zip(histogram.buckets, histogram.counts)]
+        lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(**labels) if labels else ''} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(**labels) if labels else ''} {histogram.count}")
+        return lines
+
+    def render(self) -> str:
+        prefix = self.prefix
+        with self._lock:
+            lines = [f"# HELP {prefix}_requests_total Predict calls by branch taken.",
+                     f"# TYPE {prefix}_requests_total counter"]
+            lines += [f"{prefix}_requests_total{_labels(branch=branch)} {count}"
+                      for branch, count in sorted(self._requests.items())]
+            lines += [f"# HELP {prefix}_cache_hits_total Answers served from a cache.",
+                      f"# TYPE {prefix}_cache_hits_total counter"]
+            lines += [f"{prefix}_cache_hits_total{_labels(cache=cache)} {count}"
+                      for cache, count in sorted(self._cache_hits.items())]
+            lines += [f"# HELP {prefix}_tokens_total Estimated tokens by stage.",
+                      f"# TYPE {prefix}_tokens_total counter"]
+            lines += [f"{prefix}_tokens_total{_labels(stage=stage, kind=kind)} {count}"
+                      for (stage, kind), count in sorted(self._tokens.items())]
+            lines += [f"# HELP {prefix}_request_seconds End-to-end predict latency.",
+                      f"# TYPE {prefix}_request_seconds histogram"]
+            lines += self._histogram_lines(f"{prefix}_request_seconds", self._request_seconds)
+            lines += [f"# HELP {prefix}_stage_seconds Latency of each stage.",
+                      f"# TYPE {prefix}_stage_seconds histogram"]
+            for (stage, backend), histogram in sorted(self._stage_seconds.items()):
+                lines += self._histogram_lines(f"{prefix}_stage_seconds", histogram,
+                                               stage=stage, backend=backend)
+        for collector in self._collectors:
+            lines += collector.prometheus_lines(prefix)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9108, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='nlp2sql-metrics', daemon=True).start()
+        return server